@@ -0,0 +1,24 @@
+"""Add latency_ms to notifications delivery journal
+
+Revision ID: 3f6a1c2d9e51
+Revises: d9b14e47cac0
+Create Date: 2026-10-17 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f6a1c2d9e51'
+down_revision = 'd9b14e47cac0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('notifications', sa.Column('latency_ms', sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('notifications', 'latency_ms')
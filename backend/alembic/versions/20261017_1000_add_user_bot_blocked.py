@@ -0,0 +1,36 @@
+"""Add is_bot_blocked to users with partial reachable index
+
+Revision ID: 7b2e9c4f1a08
+Revises: 3f6a1c2d9e51
+Create Date: 2026-10-17 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7b2e9c4f1a08'
+down_revision = '3f6a1c2d9e51'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('users', sa.Column('is_bot_blocked', sa.Boolean(), server_default=sa.false(), nullable=False))
+    op.add_column('users', sa.Column('bot_blocked_at', sa.DateTime(timezone=True), nullable=True))
+    op.add_column('users', sa.Column('bot_blocked_reason', sa.String(length=50), nullable=True))
+    op.create_index(
+        'ix_users_reachable',
+        'users',
+        ['primary_address_id', 'user_id'],
+        unique=False,
+        postgresql_where=sa.text('is_bot_blocked = false AND is_blocked IS NOT true')
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_users_reachable', table_name='users')
+    op.drop_column('users', 'bot_blocked_reason')
+    op.drop_column('users', 'bot_blocked_at')
+    op.drop_column('users', 'is_bot_blocked')
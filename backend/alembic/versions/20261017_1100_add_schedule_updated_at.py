@@ -0,0 +1,29 @@
+"""Add updated_at to schedules for incremental warning scheduling
+
+Revision ID: 5c8d2a7e3b14
+Revises: 7b2e9c4f1a08
+Create Date: 2026-10-17 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c8d2a7e3b14'
+down_revision = '7b2e9c4f1a08'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        'schedules',
+        sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False)
+    )
+    op.create_index(op.f('ix_schedules_updated_at'), 'schedules', ['updated_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_schedules_updated_at'), table_name='schedules')
+    op.drop_column('schedules', 'updated_at')
@@ -0,0 +1,24 @@
+"""Add measured_at to iot_data for batched readings with device timestamps
+
+Revision ID: 9e4f1b6c2d37
+Revises: 5c8d2a7e3b14
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9e4f1b6c2d37'
+down_revision = '5c8d2a7e3b14'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('iot_data', sa.Column('measured_at', sa.DateTime(timezone=True), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('iot_data', 'measured_at')
@@ -0,0 +1,40 @@
+"""Change-only storage for iot_data: prev_seen_at and (sensor_id, measured_at) index
+
+Revision ID: 3a7d5e9f0c21
+Revises: 9e4f1b6c2d37
+Create Date: 2026-10-17 13:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3a7d5e9f0c21'
+down_revision = '9e4f1b6c2d37'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Живые показания: время сенсора = время получения
+    op.execute("UPDATE iot_data SET measured_at = received_at WHERE measured_at IS NULL")
+    op.alter_column(
+        'iot_data', 'measured_at',
+        existing_type=sa.DateTime(timezone=True),
+        nullable=False,
+        server_default=sa.text('now()')
+    )
+    op.add_column('iot_data', sa.Column('prev_seen_at', sa.DateTime(timezone=True), nullable=True))
+    op.create_index('ix_iot_data_sensor_id_measured_at', 'iot_data', ['sensor_id', 'measured_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_iot_data_sensor_id_measured_at', table_name='iot_data')
+    op.drop_column('iot_data', 'prev_seen_at')
+    op.alter_column(
+        'iot_data', 'measured_at',
+        existing_type=sa.DateTime(timezone=True),
+        nullable=True,
+        server_default=None
+    )
@@ -0,0 +1,27 @@
+"""Add replayed flag to iot_data for readings outside change-only spans
+
+Revision ID: 6b1c8e4d9a52
+Revises: 3a7d5e9f0c21
+Create Date: 2026-10-17 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6b1c8e4d9a52'
+down_revision = '3a7d5e9f0c21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        'iot_data',
+        sa.Column('replayed', sa.Boolean(), server_default=sa.text('false'), nullable=False)
+    )
+
+
+def downgrade() -> None:
+    op.drop_column('iot_data', 'replayed')
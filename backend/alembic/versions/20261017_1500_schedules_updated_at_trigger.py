@@ -0,0 +1,38 @@
+"""Maintain schedules.updated_at with a trigger for writes outside the ORM
+
+Revision ID: 8d3f6a2c5e17
+Revises: 6b1c8e4d9a52
+Create Date: 2026-10-17 15:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '8d3f6a2c5e17'
+down_revision = '6b1c8e4d9a52'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # onupdate в модели срабатывает только для ORM; core UPDATE, сырой SQL
+    # и ручные правки тоже должны попадать в инкрементальную выборку планировщика
+    op.execute("""
+        CREATE OR REPLACE FUNCTION schedules_touch_updated_at() RETURNS trigger AS $$
+        BEGIN
+            NEW.updated_at := now();
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER schedules_touch_updated_at
+        BEFORE UPDATE ON schedules
+        FOR EACH ROW EXECUTE FUNCTION schedules_touch_updated_at()
+    """)
+
+
+def downgrade() -> None:
+    op.execute("DROP TRIGGER IF EXISTS schedules_touch_updated_at ON schedules")
+    op.execute("DROP FUNCTION IF EXISTS schedules_touch_updated_at()")
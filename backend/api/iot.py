@@ -1,13 +1,20 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Header
+from fastapi import APIRouter, Depends, HTTPException, Request, status, Header
+from fastapi.exceptions import RequestValidationError
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
-from typing import Optional
-from pydantic import BaseModel
-from datetime import datetime, timedelta
+from sqlalchemy import select, update
+from typing import List, Optional, Tuple
+from pydantic import BaseModel, Field, ValidationError, field_validator
+from datetime import datetime, timedelta, timezone
+import zlib
 
 from database import get_db
 from models.iot_sensor import IoTSensor, IoTData
+from models.queue import Queue
 from config import settings
+from services.power_status import power_status_coalescer
+from services.outage_trace import outage_tracer, STAGE_CONSENSUS, STAGE_STATUS_COMMIT
+from services.iot_registry import iot_registry, now_ms
+from services.iot_ingest import iot_write_buffer, change_filter, reading_row, reading_at
 
 router = APIRouter(prefix="/api/iot", tags=["IoT"])
 
@@ -37,6 +44,24 @@ class IoTDataReceive(BaseModel):
     frequency: Optional[float] = None  # PRO sensors
 
 
+class IoTReading(BaseModel):
+    is_power_on: bool
+    voltage: Optional[float] = Field(None, ge=0, lt=1000)  # PRO sensors
+    frequency: Optional[float] = Field(None, ge=0, lt=1000)  # PRO sensors
+    measured_at: datetime  # по часам сенсора: ISO 8601 или unix time
+    
+    @field_validator("measured_at")
+    @classmethod
+    def assume_utc(cls, value: datetime) -> datetime:
+        """Время без часового пояса - UTC (часы ESP32 синхронизируются по NTP)"""
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+class IoTDataBatch(BaseModel):
+    sensor_id: str
+    readings: List[IoTReading] = Field(..., min_length=1, max_length=settings.IOT_BATCH_MAX_READINGS)
+
+
 class IoTSensorCreate(BaseModel):
     sensor_id: str
     queue_id: int
@@ -72,6 +97,14 @@ async def receive_iot_data(
     
     **Вызывается ESP32 каждые 10-30 секунд**
     
+    Пинг без смены состояния не обращается к Postgres в запросе: сенсор,
+    состояние черги и показания других сенсоров берутся из Redis
+    (services.iot_registry), строка iot_data (только при изменении
+    показания) уходит в write-behind буфер (services.iot_ingest),
+    last_ping_at переносит задача sync_iot_pings.
+    
+    Буфер переполнен (Postgres не успевает) - 429 с Retry-After.
+    
     Формат запроса:
     ```
     POST /api/iot/data
@@ -85,90 +118,131 @@ async def receive_iot_data(
     ```
     """
     
-    # 1. Обновить статус сенсора
-    result = await db.execute(
-        select(IoTSensor).where(IoTSensor.sensor_id == data.sensor_id)
+    check_write_capacity(1)
+    
+    queue_id, status_changed = await apply_reading(
+        db, data.sensor_id, data.is_power_on, voltage=data.voltage
     )
-    sensor = result.scalar_one_or_none()
     
-    if not sensor:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Sensor {data.sensor_id} not found"
-        )
+    # Сохранить данные (только изменения, write-behind буфер, запись после ответа сенсору)
+    iot_write_buffer.submit(await change_filter.select(data.sensor_id, [
+        reading_row(data.sensor_id, data.is_power_on, data.voltage, data.frequency)
+    ]))
     
-    sensor.is_online = True
-    sensor.last_ping_at = datetime.utcnow()
+    if status_changed is None:
+        return {"status": "received", "message": "Data saved, but queue not found"}
     
-    # 2. Сохранить данные
-    iot_data = IoTData(
-        sensor_id=data.sensor_id,
-        is_power_on=data.is_power_on,
-        voltage=data.voltage,
-        frequency=data.frequency
-    )
+    return {
+        "status": "received",
+        "sensor_id": data.sensor_id,
+        "queue_id": queue_id,
+        "power_status": "ON" if data.is_power_on else "OFF",
+        "status_changed": status_changed
+    }
+
+
+@router.post("/data/batch", dependencies=[Depends(verify_iot_key)])
+async def receive_iot_data_batch(
+    request: Request,
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Получить пакет показаний от IoT сенсора
     
-    db.add(iot_data)
+    **Сенсор на нестабильном 4G копит показания и досылает их одним запросом**
     
-    # 3. Проверить изменение статуса черги
-    from models.queue import Queue
-    result = await db.execute(
-        select(Queue).where(Queue.queue_id == sensor.queue_id)
-    )
-    queue = result.scalar_one_or_none()
+    Показания валидируются все сразу и уходят в iot_data через
+    write-behind буфер (сбрасывается одним COPY; measured_at - время по
+    часам сенсора), логика смены состояния черги
+    выполняется один раз - по последнему показанию упорядоченного пакета.
+    Более ранние показания - история, рассылок по ним нет.
     
-    if not queue:
-        await db.commit()
-        return {"status": "received", "message": "Data saved, but queue not found"}
+    Тело можно сжать gzip (Content-Encoding: gzip). Показания "из будущего"
+    дальше IOT_CLOCK_SKEW отбрасываются (rejected в ответе). Пакет не
+    помещается в буфер - 429 с Retry-After, сенсор повторит его позже.
     
-    # Текущий статус черги
-    current_status = queue.is_power_on
-    new_status = data.is_power_on
-    
-    # 4. Логика подтверждения (2 сенсора)
-    status_changed = False
-    
-    if current_status != new_status:
-        # Статус изменился - проверить второй сенсор
-        other_sensor = await get_other_sensor(db, sensor.queue_id, data.sensor_id)
-        
-        if other_sensor:
-            # Есть второй сенсор - проверить его последние данные
-            other_data = await get_latest_sensor_data(db, other_sensor.sensor_id)
-            
-            if other_data and other_data.is_power_on == new_status:
-                # ✅ Оба сенсора подтверждают изменение
-                queue.is_power_on = new_status
-                queue.last_change_at = datetime.utcnow()
-                queue.last_change_source = 'iot'
-                
-                if not new_status:
-                    queue.total_outages += 1
-                
-                status_changed = True
-                
-                # TODO: Trigger notification
-                # from tasks.notification_dispatcher import send_power_notification
-                # send_power_notification.delay(sensor.queue_id, new_status)
-            else:
-                # ⏳ Только один сенсор сообщил об изменении
-                # Ждём подтверждения от второго (в следующем ping)
-                pass
-        else:
-            # Нет второго сенсора - принимаем данные от одного
-            queue.is_power_on = new_status
-            queue.last_change_at = datetime.utcnow()
-            queue.last_change_source = 'iot'
-            status_changed = True
+    Формат запроса:
+    ```
+    POST /api/iot/data/batch
+    Headers: X-IoT-Key: your_iot_api_key
+             Content-Encoding: gzip  (необязательно)
+    Body: {
+        "sensor_id": "ESP32_CH5_01",
+        "readings": [
+            {"is_power_on": false, "measured_at": "2026-10-17T10:00:00Z"},
+            {"is_power_on": true, "voltage": 224.5, "frequency": 50.1, "measured_at": 1792231230}
+        ]
+    }
+    ```
+    """
     
-    await db.commit()
+    batch = await read_batch(request)
+    
+    # 1. Сенсор должен быть зарегистрирован до записи показаний
+    queue_id = await iot_registry.sensor_queue(batch.sensor_id)
+    if queue_id is None and await ensure_registry_loaded(db):
+        queue_id = await iot_registry.sensor_queue(batch.sensor_id)
+    
+    if queue_id is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Sensor {batch.sensor_id} not found"
+        )
+    
+    # 2. Упорядочить по времени сенсора, отбросить показания "из будущего"
+    received_at = datetime.now(timezone.utc)
+    latest_allowed = received_at + timedelta(seconds=settings.IOT_CLOCK_SKEW)
+    readings = sorted(
+        (reading for reading in batch.readings if reading.measured_at <= latest_allowed),
+        key=lambda reading: reading.measured_at
+    )
+    rejected = len(batch.readings) - len(readings)
+    
+    if not readings:
+        return {
+            "status": "received",
+            "sensor_id": batch.sensor_id,
+            "queue_id": queue_id,
+            "accepted": 0,
+            "rejected": rejected,
+            "stored": 0,
+            "status_changed": False
+        }
+    
+    # 3. Весь пакет - в буфер записи (или целиком 429), только изменения
+    check_write_capacity(len(readings))
+    rows = await change_filter.select(batch.sensor_id, [
+        reading_row(
+            batch.sensor_id,
+            reading.is_power_on,
+            reading.voltage,
+            reading.frequency,
+            measured_at=reading.measured_at,
+            received_at=received_at
+        )
+        for reading in readings
+    ])
+    iot_write_buffer.submit(rows)
+    
+    # 4. Смена состояния - один раз, по последнему показанию
+    last = readings[-1]
+    queue_id, status_changed = await apply_reading(
+        db,
+        batch.sensor_id,
+        last.is_power_on,
+        at_ms=int(last.measured_at.timestamp() * 1000),
+        voltage=last.voltage
+    )
     
     return {
         "status": "received",
-        "sensor_id": data.sensor_id,
-        "queue_id": sensor.queue_id,
-        "power_status": "ON" if data.is_power_on else "OFF",
-        "status_changed": status_changed
+        "sensor_id": batch.sensor_id,
+        "queue_id": queue_id,
+        "accepted": len(readings),
+        "rejected": rejected,
+        "stored": len(rows),
+        "power_status": "ON" if last.is_power_on else "OFF",
+        "status_changed": bool(status_changed)
     }
 
 
@@ -235,6 +309,32 @@ async def get_sensor_details(
     }
 
 
+@router.get("/sensors/{sensor_id}/reading")
+async def get_sensor_reading_at(
+    sensor_id: str,
+    at: datetime,
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Что сообщал сенсор в момент at
+    
+    В режиме IOT_STORAGE_MODE = "changes" iot_data хранит только
+    изменения: показание восстанавливается по отрезку, в который попадает
+    at (services.iot_ingest.reading_at).
+    """
+    if at.tzinfo is None:
+        at = at.replace(tzinfo=timezone.utc)
+    
+    reading = await reading_at(db, sensor_id, at)
+    if reading is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No reading from sensor {sensor_id} at {at.isoformat()}"
+        )
+    
+    return {"sensor_id": sensor_id, "at": at, **reading}
+
+
 @router.post("/sensors", response_model=IoTSensorResponse)
 async def register_sensor(
     sensor_data: IoTSensorCreate,
@@ -252,6 +352,7 @@ async def register_sensor(
     existing = result.scalar_one_or_none()
     
     if existing:
+        await iot_registry.add_sensor(existing.sensor_id, existing.queue_id)
         return existing
     
     # Создать новый сенсор
@@ -269,6 +370,9 @@ async def register_sensor(
     await db.commit()
     await db.refresh(sensor)
     
+    # Пинги нового сенсора принимаются сразу, без перезагрузки реестра
+    await iot_registry.add_sensor(sensor.sensor_id, sensor.queue_id)
+    
     return sensor
 
 
@@ -306,6 +410,7 @@ async def check_sensors_health(
         "online": online_count,
         "offline": len(offline_sensors),
         "offline_sensors": offline_sensors,
+        "write_buffer": iot_write_buffer.stats(),
         "health": "healthy" if len(offline_sensors) == 0 else "degraded"
     }
 
@@ -314,28 +419,168 @@ async def check_sensors_health(
 # HELPER FUNCTIONS
 # ============================================
 
-async def get_other_sensor(db: AsyncSession, queue_id: int, current_sensor_id: str):
-    """Получить второй сенсор черги"""
-    result = await db.execute(
-        select(IoTSensor).where(
-            IoTSensor.queue_id == queue_id,
-            IoTSensor.sensor_id != current_sensor_id
+async def ensure_registry_loaded(db: AsyncSession) -> bool:
+    """Загрузить реестр IoT, если его нет в Redis (True - загружен сейчас)"""
+    if await iot_registry.is_loaded():
+        return False
+    await iot_registry.load(db)
+    return True
+
+
+async def apply_reading(
+    db: AsyncSession,
+    sensor_id: str,
+    is_power_on: bool,
+    at_ms: Optional[int] = None,
+    voltage: Optional[float] = None
+) -> Tuple[int, Optional[bool]]:
+    """
+    Пинг сенсора и консенсус по состоянию черги
+    
+    Голосование N из M, гистерезис, минимальное время в состоянии и окно
+    свежести - в одном атомарном скрипте Redis (services.iot_registry).
+    Подтверждённый переход получает ровно один пинг, он и пишет его в
+    Postgres и запускает рассылку.
+    
+    Args:
+        at_ms: Время показания по часам сенсора (None - сейчас). Показание
+            старше IOT_STALE_AFTER записывается, но не голосует.
+        voltage: Напряжение (PRO сенсоры)
+    
+    Returns:
+        (queue_id, status_changed), status_changed None - черга не найдена
+    """
+    
+    # 1. Пинг и голосование - в Redis
+    ping = await iot_registry.ping(sensor_id, is_power_on, at_ms, voltage)
+    if ping is None and await ensure_registry_loaded(db):
+        ping = await iot_registry.ping(sensor_id, is_power_on, at_ms, voltage)
+    
+    if ping is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Sensor {sensor_id} not found"
         )
+    
+    # 2. Черги нет в кэше - прочитать из Postgres (один раз) и проголосовать заново
+    queue_id = ping.queue_id
+    if ping.state is None:
+        if await iot_registry.load_queue_state(db, queue_id) is None:
+            return queue_id, None
+        ping = await iot_registry.ping(sensor_id, is_power_on, at_ms, voltage)
+        if ping is None or ping.state is None:
+            return queue_id, False
+    
+    new_status = ping.vote
+    if ping.state == new_status:
+        return queue_id, False
+    
+    # Трасса события начинается с первого сенсора, проголосовавшего за новое состояние
+    fresh = at_ms is None or at_ms > now_ms() - settings.IOT_STALE_AFTER * 1000
+    event_id = await outage_tracer.begin(queue_id, new_status) if fresh or ping.changed else None
+    
+    # ⏳ Кворума нет или черга ещё держит прежнее состояние - ждём следующих пингов
+    if not ping.changed:
+        return queue_id, False
+    
+    # ✅ Переход подтверждён (ping.votes из ping.voters свежих голосов при кворуме ping.quorum)
+    await outage_tracer.mark(event_id, STAGE_CONSENSUS)
+    if not await commit_queue_status(db, queue_id, new_status):
+        return queue_id, False
+    
+    await outage_tracer.mark(event_id, STAGE_STATUS_COMMIT)
+    await outage_tracer.confirm(event_id, queue_id, new_status)
+    
+    # Рассылка после debounce (флапы OFF->ON->OFF схлопываются)
+    await power_status_coalescer.submit(queue_id, new_status, event_id=event_id)
+    
+    return queue_id, True
+
+
+async def read_batch(request: Request) -> IoTDataBatch:
+    """
+    Прочитать и провалидировать пакет показаний
+    
+    Тело читается потоком с лимитом IOT_BATCH_MAX_BYTES (и до, и после
+    распаковки gzip), весь пакет валидируется одним model_validate_json.
+    """
+    too_large = HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail=f"Batch exceeds {settings.IOT_BATCH_MAX_BYTES} bytes"
     )
-    return result.scalar_one_or_none()
+    
+    body = bytearray()
+    async for chunk in request.stream():
+        body.extend(chunk)
+        if len(body) > settings.IOT_BATCH_MAX_BYTES:
+            raise too_large
+    
+    encoding = request.headers.get("content-encoding", "identity").lower()
+    if encoding == "gzip":
+        decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+        try:
+            body = decompressor.decompress(bytes(body), settings.IOT_BATCH_MAX_BYTES)
+        except zlib.error:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid gzip body")
+        if decompressor.unconsumed_tail:
+            raise too_large
+    elif encoding != "identity":
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail=f"Unsupported Content-Encoding: {encoding}"
+        )
+    
+    try:
+        return IoTDataBatch.model_validate_json(body)
+    except ValidationError as e:
+        raise RequestValidationError(e.errors(include_url=False))
 
 
-async def get_latest_sensor_data(db: AsyncSession, sensor_id: str):
-    """Получить последние данные от сенсора (за последние 60 сек)"""
-    threshold = datetime.utcnow() - timedelta(seconds=60)
+async def commit_queue_status(db: AsyncSession, queue_id: int, is_power_on: bool) -> bool:
+    """
+    Записать подтверждённый переход черги
     
-    result = await db.execute(
-        select(IoTData)
-        .where(
-            IoTData.sensor_id == sensor_id,
-            IoTData.received_at > threshold
+    UPDATE условный: если черга уже в этом состоянии (например, его
+    выставили вручную), ничего не меняется и рассылки не будет.
+    Переход не записан (0 строк или ошибка) - кэш возвращается к
+    Postgres и таймер IOT_MIN_DWELL сбрасывается, следующие пинги
+    проголосуют заново.
+    
+    Returns:
+        bool: Состояние действительно изменилось
+    """
+    try:
+        result = await db.execute(
+            update(Queue)
+            .where(Queue.queue_id == queue_id, Queue.is_power_on.is_distinct_from(is_power_on))
+            .values(
+                is_power_on=is_power_on,
+                last_change_at=datetime.utcnow(),
+                last_change_source='iot',
+                total_outages=Queue.total_outages + (0 if is_power_on else 1)
+            )
+        )
+        await db.commit()
+    except Exception:
+        # Транзакция откатилась: в Postgres прежнее состояние
+        await iot_registry.revert_transition(queue_id, not is_power_on)
+        await db.rollback()
+        raise
+    
+    if result.rowcount != 1:
+        # Postgres уже в этом состоянии или черги нет - кэш из Postgres
+        current = await db.scalar(select(Queue.is_power_on).where(Queue.queue_id == queue_id))
+        await iot_registry.revert_transition(queue_id, current)
+        return False
+    
+    return True
+
+
+def check_write_capacity(rows: int):
+    """Буфер записи iot_data переполнен (Postgres отстаёт) - 429, сенсор повторит позже"""
+    if not iot_write_buffer.has_room(rows):
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="IoT write buffer is full, retry later",
+            headers={"Retry-After": str(settings.IOT_WRITE_RETRY_AFTER)}
         )
-        .order_by(IoTData.received_at.desc())
-        .limit(1)
-    )
-    return result.scalar_one_or_none()
@@ -0,0 +1,45 @@
+from fastapi import APIRouter, HTTPException, status
+from typing import Optional
+
+from services.outage_trace import outage_tracer
+
+router = APIRouter(prefix="/api/metrics", tags=["Metrics"])
+
+
+# ============================================
+# ENDPOINTS
+# ============================================
+
+@router.get("/latency")
+async def get_latency_metrics(queue_id: Optional[int] = None):
+    """
+    Задержка оповещений об отключениях по чергам
+    
+    Перцентили p50/p95/p99 (мс) по последним событиям:
+    - sensor_flip->consensus ... first_send->last_send - интервалы между этапами
+    - detect_to_first_send - от первого сигнала сенсора до первого сообщения
+    - detect_to_deliver - от первого сигнала сенсора до последнего сообщения
+    
+    Интервал task_enqueue->task_start включает debounce коалесцера.
+    """
+    return {
+        "queues": await outage_tracer.latency_metrics(queue_id)
+    }
+
+
+@router.get("/traces/{event_id}")
+async def get_outage_trace(event_id: str):
+    """
+    Трасса одного события отключения/включения
+    
+    Этапы - время в мс от эпохи (отсутствует - этап не пройден).
+    """
+    trace = await outage_tracer.get(event_id)
+    
+    if not trace:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Trace {event_id} not found"
+        )
+    
+    return trace
@@ -7,6 +7,7 @@ from datetime import datetime
 
 from database import get_db
 from models.notification import Notification
+from services.fanout import FanoutProgress
 
 router = APIRouter(prefix="/api/notifications", tags=["Notifications"])
 
@@ -137,6 +138,32 @@ async def get_notification_history(
     ]
 
 
+@router.get("/fanouts/{fanout_id}")
+async def get_fanout_progress(fanout_id: str):
+    """
+    Прогресс массовой рассылки
+    
+    fanout_id - ID Celery task, запустившей рассылку.
+    Счётчики обновляются шардами после каждого батча.
+    
+    **Статусы:**
+    - running - Шарды в работе
+    - done - Все шарды завершены
+    - failed - Шард исчерпал повторы
+    
+    После завершения в tiers - задержка доставки и доля в SLO по тарифам.
+    """
+    progress = await FanoutProgress(fanout_id).get()
+    
+    if not progress:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Fanout {fanout_id} not found"
+        )
+    
+    return progress
+
+
 @router.get("/stats")
 async def get_notification_stats(
     db: AsyncSession = Depends(get_db)
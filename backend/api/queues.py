@@ -8,6 +8,9 @@ from datetime import datetime
 from database import get_db
 from models.queue import Queue
 from models.user import User
+from services.power_status import power_status_coalescer
+from services.outage_trace import outage_tracer, STAGE_CONSENSUS, STAGE_STATUS_COMMIT
+from services.iot_registry import iot_registry
 
 router = APIRouter(prefix="/api/queues", tags=["Queues"])
 
@@ -139,6 +142,10 @@ async def update_queue_status(
     status_changed = queue.is_power_on != status_data.is_power_on
     
     if status_changed:
+        # Ручное изменение: сигнал и подтверждение совпадают
+        event_id = await outage_tracer.begin(queue_id, status_data.is_power_on)
+        await outage_tracer.mark(event_id, STAGE_CONSENSUS)
+        
         # Обновить статус
         queue.is_power_on = status_data.is_power_on
         queue.last_change_at = datetime.utcnow()
@@ -149,15 +156,20 @@ async def update_queue_status(
             queue.total_outages += 1
         
         await db.commit()
+        await iot_registry.set_queue_state(queue_id, status_data.is_power_on)
+        await outage_tracer.mark(event_id, STAGE_STATUS_COMMIT)
+        await outage_tracer.confirm(event_id, queue_id, status_data.is_power_on)
         
-        # TODO: Trigger notification task (Celery)
-        # from tasks.notification_dispatcher import send_power_notification
-        # send_power_notification.delay(queue_id, status_data.is_power_on)
+        # Рассылка после debounce (флапы OFF->ON->OFF схлопываются)
+        notification = await power_status_coalescer.submit(
+            queue_id, status_data.is_power_on, event_id=event_id
+        )
         
         return {
             "queue_id": queue_id,
             "status_changed": True,
             "new_status": "ON" if status_data.is_power_on else "OFF",
+            "notification": notification,
             "message": f"Queue {queue_id} status updated to {'ON' if status_data.is_power_on else 'OFF'}"
         }
     else:
@@ -9,6 +9,7 @@ import base64
 
 from database import get_db
 from models.user import User
+from services.recipient_index import recipient_index
 
 router = APIRouter(prefix="/api/users", tags=["Users"])
 
@@ -30,6 +31,13 @@ class UserUpdate(BaseModel):
     subscription_expires_at: Optional[datetime] = None
     is_channel_subscribed: Optional[bool] = None
     settings: Optional[dict] = None
+    # Тихий режим (хранится в settings, бот передаёт отдельными полями)
+    quiet_mode_enabled: Optional[bool] = None
+    quiet_hours_start: Optional[str] = None  # "HH:MM"
+    quiet_hours_end: Optional[str] = None  # "HH:MM"
+
+
+QUIET_MODE_FIELDS = ("quiet_mode_enabled", "quiet_hours_start", "quiet_hours_end")
 
 
 class UserResponse(BaseModel):
@@ -44,6 +52,7 @@ class UserResponse(BaseModel):
     referral_code: str
     referral_count: int
     referral_days_earned: int
+    quiet_mode_enabled: bool = False
     
     class Config:
         from_attributes = True
@@ -92,6 +101,15 @@ async def create_user(
     
     if existing_user:
         # Пользователь уже существует
+        if existing_user.is_bot_blocked:
+            # Повторный /start - снова может получать рассылки
+            existing_user.is_bot_blocked = False
+            existing_user.bot_blocked_at = None
+            existing_user.bot_blocked_reason = None
+            await db.commit()
+            await db.refresh(existing_user)
+            await recipient_index.refresh_user(db, existing_user.user_id)
+
         return existing_user
     
     # 2. Найти реферера (если указан код)
@@ -175,6 +193,12 @@ async def update_user(
     
     # Обновить поля (только те, что переданы)
     update_data = user_data.model_dump(exclude_unset=True)
+    
+    # Поля тихого режима - ключи в settings (новый dict, чтобы JSON колонка обновилась)
+    quiet_mode = {field: update_data.pop(field) for field in QUIET_MODE_FIELDS if field in update_data}
+    if quiet_mode:
+        update_data["settings"] = {**(update_data.get("settings") or user.settings or {}), **quiet_mode}
+    
     for field, value in update_data.items():
         setattr(user, field, value)
     
@@ -184,6 +208,10 @@ async def update_user(
     await db.commit()
     await db.refresh(user)
     
+    # Адрес, тариф или настройки влияют на индекс получателей
+    if update_data.keys() & {"primary_address_id", "subscription_tier", "settings"}:
+        await recipient_index.refresh_user(db, user_id)
+    
     return user
 
 
@@ -214,11 +242,15 @@ async def check_channel_subscription(
     user.last_subscription_check = datetime.utcnow()
     
     # Если подписался - изменить тариф с NOFREE на FREE
-    if is_subscribed and user.subscription_tier == 'NOFREE':
+    tier_changed = is_subscribed and user.subscription_tier == 'NOFREE'
+    if tier_changed:
         user.subscription_tier = 'FREE'
     
     await db.commit()
     
+    if tier_changed:
+        await recipient_index.refresh_user(db, user_id)
+    
     return {
         "user_id": user_id,
         "is_subscribed": is_subscribed,
@@ -297,6 +329,9 @@ async def delete_user(
     
     await db.commit()
     
+    # Убрать из индекса получателей
+    await recipient_index.refresh_user(db, user_id)
+    
     return {
         "user_id": user_id,
         "message": "User deleted (soft delete)"
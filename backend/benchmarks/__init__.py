@@ -0,0 +1,4 @@
+"""
+Benchmarks Package
+Нагрузочные замеры пути отправки уведомлений СвітлоБот
+"""
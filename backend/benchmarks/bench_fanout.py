@@ -0,0 +1,286 @@
+"""
+Benchmark: путь рассылки на 1k / 10k / 100k / 1M синтетических получателей
+Пропускная способность (msg/sec), пик RSS и p99 времени доставки против локального mock Bot API
+
+Режимы:
+    batch   - один NotificationService.send_batch на всех получателей
+    sharded - нарезка на шарды по FANOUT_SHARD_SIZE (services.fanout.split_ranges)
+              и параллельные шарды, как send_fanout_shard на --workers воркерах
+
+Каждый размер прогоняется в отдельном процессе (чистый пик RSS),
+mock API - тоже в отдельном процессе и не влияет на замер.
+Получатели генерируются потоком, в память целиком не грузятся.
+
+Результаты дописываются в benchmarks/results/fanout.jsonl и сравниваются
+с предыдущим прогоном того же кейса (--fail-on-regression - код выхода 1).
+
+Запуск (из каталога backend):
+    python -m benchmarks.bench_fanout --sizes 1000,10000 --latency 0.01
+    python -m benchmarks.bench_fanout --mode sharded --workers 8 --blocked-ratio 0.02
+    python -m benchmarks.bench_fanout --rate-limit 30 --paid   # allow_paid_broadcast против 30 msg/sec
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import resource
+import subprocess
+import sys
+import time
+from array import array
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+from benchmarks.mock_bot_api import add_arguments, from_arguments
+from config import settings
+from services.fanout import split_ranges
+from services.notification_service import NotificationService
+from services.rate_limiter import LANE_BULK
+from services.recipients import Recipient, FLAG_POWER_OFF, FLAG_POWER_ON
+
+
+DEFAULT_SIZES = "1000,10000,100000,1000000"
+BASE_CHAT_ID = 100000
+TEMPLATE = "🔴 Світло відключено, {first_name}. Черга: {queue}, {time}"
+
+RESULTS_FILE = Path(__file__).parent / "results" / "fanout.jsonl"
+
+# Метрики, по которым ищется регрессия: (ключ, чем больше - тем лучше)
+REGRESSION_METRICS = (("rate", True), ("peak_rss_mb", False), ("p99_completion_s", False))
+
+
+class TimedService(NotificationService):
+    """NotificationService, запоминающий момент завершения каждой отправки"""
+
+    def __init__(self):
+        super().__init__()
+        self.started = time.perf_counter()
+        self.completions = array("d")  # секунд от старта рассылки
+        self.latencies = array("d")  # мс ответа mock API
+
+    async def _send_body(self, user_id: int, body: bytes, lane: str = LANE_BULK, is_cancelled=None, paid=False):
+        result = await super()._send_body(user_id, body, lane, is_cancelled, paid)
+        self.completions.append(time.perf_counter() - self.started)
+        if result.get("latency_ms") is not None:
+            self.latencies.append(result["latency_ms"])
+        return result
+
+
+def synthetic_recipients(start: int, end: int) -> Iterator[Recipient]:
+    """Получатели с chat ID в [start, end)"""
+    for user_id in range(start, end):
+        yield Recipient(
+            user_id=user_id,
+            first_name=f"User{user_id}",
+            username=None,
+            tier="FREE",
+            queue_id=1,
+            flags=FLAG_POWER_OFF | FLAG_POWER_ON
+        )
+
+
+def percentile(values: array, p: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+async def run_case(case: Dict[str, Any], base_url: str) -> Dict[str, Any]:
+    """Один прогон: size получателей в режиме batch или sharded"""
+    service = TimedService()
+    service.base_url = f"{base_url}/botBENCH"
+    service.rate_limiter = None  # без Redis: темп задают 429 от mock API
+    service.paid_rate_limiter = None
+
+    # Платная рассылка для всех получателей (power_off в TELEGRAM_PAID_BROADCAST_TYPES)
+    settings.TELEGRAM_PAID_BROADCAST = case["paid"]
+    settings.TELEGRAM_PAID_BROADCAST_TYPES = ["power_off"]
+    settings.TELEGRAM_PAID_BROADCAST_TIERS = []
+
+    size = case["size"]
+    results: List[Dict[str, Any]] = []
+
+    service.started = time.perf_counter()
+
+    if case["mode"] == "sharded":
+        ranges = split_ranges(range(BASE_CHAT_ID, BASE_CHAT_ID + size), case["shard_size"])
+        workers = asyncio.Semaphore(case["workers"])
+
+        async def shard(id_range):
+            async with workers:
+                results.append(await service.send_batch(
+                    users=synthetic_recipients(*id_range),
+                    message_template=TEMPLATE,
+                    notification_type="power_off",
+                    queue_id=1
+                ))
+
+        await asyncio.gather(*(shard(id_range) for id_range in ranges))
+    else:
+        results.append(await service.send_batch(
+            users=synthetic_recipients(BASE_CHAT_ID, BASE_CHAT_ID + size),
+            message_template=TEMPLATE,
+            notification_type="power_off",
+            queue_id=1
+        ))
+
+    elapsed = time.perf_counter() - service.started
+    await service.close()
+
+    success = sum(result["success"] for result in results)
+    error_codes: Dict[str, int] = {}
+    for result in results:
+        for error_code, count in result["error_codes"].items():
+            error_codes[error_code] = error_codes.get(error_code, 0) + count
+
+    return {
+        "elapsed_s": round(elapsed, 3),
+        "success": success,
+        "paid": sum(result["paid"] for result in results),
+        "failed": sum(result["failed"] for result in results),
+        "error_codes": error_codes,
+        "rate": round(success / elapsed, 1) if elapsed else 0.0,
+        "p99_completion_s": round(percentile(service.completions, 99) or 0.0, 3),
+        "p50_latency_ms": percentile(service.latencies, 50),
+        "p99_latency_ms": percentile(service.latencies, 99),
+        # ru_maxrss в Linux - килобайты
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def _case_process(conn, case: Dict[str, Any], base_url: str):
+    logging.basicConfig(level=logging.WARNING)
+    conn.send(asyncio.run(run_case(case, base_url)))
+    conn.close()
+
+
+def _mock_process(conn, mock_args: argparse.Namespace):
+    async def serve():
+        mock = from_arguments(mock_args)
+        conn.send(await mock.start())
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_previous(case: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Последний сохранённый прогон того же кейса"""
+    if not RESULTS_FILE.exists():
+        return None
+
+    previous = None
+    with RESULTS_FILE.open() as f:
+        for line in f:
+            record = json.loads(line)
+            if record["case"] == case:
+                previous = record
+    return previous
+
+
+def find_regressions(metrics: Dict[str, Any], previous: Dict[str, Any], threshold: float) -> List[str]:
+    regressions = []
+    for key, higher_is_better in REGRESSION_METRICS:
+        old, new = previous["metrics"].get(key), metrics.get(key)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        if (higher_is_better and change < -threshold) or (not higher_is_better and change > threshold):
+            regressions.append(f"{key} {old} -> {new} ({change:+.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="число получателей через запятую")
+    parser.add_argument("--mode", choices=("batch", "sharded"), default="batch")
+    # Шарды в одном процессе делят пул соединений: по умолчанию столько, чтобы
+    # все корутины отправки помещались в TELEGRAM_MAX_CONNECTIONS (как отдельные воркеры)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=max(1, settings.TELEGRAM_MAX_CONNECTIONS // settings.NOTIFICATION_SENDERS),
+        help="параллельных шардов (режим sharded)"
+    )
+    parser.add_argument("--shard-size", type=int, default=settings.FANOUT_SHARD_SIZE)
+    parser.add_argument("--paid", action="store_true", help="платная рассылка (allow_paid_broadcast)")
+    parser.add_argument("--threshold", type=float, default=0.1, help="допустимое ухудшение метрики")
+    parser.add_argument("--no-save", action="store_true", help="не сохранять результаты")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context("spawn")
+
+    mock_conn, child_conn = ctx.Pipe()
+    mock = ctx.Process(target=_mock_process, args=(child_conn, args), daemon=True)
+    mock.start()
+    base_url = mock_conn.recv()
+
+    regressions_found = False
+
+    try:
+        for size in (int(size) for size in args.sizes.split(",")):
+            case = {
+                "mode": args.mode,
+                "size": size,
+                "workers": args.workers if args.mode == "sharded" else 1,
+                "shard_size": args.shard_size if args.mode == "sharded" else None,
+                "latency": args.latency,
+                "jitter": args.jitter,
+                "rate_limit": args.rate_limit,
+                "paid": args.paid,
+                "per_chat_interval": args.per_chat_interval,
+                "blocked_ratio": args.blocked_ratio,
+            }
+
+            conn, child_conn = ctx.Pipe()
+            process = ctx.Process(target=_case_process, args=(child_conn, case, base_url))
+            process.start()
+            metrics = conn.recv()
+            process.join()
+
+            print(
+                f"{args.mode:<8} users={size:<8} sent={metrics['success']:<8} failed={metrics['failed']:<6} "
+                f"time={metrics['elapsed_s']:8.2f}s  rate={metrics['rate']:9.1f} msg/s  "
+                f"p99={metrics['p99_completion_s']:7.2f}s  rss={metrics['peak_rss_mb']:7.1f} MB"
+            )
+
+            previous = load_previous(case)
+            if previous:
+                regressions = find_regressions(metrics, previous, args.threshold)
+                if regressions:
+                    regressions_found = True
+                    print(f"  REGRESSION vs {previous.get('commit') or previous['timestamp']}: " + "; ".join(regressions))
+
+            if not args.no_save:
+                RESULTS_FILE.parent.mkdir(parents=True, exist_ok=True)
+                with RESULTS_FILE.open("a") as f:
+                    f.write(json.dumps({
+                        "timestamp": datetime.now(timezone.utc).isoformat(),
+                        "commit": git_commit(),
+                        "case": case,
+                        "metrics": metrics,
+                    }) + "\n")
+    finally:
+        mock.terminate()
+        mock.join()
+
+    if regressions_found and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Benchmark: NotificationService.send_batch
+Сравнение пропускной способности (msg/sec) долгоживущего HTTP клиента
+и старого подхода "новый httpx.AsyncClient на каждое сообщение"
+
+Запуск (из каталога backend):
+    python -m benchmarks.bench_send_batch --users 5000 --latency 0.005
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+import httpx
+
+from benchmarks.mock_bot_api import MockBotAPI
+from services.notification_service import NotificationService
+from services.rate_limiter import LANE_BULK
+from services.recipients import Recipient, FLAG_POWER_OFF, FLAG_POWER_ON
+
+
+class PerMessageClientService(NotificationService):
+    """Старое поведение: TCP (и TLS) хендшейк на каждое сообщение"""
+
+    async def _send_body(self, user_id: int, body: bytes, lane: str = LANE_BULK, is_cancelled=None, paid=False):
+        try:
+            async with httpx.AsyncClient(timeout=10.0) as client:
+                response = await client.post(
+                    f"{self.base_url}/sendMessage",
+                    content=body,
+                    headers={"Content-Type": "application/json"}
+                )
+                response.raise_for_status()
+                return {"success": True, "message_id": response.json()["result"]["message_id"]}
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+
+def make_users(count: int):
+    """Синтетические получатели"""
+    return [
+        Recipient(
+            user_id=100000 + i,
+            first_name=f"User{i}",
+            username=None,
+            tier="FREE",
+            queue_id=1,
+            flags=FLAG_POWER_OFF | FLAG_POWER_ON
+        )
+        for i in range(count)
+    ]
+
+
+async def run_case(name: str, service: NotificationService, users, base_url: str) -> float:
+    service.base_url = f"{base_url}/botTEST"
+    service.rate_limiter = None  # замеряем HTTP путь, а не rate limit
+
+    started = time.perf_counter()
+    result = await service.send_batch(
+        users=users,
+        message_template="🔴 Світло відключено, {first_name}. Черга: {queue}, {time}",
+        notification_type="power_off"
+    )
+    elapsed = time.perf_counter() - started
+    await service.close()
+
+    rate = result["success"] / elapsed if elapsed else 0.0
+    print(
+        f"{name:<22} sent={result['success']:<7} failed={result['failed']:<5} "
+        f"time={elapsed:7.2f}s  rate={rate:9.1f} msg/s"
+    )
+    return rate
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка mock API, сек")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    mock = MockBotAPI(latency=args.latency)
+    base_url = await mock.start()
+    users = make_users(args.users)
+
+    try:
+        legacy = await run_case("per-message client", PerMessageClientService(), users, base_url)
+        pooled = await run_case("pooled client", NotificationService(), users, base_url)
+    finally:
+        await mock.stop()
+
+    if legacy:
+        print(f"speedup: x{pooled / legacy:.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
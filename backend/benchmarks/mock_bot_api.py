@@ -0,0 +1,198 @@
+"""
+Mock Telegram Bot API
+Локальный сервер, эмулирующий sendMessage, для бенчмарков без сети
+
+Можно запустить отдельно и направить на него воркеры Celery
+(TELEGRAM_API_URL=http://127.0.0.1:8081):
+    python -m benchmarks.mock_bot_api --port 8081 --latency 0.05 --rate-limit 30 --blocked-ratio 0.01
+"""
+
+import argparse
+import asyncio
+import itertools
+import math
+import random
+import time
+from collections import deque
+from typing import Dict, Iterable, Optional
+
+from aiohttp import web
+
+
+class MockBotAPI:
+    """
+    Bot API с поведением настоящего Telegram под нагрузкой
+
+    - общий лимит сообщений в секунду (429 с retry_after), для allow_paid_broadcast - свой
+    - лимит на чат: не чаще одного сообщения в per_chat_interval (429)
+    - заблокировавшие бота пользователи (403 Forbidden: bot was blocked by the user)
+    - задержка ответа latency +- jitter
+
+    Args:
+        latency: Задержка ответа (секунд)
+        jitter: Случайное отклонение задержки (секунд, равномерно в [-jitter, jitter])
+        rate_limit: Сообщений в секунду на бота (None - без лимита)
+        paid_rate_limit: Сообщений в секунду с allow_paid_broadcast (None - без лимита)
+        per_chat_interval: Минимальный интервал между сообщениями в один чат (None - без лимита)
+        retry_after: retry_after для общего лимита (секунд)
+        blocked_ratio: Доля чатов, заблокировавших бота (по chat ID, детерминированно)
+        blocked_ids: Конкретные чаты, заблокировавшие бота
+    """
+
+    def __init__(
+            self,
+            latency: float = 0.0,
+            jitter: float = 0.0,
+            rate_limit: Optional[int] = None,
+            paid_rate_limit: Optional[int] = 1000,
+            per_chat_interval: Optional[float] = None,
+            retry_after: int = 1,
+            blocked_ratio: float = 0.0,
+            blocked_ids: Optional[Iterable[int]] = None
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.paid_rate_limit = paid_rate_limit
+        self.per_chat_interval = per_chat_interval
+        self.retry_after = retry_after
+        self.blocked_ratio = blocked_ratio
+        self.blocked_ids = set(blocked_ids or ())
+
+        self.requests = 0
+        self.stats: Dict[str, int] = {"ok": 0, "paid": 0, "rate_limited": 0, "chat_limited": 0, "blocked": 0}
+        self._message_ids = itertools.count(1)
+        # Моменты принятых сообщений за последнюю секунду (обычные и платные)
+        self._windows: Dict[bool, deque] = {False: deque(), True: deque()}
+        self._last_sent: Dict[int, float] = {}
+        self._runner: Optional[web.AppRunner] = None
+        self.url: Optional[str] = None
+
+    def _is_blocked(self, chat_id: int) -> bool:
+        if chat_id in self.blocked_ids:
+            return True
+        # Детерминированно по chat ID: одни и те же чаты "заблокированы" во всех прогонах
+        return self.blocked_ratio > 0 and (chat_id * 2654435761 % 10000) < self.blocked_ratio * 10000
+
+    @staticmethod
+    def _error(error_code: int, description: str, retry_after: Optional[int] = None) -> web.Response:
+        payload = {"ok": False, "error_code": error_code, "description": description}
+        if retry_after is not None:
+            payload["parameters"] = {"retry_after": retry_after}
+        return web.json_response(payload, status=error_code)
+
+    async def _send_message(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        chat_id = int(payload.get("chat_id", 0))
+        paid = bool(payload.get("allow_paid_broadcast"))
+        self.requests += 1
+
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+        now = time.monotonic()
+
+        rate_limit = self.paid_rate_limit if paid else self.rate_limit
+        window = self._windows[paid]
+
+        if rate_limit:
+            while window and now - window[0] >= 1.0:
+                window.popleft()
+            if len(window) >= rate_limit:
+                self.stats["rate_limited"] += 1
+                return self._error(
+                    429, f"Too Many Requests: retry after {self.retry_after}", self.retry_after
+                )
+
+        if self.per_chat_interval:
+            last = self._last_sent.get(chat_id)
+            if last is not None and now - last < self.per_chat_interval:
+                self.stats["chat_limited"] += 1
+                retry_after = max(1, math.ceil(self.per_chat_interval - (now - last)))
+                return self._error(429, f"Too Many Requests: retry after {retry_after}", retry_after)
+
+        if self._is_blocked(chat_id):
+            self.stats["blocked"] += 1
+            return self._error(403, "Forbidden: bot was blocked by the user")
+
+        if rate_limit:
+            window.append(now)
+        if self.per_chat_interval:
+            self._last_sent[chat_id] = now
+
+        self.stats["ok"] += 1
+        if paid:
+            self.stats["paid"] += 1
+        return web.json_response({
+            "ok": True,
+            "result": {
+                "message_id": next(self._message_ids),
+                "chat": {"id": chat_id},
+            }
+        })
+
+    async def _get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({"requests": self.requests, **self.stats})
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Запустить сервер, вернуть базовый URL (аналог https://api.telegram.org)"""
+        app = web.Application()
+        app.router.add_post("/bot{token}/sendMessage", self._send_message)
+        app.router.add_get("/stats", self._get_stats)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+
+        sockets = site._server.sockets
+        bound_port = sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{bound_port}"
+        return self.url
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """Параметры mock API (общие для бенчмарков и отдельного запуска)"""
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка mock API, сек")
+    parser.add_argument("--jitter", type=float, default=0.0, help="отклонение задержки, сек")
+    parser.add_argument("--rate-limit", type=int, default=None, help="сообщений/сек до 429")
+    parser.add_argument("--paid-rate-limit", type=int, default=1000, help="сообщений/сек до 429 в платном режиме")
+    parser.add_argument("--per-chat-interval", type=float, default=None, help="сек между сообщениями в чат")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответе 429")
+    parser.add_argument("--blocked-ratio", type=float, default=0.0, help="доля чатов с 403")
+
+
+def from_arguments(args: argparse.Namespace) -> MockBotAPI:
+    return MockBotAPI(
+        latency=args.latency,
+        jitter=args.jitter,
+        rate_limit=args.rate_limit,
+        paid_rate_limit=args.paid_rate_limit,
+        per_chat_interval=args.per_chat_interval,
+        retry_after=args.retry_after,
+        blocked_ratio=args.blocked_ratio
+    )
+
+
+async def serve(mock: MockBotAPI, host: str, port: int):
+    url = await mock.start(host, port)
+    print(f"Mock Bot API listening on {url}", flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await mock.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    asyncio.run(serve(from_arguments(args), args.host, args.port))
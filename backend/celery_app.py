@@ -4,7 +4,9 @@ Celery Application Configuration
 """
 from celery import Celery
 from celery.schedules import crontab
+from kombu import Queue
 from config import settings
+from services.rate_limiter import LANES, lane_for
 
 # Создаём экземпляр Celery
 celery_app = Celery(
@@ -13,9 +15,25 @@ celery_app = Celery(
     backend=settings.CELERY_RESULT_BACKEND,
     include=[
         "tasks.notification_tasks",
+        "tasks.iot_tasks",
     ]
 )
 
+
+def route_by_notification_type(name, args, kwargs, options, task=None, **kw):
+    """
+    send_queue_notification уходит в полосу своего типа уведомления
+    (power_on/off - critical, warning - warnings, остальное - bulk)
+    """
+    if name != "tasks.notification_tasks.send_queue_notification":
+        return None
+
+    notification_type = kwargs.get("notification_type")
+    if notification_type is None and len(args) > 1:
+        notification_type = args[1]
+    return {"queue": lane_for(notification_type)}
+
+
 # Конфигурация Celery
 celery_app.conf.update(
     # Временная зона
@@ -34,8 +52,35 @@ celery_app.conf.update(
         "visibility_timeout": 3600,
     },
     
+    # Полосы приоритета: у каждой свои воркеры (celery worker -Q <lane>)
+    # и своя доля rate limit Telegram (TELEGRAM_LANE_SHARES)
+    task_queues=[Queue(lane) for lane in LANES],
+    task_default_queue="bulk",
+    task_routes=[
+        route_by_notification_type,
+        {
+            "tasks.notification_tasks.notify_queue_status": {"queue": "critical"},
+            "tasks.notification_tasks.send_power_off_notification": {"queue": "critical"},
+            "tasks.notification_tasks.send_power_on_notification": {"queue": "critical"},
+            "tasks.notification_tasks.send_warning_notifications": {"queue": "warnings"},
+            "tasks.notification_tasks.schedule_warnings": {"queue": "warnings"},
+            "tasks.notification_tasks.send_custom_notification": {"queue": "bulk"},
+            "tasks.notification_tasks.release_quiet_notifications": {"queue": "bulk"},
+            # Фоновые досылки не занимают слоты воркеров critical у живых рассылок;
+            # сами сообщения идут в полосе rate limit, записанной при откладывании
+            "tasks.notification_tasks.flush_merged_notifications": {"queue": "maintenance"},
+            "tasks.notification_tasks.retry_dead_letters": {"queue": "maintenance"},
+            "tasks.notification_tasks.cleanup_old_notifications": {"queue": "maintenance"},
+            "tasks.notification_tasks.check_recipient_index": {"queue": "maintenance"},
+            "tasks.notification_tasks.test_notification": {"queue": "maintenance"},
+            "tasks.iot_tasks.sync_iot_pings": {"queue": "maintenance"},
+        },
+    ],
+
     # Производительность
-    worker_prefetch_multiplier=4,
+    # Шарды рассылки длинные: воркер не резервирует задачи впрок,
+    # иначе срочная задача ждала бы за чужими prefetched шардами
+    worker_prefetch_multiplier=1,
     worker_max_tasks_per_child=1000,
     
     # Повторы при ошибках
@@ -52,13 +97,42 @@ celery_app.conf.update(
 )
 
 # Периодические задачи (Celery Beat)
-# Пока оставляем только очистку старых уведомлений
 celery_app.conf.beat_schedule = {
     # Очистка старых уведомлений раз в день
     "cleanup-old-notifications": {
         "task": "tasks.notification_tasks.cleanup_old_notifications",
         "schedule": crontab(hour=3, minute=0),  # в 3:00 ночи
     },
+    # Предупреждения по графикам: изменённые графики + точные eta на ближайшую минуту
+    "schedule-warnings": {
+        "task": "tasks.notification_tasks.schedule_warnings",
+        "schedule": float(settings.WARNING_SCHEDULER_INTERVAL),
+    },
+    # Страховка: склеенные сообщения, чья задача отправки потерялась
+    "flush-merged-notifications": {
+        "task": "tasks.notification_tasks.flush_merged_notifications",
+        "schedule": 60.0,
+    },
+    # Повторы по отдельным получателям с временными ошибками
+    "retry-dead-letters": {
+        "task": "tasks.notification_tasks.retry_dead_letters",
+        "schedule": 30.0,
+    },
+    # Выдача сообщений, отложенных тихим режимом (волнами)
+    "release-quiet-notifications": {
+        "task": "tasks.notification_tasks.release_quiet_notifications",
+        "schedule": 60.0,
+    },
+    # Сверка индекса получателей с Postgres
+    "check-recipient-index": {
+        "task": "tasks.notification_tasks.check_recipient_index",
+        "schedule": crontab(hour=4, minute=0),
+    },
+    # Время последних пингов IoT-сенсоров из Redis в Postgres (один UPDATE)
+    "sync-iot-pings": {
+        "task": "tasks.iot_tasks.sync_iot_pings",
+        "schedule": float(settings.IOT_PING_SYNC_INTERVAL),
+    },
 }
 
 if __name__ == "__main__":
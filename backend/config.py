@@ -4,7 +4,7 @@ Configuration Settings
 """
 
 from pydantic_settings import BaseSettings
-from typing import Optional
+from typing import Dict, List, Optional
 
 
 class Settings(BaseSettings):
@@ -41,12 +41,96 @@ class Settings(BaseSettings):
 
     # Rate Limiting
     RATE_LIMIT_PER_MINUTE: int = 60
-    TELEGRAM_RATE_LIMIT: int = 30  # messages per second
+    TELEGRAM_RATE_LIMIT: int = 30  # messages per second (глобально на весь кластер)
+    TELEGRAM_RATE_BURST: int = 5  # ёмкость token bucket
+    TELEGRAM_PER_CHAT_INTERVAL: float = 1.0  # секунд между сообщениями в один чат
+    # Доля rate limit, которая остаётся полосе, пока активна более приоритетная
+    TELEGRAM_LANE_SHARES: Dict[str, float] = {
+        "critical": 1.0,
+        "warnings": 0.3,
+        "bulk": 0.1,
+        "maintenance": 0.1,
+    }
+    TELEGRAM_LANE_ACTIVE_TTL: float = 2.0  # секунд полоса считается активной после последней отправки
+    # Платная рассылка (allow_paid_broadcast): до 1000 msg/sec за Telegram Stars, отдельный бюджет
+    TELEGRAM_PAID_BROADCAST: bool = False  # включить платный режим
+    TELEGRAM_PAID_BROADCAST_TYPES: List[str] = ["power_off", "power_on"]  # типы уведомлений в платном режиме
+    TELEGRAM_PAID_BROADCAST_TIERS: List[str] = []  # тарифы в платном режиме (пусто - все)
+    TELEGRAM_PAID_RATE_LIMIT: int = 1000  # messages per second в платном режиме
+    TELEGRAM_PAID_RATE_BURST: int = 100  # ёмкость token bucket платного режима
+    TELEGRAM_PAID_STARS_PER_MESSAGE: float = 0.1  # стоимость сообщения сверх бесплатного лимита
+
+    # Telegram HTTP client (один долгоживущий клиент на процесс воркера)
+    TELEGRAM_API_URL: str = "https://api.telegram.org"
+    TELEGRAM_HTTP2: bool = True
+    TELEGRAM_MAX_CONNECTIONS: int = 100
+    TELEGRAM_MAX_KEEPALIVE_CONNECTIONS: int = 20
+    TELEGRAM_KEEPALIVE_EXPIRY: float = 30.0  # секунд
+    TELEGRAM_CONNECT_TIMEOUT: float = 5.0  # секунд
+    TELEGRAM_READ_TIMEOUT: float = 10.0  # секунд
 
     # Notification Settings
     NOTIFICATION_BATCH_SIZE: int = 1000  # пользователей в одном батче
+    NOTIFICATION_SENDERS: int = 50  # корутин отправки в одной рассылке (одновременных запросов к Bot API)
+    NOTIFICATION_PIPELINE_DEPTH: int = 200  # получателей в очереди к корутинам отправки
+    NOTIFICATION_STREAM_CHUNK: int = 2000  # строк за один fetch из server-side cursor
+    DELIVERY_JOURNAL_CHUNK: int = 5000  # результатов доставки в одном COPY
+    POWER_STATUS_DEBOUNCE: int = 30  # секунд ожидания перед рассылкой power_on/off (схлопывание флапов)
+    FANOUT_SHARD_SIZE: int = 1000  # получателей в одном шарде рассылки (укладывается в task_soft_time_limit)
+    # Порядок доставки по тарифам: шарды групп ставятся в очередь одна за другой (services.fanout)
+    FANOUT_TIER_ORDER: List[List[str]] = [["PRO"], ["STANDARD", "TRIAL"], ["FREE", "NOFREE"]]
+    # SLO доставки по тарифам: секунд от запуска рассылки до отправки сообщения
+    FANOUT_TIER_SLO: Dict[str, int] = {"PRO": 60, "STANDARD": 300, "TRIAL": 300, "FREE": 1800, "NOFREE": 1800}
     NOTIFICATION_RETRY_ATTEMPTS: int = 3
     NOTIFICATION_RETRY_DELAY: int = 60  # секунд
+    # Повторы по отдельным получателям (services.delivery_checkpoint)
+    DEAD_LETTER_BACKOFF: int = 30  # секунд до первой повторной попытки, дальше пауза удваивается
+    DEAD_LETTER_MAX_BACKOFF: int = 900  # секунд: потолок паузы между попытками
+    DEAD_LETTER_MAX_ATTEMPTS: int = 5  # попыток после первой неудачной отправки
+    DEAD_LETTER_BATCH_SIZE: int = 500  # сообщений за одну выборку из dead-letter
+    DEAD_LETTER_TIME_BUDGET: int = 25  # секунд работы retry_dead_letters (запускается раз в 30 секунд)
+    DEAD_LETTER_LEASE: int = 120  # секунд аренды выбранных сообщений: без исхода за это время они повторятся
+    # Тихий режим: окно по умолчанию (пользователь может задать своё в settings)
+    QUIET_HOURS_TIMEZONE: str = "Europe/Kiev"
+    QUIET_HOURS_START: str = "23:00"
+    QUIET_HOURS_END: str = "07:00"
+    QUIET_RELEASE_SPREAD: int = 900  # секунд, на которые размазывается выдача отложенных после окна
+    QUIET_RELEASE_WAVE_SIZE: int = 500  # отложенных сообщений за одну волну
+    QUIET_RELEASE_TIME_BUDGET: int = 50  # секунд работы release задачи (запускается раз в минуту)
+    QUIET_RELEASE_LEASE: int = 300  # секунд аренды волны: без исхода за это время она выдаётся снова
+    # Предупреждения о плановых отключениях (services.warning_scheduler)
+    WARNING_DEFAULT_TIMES: List[int] = [60, 30, 15, 5]  # минут до отключения, если в settings нет warning_times
+    WARNING_SCHEDULER_INTERVAL: int = 30  # секунд между синхронизациями графиков
+    WARNING_SCHEDULER_LOOKAHEAD: int = 60  # секунд вперёд, на которые задачи ставятся с точным ETA
+    WARNING_MAX_LATENESS: int = 120  # секунд: более позднее предупреждение уже не отправляется
+    # Склейка одновременных переходов нескольких черг в одно сообщение на чат (services.chat_merge)
+    # секунд ожидания переходов других черг (только для пользователей с несколькими адресами,
+    # у которых другая черга ждёт debounce или рассылается - иначе отправка сразу);
+    # None - POWER_STATUS_DEBOUNCE: рассылки черг стартуют после своего debounce, поэтому
+    # разнесены так же, как их переходы, и окно короче debounce теряет часть склеек
+    CHAT_MERGE_WINDOW: Optional[float] = None
+    CHAT_MERGE_LEASE: int = 120  # секунд аренды забранных чатов: без исхода за это время они отправятся снова
+    # IoT: горячее состояние в Redis (services.iot_registry)
+    IOT_PING_SYNC_INTERVAL: int = 60  # секунд между переносами пингов в iot_sensors.last_ping_at
+    # Консенсус сенсоров черги (services.iot_registry.CONSENSUS_SCRIPT)
+    IOT_CONSENSUS_QUORUM: Dict[int, int] = {}  # queue_id -> голосов для перехода (по умолчанию большинство свежих голосов)
+    IOT_STALE_AFTER: int = 60  # секунд: более старый голос сенсора не учитывается
+    IOT_MIN_DWELL: int = 30  # секунд в состоянии после перехода, раньше новый переход не подтверждается
+    IOT_VOLTAGE_ON: float = 190.0  # вольт: не ниже - свет есть (PRO сенсоры)
+    IOT_VOLTAGE_OFF: float = 160.0  # вольт: не выше - света нет; между порогами голос не меняется
+    IOT_BATCH_MAX_READINGS: int = 1000  # показаний в одном пакете /api/iot/data/batch
+    IOT_BATCH_MAX_BYTES: int = 1024 * 1024  # размер пакета после распаковки gzip
+    IOT_CLOCK_SKEW: int = 300  # секунд: показания "из будущего" по часам сенсора дальше этого отбрасываются
+    # Что пишется в iot_data: "changes" - смены состояния и выход voltage/frequency за deadband, "all" - каждое показание
+    IOT_STORAGE_MODE: str = "changes"
+    IOT_VOLTAGE_DEADBAND: float = 2.0  # вольт
+    IOT_FREQUENCY_DEADBAND: float = 0.1  # герц
+    IOT_HEARTBEAT_GAP: int = 90  # секунд без пингов, после которых сенсор считается молчавшим
+    # Write-behind буфер iot_data в процессе API (services.iot_ingest)
+    IOT_WRITE_FLUSH_ROWS: int = 500  # строк, после которых буфер сбрасывается сразу
+    IOT_WRITE_FLUSH_INTERVAL: float = 1.0  # секунд между сбросами
+    IOT_WRITE_BUFFER_MAX_ROWS: int = 20000  # строк в буфере, дальше сенсорам 429
+    IOT_WRITE_RETRY_AFTER: int = 5  # секунд: Retry-After для сенсоров и предельная пауза между повторами сброса
     # Debug mode
     DEBUG: bool = False
 
@@ -5,8 +5,10 @@ import logging
 import uvicorn
 
 from config import settings
-from database import init_db, close_db
+from database import init_db, close_db, get_session
 from redis_client import redis_client
+from services.iot_registry import iot_registry
+from services.iot_ingest import iot_write_buffer
 
 # Налаштування логування
 logging.basicConfig(
@@ -23,12 +25,18 @@ async def lifespan(app: FastAPI):
     logger.info("🚀 Starting СвітлоБот API...")
     await init_db()
     await redis_client.connect()
+    # Реестр IoT-сенсоров и состояния черг в Redis (пинги без запросов к Postgres)
+    async with get_session() as session:
+        await iot_registry.load(session)
+    await iot_write_buffer.start()
     logger.info("✅ Application started successfully")
 
     yield
 
     # Shutdown
     logger.info("🛑 Shutting down...")
+    # Показания из буфера - до закрытия пула БД
+    await iot_write_buffer.stop()
     await redis_client.close()
     await close_db()
     logger.info("✅ Application stopped")
@@ -71,7 +79,7 @@ async def health():
 
 
 # Підключити роутери
-from api import users, queues, addresses, notifications, iot, crowdreports
+from api import users, queues, addresses, notifications, iot, crowdreports, metrics
 
 app.include_router(users.router)
 app.include_router(queues.router)
@@ -79,6 +87,7 @@ app.include_router(addresses.router)
 app.include_router(notifications.router)
 app.include_router(iot.router)
 app.include_router(crowdreports.router)
+app.include_router(metrics.router)
 
 
 if __name__ == "__main__":
@@ -23,7 +23,11 @@ class Address(Base):
 
 
 class UserAddress(Base):
-    """Зв'язок користувачів та адрес (для PRO з 3 адресами)"""
+    """
+    Зв'язок користувачів та адрес (для PRO з 3 адресами)
+
+    Після зміни рядків викликати recipient_index.refresh_user(user_id)
+    """
     __tablename__ = "user_addresses"
 
     user_id = Column(BigInteger, primary_key=True)
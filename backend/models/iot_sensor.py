@@ -1,5 +1,5 @@
-from sqlalchemy import Column, Integer, String, Boolean, Numeric, DateTime
-from sqlalchemy.sql import func
+from sqlalchemy import Column, Integer, String, Boolean, Numeric, DateTime, Index
+from sqlalchemy.sql import func, false
 from database import Base
 
 
@@ -36,7 +36,17 @@ class IoTData(Base):
     voltage = Column(Numeric(5, 2))  # PRO
     frequency = Column(Numeric(5, 2))  # PRO
 
+    # За годинником сенсора (пакет з буфера), для живих показань - момент отримання
+    measured_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
     received_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+    # Режим "changes": останній пінг попереднього відрізка (services.iot_ingest.ChangeFilter)
+    prev_seen_at = Column(DateTime(timezone=True))
+    # Дослане показання, старше за останній пінг: до відрізків не входить
+    replayed = Column(Boolean, nullable=False, server_default=false())
+
+    __table_args__ = (
+        Index("ix_iot_data_sensor_id_measured_at", "sensor_id", "measured_at"),
+    )
 
     def __repr__(self):
         return f"<IoTData {self.sensor_id} {'ON' if self.is_power_on else 'OFF'}>"
\ No newline at end of file
@@ -18,6 +18,7 @@ class Notification(Base):
 
     is_delivered = Column(Boolean, default=True)
     error_message = Column(Text, nullable=True)
+    latency_ms = Column(Integer, nullable=True)  # час відповіді Bot API
 
     def __repr__(self):
         return f"<Notification {self.id} ({self.notification_type})>"
@@ -36,6 +37,14 @@ class Schedule(Base):
 
     is_confirmed = Column(Boolean, default=False)  # Підтверджено фактом?
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    # Змінені графіки планувальник попереджень підхоплює інкрементально
+    updated_at = Column(
+        DateTime(timezone=True),
+        nullable=False,
+        server_default=func.now(),
+        onupdate=func.now(),
+        index=True
+    )
 
     def __repr__(self):
         return f"<Schedule Q{self.queue_id} {self.scheduled_date}>"
\ No newline at end of file
@@ -1,5 +1,5 @@
-from sqlalchemy import Column, BigInteger, String, Boolean, DateTime, Integer, JSON
-from sqlalchemy.sql import func
+from sqlalchemy import Column, BigInteger, String, Boolean, DateTime, Integer, JSON, Index, text
+from sqlalchemy.sql import func, false
 from database import Base
 
 
@@ -46,5 +46,27 @@ class User(Base):
     last_active_at = Column(DateTime(timezone=True), server_default=func.now())
     is_blocked = Column(Boolean, default=False)
 
+    # Недосяжні для бота (403 blocked/deactivated, 400 chat not found) -
+    # виключаються з розсилок, скидаються при повторному /start
+    is_bot_blocked = Column(Boolean, nullable=False, default=False, server_default=false())
+    bot_blocked_at = Column(DateTime(timezone=True), nullable=True)
+    bot_blocked_reason = Column(String(50), nullable=True)  # 'blocked', 'deactivated', 'chat_not_found'
+
+    __table_args__ = (
+        # Частковий індекс для вибірки отримувачів розсилки
+        Index(
+            "ix_users_reachable",
+            "primary_address_id",
+            "user_id",
+            postgresql_where=text("is_bot_blocked = false AND is_blocked IS NOT true")
+        ),
+    )
+
+    @property
+    def quiet_mode_enabled(self) -> bool:
+        """Тихий режим: сповіщення під час вікна відкладаються до його кінця"""
+        user_settings = self.settings or {}
+        return bool(user_settings.get("quiet_mode_enabled") or user_settings.get("night_mode"))
+
     def __repr__(self):
         return f"<User {self.user_id} ({self.subscription_tier})>"
\ No newline at end of file
@@ -0,0 +1,36 @@
+"""
+Перестройка / сверка индекса получателей в Redis
+
+Запуск (из каталога backend):
+    python rebuild_recipient_index.py            # полная перестройка
+    python rebuild_recipient_index.py --check    # только сверка с Postgres
+    python rebuild_recipient_index.py --repair   # сверка + исправление расхождений
+"""
+
+import argparse
+import asyncio
+
+from database import AsyncSessionLocal
+from redis_client import redis_client
+from services.recipient_index import recipient_index
+
+
+async def main(check: bool, repair: bool):
+    async with AsyncSessionLocal() as db:
+        if check or repair:
+            report = await recipient_index.check(db, repair=repair)
+            print(f"🔎 Сверка індексу: {report}")
+        else:
+            stats = await recipient_index.rebuild(db)
+            print(f"✅ Індекс отримувачів перебудовано: {stats['users']} користувачів, {stats['keys']} ключів")
+
+    await redis_client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Індекс отримувачів сповіщень")
+    parser.add_argument("--check", action="store_true", help="Сверить индекс с Postgres")
+    parser.add_argument("--repair", action="store_true", help="Сверить и исправить расхождения")
+    args = parser.parse_args()
+
+    asyncio.run(main(args.check, args.repair))
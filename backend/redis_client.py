@@ -17,9 +17,16 @@ class RedisClient:
         )
         logger.info("✅ Redis connected")
 
+    async def get_connection(self):
+        """Подключение к Redis (лениво подключается, например в Celery воркере)"""
+        if self.redis is None:
+            await self.connect()
+        return self.redis
+
     async def close(self):
         if self.redis:
             await self.redis.close()
+            self.redis = None
             logger.info("✅ Redis connection closed")
 
     async def get(self, key: str):
@@ -0,0 +1,298 @@
+"""
+Chat Merge
+Склейка одновременных переходов нескольких черг в одно сообщение на чат (PRO с несколькими адресами)
+"""
+
+import json
+import logging
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from redis_client import redis_client
+from config import settings
+from services.recipients import Recipient
+from services.recipient_index import recipient_index
+from services.power_status import power_status_coalescer
+
+logger = logging.getLogger(__name__)
+
+
+DUE_KEY = "merge:due"  # ZSET chat ID -> момент отправки склеенного сообщения (unix)
+CHAT_TTL = 3600  # секунд: буфер чата, который никто не забрал, не живёт вечно
+
+# Строка склеенного сообщения для каждого типа, который можно склеивать
+MERGED_LINES = {
+    "power_off": "🔴 Черга {queue}: світло відключено ({time})",
+    "power_on": "🟢 Черга {queue}: світло з'явилось ({time})",
+}
+MERGED_HEADER = "⚡️ <b>Зміни світла за вашими адресами</b>"
+
+# Отложить сообщения в буфер чата (одна запись на чергу, последнее состояние побеждает)
+# KEYS[1] - ZSET моментов отправки, KEYS[1 + j] - HASH буфера чата j-й тройки
+# ARGV[1] - момент отправки (unix), ARGV[2] - версия (мс), ARGV[3] - TTL буфера
+# ARGV[4..] - тройки: chat ID, черга, JSON записи
+HOLD_SCRIPT = """
+for i = 4, #ARGV, 3 do
+    local chat = KEYS[1 + (i - 1) / 3]
+    local current = tonumber(redis.call('HGET', chat, 'v:' .. ARGV[i + 1]))
+    if current == nil or tonumber(ARGV[2]) >= current then
+        redis.call('HSET', chat, 'q:' .. ARGV[i + 1], ARGV[i + 2], 'v:' .. ARGV[i + 1], ARGV[2])
+        redis.call('EXPIRE', chat, ARGV[3])
+    end
+    redis.call('ZADD', KEYS[1], 'NX', ARGV[1], ARGV[i])
+end
+return 1
+"""
+
+# Взять в аренду выбранные чаты, у которых окно склейки закончилось: момент отправки
+# сдвигается на срок аренды, записи удаляются только после известного исхода (ACK_SCRIPT)
+# KEYS[1] - ZSET моментов отправки, KEYS[1 + j] - HASH буфера чата ARGV[2 + j]
+# ARGV[1] - текущее время (unix), ARGV[2] - конец аренды (unix), ARGV[3..] - chat ID из ZRANGEBYSCORE
+# Возвращает {chat ID, {поле, значение, ...} буфера, ...}
+LEASE_SCRIPT = """
+local result = {}
+for i = 3, #ARGV do
+    local chat_id = ARGV[i]
+    local score = redis.call('ZSCORE', KEYS[1], chat_id)
+    if score and tonumber(score) <= tonumber(ARGV[1]) then
+        redis.call('ZADD', KEYS[1], 'XX', ARGV[2], chat_id)
+        table.insert(result, chat_id)
+        table.insert(result, redis.call('HGETALL', KEYS[i - 1]))
+    end
+end
+return result
+"""
+
+# Удалить отправленные записи, если за время аренды их не заменили более новые
+# KEYS[1] - ZSET моментов отправки, KEYS[1 + j] - HASH буфера j-го чата
+# ARGV[1] - момент отправки чатов с оставшимися записями (unix),
+# ARGV[2..] - по чатам: chat ID, число пар n, n пар (черга, версия из аренды)
+ACK_SCRIPT = """
+local i = 2
+local j = 1
+while i <= #ARGV do
+    local chat_id = ARGV[i]
+    local chat = KEYS[1 + j]
+    local n = tonumber(ARGV[i + 1])
+    for k = 0, n - 1 do
+        local queue = ARGV[i + 2 + 2 * k]
+        if redis.call('HGET', chat, 'v:' .. queue) == ARGV[i + 3 + 2 * k] then
+            redis.call('HDEL', chat, 'q:' .. queue, 'v:' .. queue)
+        end
+    end
+    if redis.call('HLEN', chat) == 0 then
+        redis.call('ZREM', KEYS[1], chat_id)
+    else
+        -- За время аренды пришли новые переходы: их окно отсчитывается заново
+        redis.call('ZADD', KEYS[1], ARGV[1], chat_id)
+    end
+    i = i + 2 + 2 * n
+    j = j + 1
+end
+return j - 1
+"""
+
+
+def chat_key(chat_id: int) -> str:
+    return f"merge:chat:{chat_id}"
+
+
+def merge_window() -> float:
+    """Окно склейки: CHAT_MERGE_WINDOW или, по умолчанию, POWER_STATUS_DEBOUNCE"""
+    if settings.CHAT_MERGE_WINDOW is not None:
+        return settings.CHAT_MERGE_WINDOW
+    return float(settings.POWER_STATUS_DEBOUNCE)
+
+
+def combine(entries: List[Dict[str, Any]]) -> bytes:
+    """
+    Тело sendMessage для чата
+
+    Одна запись - исходное сообщение без изменений,
+    несколько - одно сообщение со строкой на каждую чергу.
+    """
+    if len(entries) == 1:
+        return entries[0]["body"].encode()
+
+    bodies = [json.loads(entry["body"]) for entry in entries]
+    lines = [
+        MERGED_LINES[entry["type"]].format(queue=entry["queue_id"], time=entry["time"])
+        for entry in sorted(entries, key=lambda entry: entry["queue_id"])
+    ]
+
+    return json.dumps({
+        "chat_id": bodies[0]["chat_id"],
+        "text": MERGED_HEADER + "\n\n" + "\n".join(lines),
+        "parse_mode": bodies[0].get("parse_mode", "HTML"),
+        # Со звуком, если хотя бы одно из исходных сообщений было со звуком
+        "disable_notification": all(body.get("disable_notification") for body in bodies),
+    }, ensure_ascii=False).encode()
+
+
+class ChatMergeBuffer:
+    """
+    Буфер склейки сообщений по чатам
+
+    Пользователь с несколькими адресами (FLAG_MULTI_ADDRESS) при
+    одновременных переходах нескольких черг получал бы по сообщению
+    от рассылки каждой черги - и упирался бы в лимит Telegram на чат.
+    Вместо этого power_on/power_off для него ждут merge_window() секунд
+    в буфере merge:chat:{chat_id} (поле на чергу), после чего уходят
+    одним сообщением (NotificationService.flush_merged).
+
+    Рассылка каждой черги стартует через POWER_STATUS_DEBOUNCE после её
+    перехода, так что рассылки одного события разнесены на разброс переходов.
+    Окно по умолчанию равно debounce: склеиваются переходы, пришедшие в пределах
+    одного debounce друг от друга (ценой такой же добавочной задержки).
+
+    Пользователи с одним адресом отправляются сразу, без задержки, как и
+    пользователи с несколькими адресами, если склеивать не с чем: другие их
+    черги не ждут debounce и не рассылаются, а буфер чата пуст (select_held).
+    """
+
+    def __init__(self):
+        self._scripts: Dict[str, Any] = {}
+
+    async def _script(self, name: str, source: str):
+        redis = await redis_client.get_connection()
+        if name not in self._scripts:
+            self._scripts[name] = redis.register_script(source)
+        return self._scripts[name]
+
+    async def hold_many(
+            self,
+            items: List[Tuple[Recipient, bytes]],
+            notification_type: str,
+            queue_id: Optional[int],
+            time_str: str,
+            version_ms: int
+    ) -> float:
+        """
+        Положить сообщения батча в буферы чатов
+
+        Окно склейки отсчитывается от первого сообщения чата:
+        переходы, пришедшие позже, окно не продлевают.
+
+        Args:
+            items: Получатели и готовые JSON тела sendMessage
+            notification_type: Тип уведомления (из MERGED_LINES)
+            queue_id: Черга рассылки
+            time_str: Время перехода для строки склеенного сообщения
+            version_ms: Время события (мс): более раннее не перезаписывает более позднее
+
+        Returns:
+            float: Момент, когда буферы можно забирать (unix)
+        """
+        release_at = time.time() + merge_window()
+        if not items:
+            return release_at
+
+        keys: List[str] = [DUE_KEY]
+        args: List[Any] = [release_at, version_ms, CHAT_TTL]
+        for recipient, body in items:
+            item_queue = recipient.queue_id or queue_id or 0
+            keys.append(chat_key(recipient.user_id))
+            args.extend([
+                recipient.user_id,
+                item_queue,
+                json.dumps({
+                    "type": notification_type,
+                    "queue_id": item_queue,
+                    "time": time_str,
+                    "body": body.decode(),
+                }, ensure_ascii=False),
+            ])
+
+        hold = await self._script("hold", HOLD_SCRIPT)
+        await hold(keys=keys, args=args)
+        return release_at
+
+    async def select_held(self, user_ids: List[int], queue_id: Optional[int]) -> Set[int]:
+        """
+        Кого из пользователей с несколькими адресами держать в буфере склейки
+
+        Держим, если в буфере чата уже есть запись или другая черга пользователя
+        (recipient_index.watched_queues) ждёт debounce или рассылается.
+        Пользователя нет в индексе - его черги неизвестны, держим.
+
+        Returns:
+            set: chat ID для hold_many; остальным отправлять сразу
+        """
+        if not user_ids:
+            return set()
+
+        redis = await redis_client.get_connection()
+        pipe = redis.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.exists(chat_key(user_id))
+        buffered = await pipe.execute()
+
+        watched = await recipient_index.watched_queues(user_ids)
+        others = {
+            user_id: queues - {queue_id}
+            for user_id, queues in watched.items()
+        }
+        active = await power_status_coalescer.active_queues(set().union(*others.values()))
+
+        return {
+            user_id
+            for user_id, in_buffer in zip(user_ids, buffered)
+            if in_buffer or not watched[user_id] or others[user_id] & active
+        }
+
+    async def lease_due(self, limit: int = 1000) -> List[Tuple[int, List[Dict[str, Any]]]]:
+        """
+        Взять в аренду чаты, окно склейки которых закончилось
+
+        До ack записи остаются в буфере, а чат - в очереди с моментом отправки
+        через CHAT_MERGE_LEASE секунд: упавший воркер не теряет сообщения.
+
+        Returns:
+            list: (chat ID, записи по чергам с версией для ack)
+        """
+        now = time.time()
+        redis = await redis_client.get_connection()
+        chat_ids = await redis.zrangebyscore(DUE_KEY, "-inf", now, start=0, num=limit)
+        if not chat_ids:
+            return []
+
+        # Скрипт перепроверяет момент отправки: чат могли забрать параллельно
+        lease = await self._script("lease", LEASE_SCRIPT)
+        flat = await lease(
+            keys=[DUE_KEY, *(chat_key(int(chat_id)) for chat_id in chat_ids)],
+            args=[now, now + settings.CHAT_MERGE_LEASE, *chat_ids]
+        )
+
+        chats = []
+        for i in range(0, len(flat), 2):
+            fields = dict(zip(flat[i + 1][::2], flat[i + 1][1::2]))
+            entries = [
+                {**json.loads(value), "version": fields.get("v:" + field[2:], "")}
+                for field, value in fields.items()
+                if field.startswith("q:")
+            ]
+            if entries:
+                chats.append((int(flat[i]), entries))
+            else:
+                await self.ack([(int(flat[i]), [])])
+        return chats
+
+    async def ack(self, chats: List[Tuple[int, List[Dict[str, Any]]]]) -> int:
+        """Удалить отправленные (или переданные в dead-letter) записи чатов"""
+        if not chats:
+            return 0
+
+        keys: List[str] = [DUE_KEY]
+        args: List[Any] = [time.time() + merge_window()]
+        for chat_id, entries in chats:
+            keys.append(chat_key(chat_id))
+            args.extend([chat_id, len(entries)])
+            for entry in entries:
+                args.extend([entry["queue_id"], entry["version"]])
+
+        ack = await self._script("ack", ACK_SCRIPT)
+        return await ack(keys=keys, args=args)
+
+
+# Глобальный экземпляр буфера склейки
+chat_merge_buffer = ChatMergeBuffer()
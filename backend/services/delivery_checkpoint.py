@@ -0,0 +1,205 @@
+"""
+Delivery Checkpoint
+Чекпоинт доставки рассылки (SET обработанных chat ID) и dead-letter ZSET для повторов по получателю
+"""
+
+import json
+import logging
+import time
+from typing import Any, Dict, Iterable, List, Set
+
+from redis.exceptions import RedisError
+
+from redis_client import redis_client
+from config import settings
+from services.fanout import PROGRESS_TTL
+from services.telegram_errors import ERROR_RATE_LIMITED, ERROR_OTHER
+
+logger = logging.getLogger(__name__)
+
+
+DUE_KEY = "deadletter:due"  # ZSET "{fanout}:{user}" -> время следующей попытки (unix)
+PAYLOAD_KEY = "deadletter:payload"  # HASH член -> JSON сообщения
+
+# Временные ошибки: получателю стоит повторить отправку позже
+RETRYABLE_ERRORS = frozenset({ERROR_RATE_LIMITED, ERROR_OTHER})
+
+# Отложить сообщения до следующей попытки
+# KEYS[1] - ZSET попыток, KEYS[2] - HASH сообщений
+# ARGV - тройки: член, время попытки, JSON сообщения
+ADD_SCRIPT = """
+for i = 1, #ARGV, 3 do
+    redis.call('ZADD', KEYS[1], ARGV[i + 1], ARGV[i])
+    redis.call('HSET', KEYS[2], ARGV[i], ARGV[i + 2])
+end
+return (#ARGV) / 3
+"""
+
+# Взять в аренду сообщения, время попытки которых наступило: время попытки
+# сдвигается на срок аренды, удаляются они только после известного исхода (ACK_SCRIPT).
+# Упавший посреди отправки воркер не теряет сообщения - они вернутся после аренды.
+# KEYS - как в ADD_SCRIPT, ARGV[1] - текущее время (unix), ARGV[2] - лимит, ARGV[3] - конец аренды
+LEASE_SCRIPT = """
+local members = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+local payloads = {}
+for _, member in ipairs(members) do
+    local payload = redis.call('HGET', KEYS[2], member)
+    if payload then
+        table.insert(payloads, payload)
+        redis.call('ZADD', KEYS[1], 'XX', ARGV[3], member)
+    else
+        redis.call('ZREM', KEYS[1], member)
+    end
+end
+return payloads
+"""
+
+# Удалить сообщения с известным исходом (доставлено, окончательная ошибка, рассылка отменена)
+# KEYS - как в ADD_SCRIPT, ARGV - члены
+ACK_SCRIPT = """
+for _, member in ipairs(ARGV) do
+    redis.call('ZREM', KEYS[1], member)
+    redis.call('HDEL', KEYS[2], member)
+end
+return #ARGV
+"""
+
+
+def member(item: Dict[str, Any]) -> str:
+    """Член ZSET для сообщения dead-letter"""
+    return f"{item['fanout_id']}:{item['user_id']}"
+
+
+def is_retryable(result: Dict[str, Any]) -> bool:
+    """Временная ошибка отправки: получателю стоит повторить позже (dead-letter)"""
+    return not result.get("success") and result.get("error_code") in RETRYABLE_ERRORS
+
+
+def retry_delay(attempt: int) -> int:
+    """Пауза перед попыткой attempt (экспоненциально от DEAD_LETTER_BACKOFF)"""
+    return min(settings.DEAD_LETTER_BACKOFF * 2 ** (attempt - 1), settings.DEAD_LETTER_MAX_BACKOFF)
+
+
+class DeliveryCheckpoint:
+    """
+    Чекпоинт рассылки: SET fanout:{id}:delivered с chat ID, которые уже обработаны
+
+    Обработан - доставлен, недостижим (403/400), отложен тихим режимом или
+    склейкой, либо передан в dead-letter. Повтор шарда или всей задачи
+    (self.retry, перезапуск воркера с acks_late) идёт с тем же fanout_id
+    и пропускает этих получателей: они не получают сообщение дважды,
+    а бюджет rate limit не тратится на повтор.
+
+    Отметки пишутся после каждого батча: при падении посреди батча
+    повторно уйдёт не больше одного батча.
+    """
+
+    def __init__(self, fanout_id: str):
+        self.fanout_id = fanout_id
+        self.key = f"fanout:{fanout_id}:delivered"
+
+    async def delivered(self, user_ids: List[int]) -> Set[int]:
+        """Какие из user_ids уже обработаны (Redis недоступен - никакие)"""
+        if not user_ids:
+            return set()
+        try:
+            redis = await redis_client.get_connection()
+            flags = await redis.smismember(self.key, user_ids)
+        except RedisError as e:
+            logger.warning(f"Failed to read fanout {self.fanout_id} checkpoint: {e}")
+            return set()
+        return {user_id for user_id, flag in zip(user_ids, flags) if flag}
+
+    async def mark(self, user_ids: Iterable[int]):
+        """Отметить получателей обработанными"""
+        user_ids = list(user_ids)
+        if not user_ids:
+            return
+        try:
+            redis = await redis_client.get_connection()
+            pipe = redis.pipeline(transaction=False)
+            pipe.sadd(self.key, *user_ids)
+            pipe.expire(self.key, PROGRESS_TTL)
+            await pipe.execute()
+        except RedisError as e:
+            logger.warning(f"Failed to write fanout {self.fanout_id} checkpoint: {e}")
+
+
+class DeadLetterQueue:
+    """
+    Повторы отправки по отдельным получателям
+
+    Получатель с временной ошибкой (429 после всех повторов, 5xx, сеть)
+    не валит шард и не перезапускает рассылку целиком: его готовое тело
+    sendMessage ложится в ZSET deadletter:due с экспоненциальной паузой
+    и отправляется задачей retry_dead_letters, пока не кончатся
+    DEAD_LETTER_MAX_ATTEMPTS попыток.
+    """
+
+    def __init__(self):
+        self._scripts: Dict[str, Any] = {}
+
+    async def _script(self, name: str, source: str):
+        redis = await redis_client.get_connection()
+        if name not in self._scripts:
+            self._scripts[name] = redis.register_script(source)
+        return self._scripts[name]
+
+    async def add_many(self, items: List[Dict[str, Any]]) -> int:
+        """
+        Запланировать повторы
+
+        Args:
+            items: fanout_id, user_id, type, queue_id, lane, body (JSON sendMessage), attempt;
+                journal - строки журнала [тип, черга, текст] склеенного сообщения (необязательно)
+
+        Returns:
+            int: Сколько сообщений запланировано
+        """
+        if not items:
+            return 0
+
+        now = time.time()
+        args: List[Any] = []
+        for item in items:
+            args.extend([
+                member(item),
+                now + retry_delay(item["attempt"]),
+                json.dumps(item, ensure_ascii=False),
+            ])
+
+        add = await self._script("add", ADD_SCRIPT)
+        return await add(keys=[DUE_KEY, PAYLOAD_KEY], args=args)
+
+    async def lease_due(self, limit: int) -> List[Dict[str, Any]]:
+        """
+        Взять в аренду сообщения, время повтора которых наступило
+
+        До ack (или нового add_many) сообщения остаются в очереди со временем
+        попытки через DEAD_LETTER_LEASE секунд.
+        """
+        now = time.time()
+        lease = await self._script("lease", LEASE_SCRIPT)
+        payloads = await lease(
+            keys=[DUE_KEY, PAYLOAD_KEY],
+            args=[now, limit, now + settings.DEAD_LETTER_LEASE]
+        )
+        return [json.loads(payload) for payload in payloads]
+
+    async def ack(self, items: List[Dict[str, Any]]) -> int:
+        """Удалить сообщения, исход которых известен"""
+        if not items:
+            return 0
+        ack = await self._script("ack", ACK_SCRIPT)
+        return await ack(keys=[DUE_KEY, PAYLOAD_KEY], args=[member(item) for item in items])
+
+    async def stats(self) -> Dict[str, Any]:
+        redis = await redis_client.get_connection()
+        return {
+            "pending": await redis.zcard(DUE_KEY),
+            "due": await redis.zcount(DUE_KEY, "-inf", time.time()),
+        }
+
+
+# Глобальный экземпляр dead-letter очереди
+dead_letter_queue = DeadLetterQueue()
@@ -0,0 +1,188 @@
+"""
+Delivery Journal
+Журнал доставки рассылки: буфер результатов + сброс в notifications через COPY,
+недостижимые получатели помечаются в users одним UPDATE на сброс
+"""
+
+import logging
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from database import engine
+from config import settings
+from services.recipients import Recipient
+from services.recipient_index import recipient_index
+from services.telegram_errors import UNREACHABLE_ERRORS
+
+logger = logging.getLogger(__name__)
+
+
+class DeliveryJournal:
+    """
+    Построчный журнал доставки одной рассылки
+
+    Результаты по каждому получателю копятся в памяти и сбрасываются
+    в таблицу notifications пачками через asyncpg copy_records_to_table:
+    100k результатов = несколько round trip вместо 100k INSERT.
+
+    Получатели с 403 (blocked/deactivated) и 400 chat not found при
+    том же сбросе помечаются is_bot_blocked и удаляются из индекса,
+    поэтому следующие рассылки их уже не выбирают.
+    """
+
+    TABLE = "notifications"
+    COLUMNS = (
+        "user_id",
+        "queue_id",
+        "notification_type",
+        "message_text",
+        "sent_at",
+        "is_delivered",
+        "error_message",
+        "latency_ms",
+    )
+
+    # Один set-based UPDATE на все недостижимые получатели сброса
+    MARK_UNREACHABLE_SQL = """
+        UPDATE users
+        SET is_bot_blocked = true, bot_blocked_at = now(), bot_blocked_reason = u.reason
+        FROM unnest($1::bigint[], $2::text[]) AS u(user_id, reason)
+        WHERE users.user_id = u.user_id AND users.is_bot_blocked = false
+    """
+
+    def __init__(
+            self,
+            notification_type: str,
+            message_text: Optional[str] = None,
+            queue_id: Optional[int] = None,
+            chunk_size: Optional[int] = None
+    ):
+        self.notification_type = notification_type
+        self.message_text = message_text
+        self.queue_id = queue_id
+        self.chunk_size = chunk_size or settings.DELIVERY_JOURNAL_CHUNK
+
+        self._rows: List[Tuple[Any, ...]] = []
+        self._unreachable: Dict[int, str] = {}
+        self.written = 0
+        self.dropped = 0
+        self.unreachable = 0
+
+    async def record(self, recipient: Recipient, result: Dict[str, Any]):
+        """
+        Записать результат отправки получателю
+
+        Args:
+            recipient: Получатель
+            result: Результат _send_body (success, error, error_code, latency_ms)
+        """
+        if result.get("error_code") in UNREACHABLE_ERRORS:
+            self._unreachable[recipient.user_id] = result["error_code"]
+
+        self._rows.append((
+            recipient.user_id,
+            recipient.queue_id or self.queue_id or 0,
+            self.notification_type,
+            self.message_text,
+            datetime.now(timezone.utc),
+            bool(result.get("success")),
+            None if result.get("success") else result.get("error"),
+            result.get("latency_ms"),
+        ))
+
+        if len(self._rows) >= self.chunk_size:
+            await self.flush()
+
+    async def flush(self):
+        """Сбросить буфер в БД одним COPY (+ один UPDATE недостижимых)"""
+        if not self._rows:
+            return
+
+        rows, self._rows = self._rows, []
+        unreachable, self._unreachable = self._unreachable, {}
+
+        try:
+            async with engine.connect() as conn:
+                raw = await conn.get_raw_connection()
+                await raw.driver_connection.copy_records_to_table(
+                    self.TABLE,
+                    records=rows,
+                    columns=self.COLUMNS
+                )
+            self.written += len(rows)
+        except Exception as e:
+            # Журнал не должен ронять рассылку
+            self.dropped += len(rows)
+            logger.error(f"Failed to write {len(rows)} delivery records: {e}")
+
+        if unreachable:
+            await self._mark_unreachable(unreachable)
+
+    async def _mark_unreachable(self, unreachable: Dict[int, str]):
+        """Пометить недостижимых пользователей и убрать их из индекса получателей"""
+        user_ids = list(unreachable)
+
+        try:
+            async with engine.connect() as conn:
+                raw = await conn.get_raw_connection()
+                await raw.driver_connection.execute(
+                    self.MARK_UNREACHABLE_SQL,
+                    user_ids,
+                    list(unreachable.values())
+                )
+            self.unreachable += len(user_ids)
+        except Exception as e:
+            # Не помеченные попадут в следующую рассылку и будут помечены там
+            logger.error(f"Failed to mark {len(user_ids)} unreachable users: {e}")
+            return
+
+        await recipient_index.remove_users(user_ids)
+
+    async def close(self):
+        """Сбросить остаток буфера (в конце рассылки)"""
+        await self.flush()
+        logger.info(
+            f"Delivery journal {self.notification_type}: "
+            f"{self.written} written, {self.dropped} dropped, "
+            f"{self.unreachable} users marked unreachable"
+        )
+
+
+class DeliveryJournals:
+    """
+    Журналы повторных отправок вне рассылки (тихий режим, склейка, dead-letter)
+
+    В одном вызове смешаны сообщения разных типов и черг: журнал
+    создаётся лениво на каждую пару (тип, черга) и закрывается в close.
+    """
+
+    def __init__(self):
+        self._journals: Dict[Tuple[str, Optional[int]], DeliveryJournal] = {}
+
+    async def record(
+            self,
+            user_id: int,
+            notification_type: str,
+            queue_id: Optional[int],
+            message_text: Optional[str],
+            result: Dict[str, Any]
+    ):
+        """Записать результат отправки в журнал пары (тип, черга)"""
+        key = (notification_type, queue_id)
+        journal = self._journals.get(key)
+        if journal is None:
+            journal = self._journals[key] = DeliveryJournal(notification_type, message_text, queue_id=queue_id)
+
+        recipient = Recipient(
+            user_id=user_id,
+            first_name=None,
+            username=None,
+            tier="",
+            queue_id=queue_id,
+            flags=0
+        )
+        await journal.record(recipient, result)
+
+    async def close(self):
+        for journal in self._journals.values():
+            await journal.close()
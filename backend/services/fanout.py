@@ -0,0 +1,277 @@
+"""
+Fanout
+Нарезка рассылки на шарды по диапазонам chat ID и live-прогресс в Redis
+"""
+
+import asyncio
+import json
+import logging
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from redis.exceptions import RedisError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from redis_client import redis_client
+from config import settings
+from services.recipients import stream_recipient_ids
+from services.recipient_index import recipient_index, TIERS
+
+logger = logging.getLogger(__name__)
+
+
+PROGRESS_TTL = 24 * 3600  # прогресс рассылки хранится сутки
+PROGRESS_INT_FIELDS = ("queue_id", "total", "shards", "shards_done", "success", "failed", "paid")
+PROGRESS_JSON_FIELDS = ("tiers",)
+CANCEL_POLL_INTERVAL = 1.0  # секунд между проверками отмены в идущем шарде
+
+
+class ShardCutter:
+    """
+    Нарезка потока отсортированных chat ID на диапазоны [from, to) по shard_size получателей
+
+    ID подаются по одному (add): в памяти только границы шардов, а не весь список.
+    """
+
+    def __init__(self, shard_size: int):
+        self.shard_size = shard_size
+        self.count = 0
+        self._starts: List[int] = []
+        self._last: Optional[int] = None
+
+    def add(self, user_id: int):
+        if self.count % self.shard_size == 0:
+            self._starts.append(user_id)
+        self._last = user_id
+        self.count += 1
+
+    def ranges(self) -> List[Tuple[int, int]]:
+        if self._last is None:
+            return []
+        return list(zip(self._starts, [*self._starts[1:], self._last + 1]))
+
+
+def split_ranges(user_ids: Iterable[int], shard_size: int) -> List[Tuple[int, int]]:
+    """
+    Нарезать отсортированные chat ID на диапазоны [from, to) по shard_size получателей
+
+    Args:
+        user_ids: Отсортированные chat ID (список или поток)
+        shard_size: Получателей в одном шарде
+
+    Returns:
+        list: Диапазоны chat ID
+    """
+    cutter = ShardCutter(shard_size)
+    for user_id in user_ids:
+        cutter.add(user_id)
+    return cutter.ranges()
+
+
+def tier_groups(tier_filter: Optional[List[str]] = None) -> List[List[str]]:
+    """
+    Группы тарифов в порядке доставки (FANOUT_TIER_ORDER), ограниченные tier_filter
+
+    Тарифы, не упомянутые в FANOUT_TIER_ORDER, идут последней группой.
+    """
+    allowed = tier_filter or TIERS
+
+    groups = []
+    ordered = set()
+    for group in settings.FANOUT_TIER_ORDER:
+        ordered.update(group)
+        tiers = [tier for tier in group if tier in allowed]
+        if tiers:
+            groups.append(tiers)
+
+    rest = [tier for tier in allowed if tier not in ordered]
+    if rest:
+        groups.append(rest)
+    return groups
+
+
+async def plan_shards(
+        session: AsyncSession,
+        queue_id: int,
+        notification_type: str,
+        tier_filter: Optional[List[str]] = None,
+        shard_size: Optional[int] = None
+) -> Tuple[int, List[Tuple[List[str], Tuple[int, int]]]]:
+    """
+    Спланировать шарды рассылки черги
+
+    Шарды нарезаются отдельно по каждой группе тарифов (tier_groups) и идут
+    в порядке групп: при FIFO очереди Celery шарды PRO разбираются воркерами
+    первыми. chat ID берутся уже упорядоченными потоками - слиянием ZSET тарифов
+    индекса получателей или из Postgres (только ID, ORDER BY user_id) - и режутся
+    на ходу (ShardCutter): без записей получателей и сортировки в памяти.
+
+    Returns:
+        tuple: (всего получателей, список (тарифы группы, диапазон chat ID))
+    """
+    shard_size = shard_size or settings.FANOUT_SHARD_SIZE
+    use_index = await recipient_index.is_ready()
+
+    total = 0
+    shards = []
+    for tiers in tier_groups(tier_filter):
+        cutter = ShardCutter(shard_size)
+        if use_index:
+            for user_id in await recipient_index.get_recipient_ids(queue_id, notification_type, tiers):
+                cutter.add(user_id)
+        else:
+            async for user_id in stream_recipient_ids(session, queue_id, notification_type, tiers):
+                cutter.add(user_id)
+
+        total += cutter.count
+        shards.extend((tiers, id_range) for id_range in cutter.ranges())
+
+    return total, shards
+
+
+def tier_slo_ms(tier: str) -> Optional[int]:
+    slo = settings.FANOUT_TIER_SLO.get(tier)
+    return slo * 1000 if slo is not None else None
+
+
+def merge_tier_stats(target: Dict[str, Dict[str, int]], source: Dict[str, Dict[str, int]]):
+    """Сложить статистику доставки по тарифам (send_batch -> finalize_fanout)"""
+    for tier, stats in source.items():
+        current = target.setdefault(tier, {"sent": 0, "within_slo": 0, "delay_sum_ms": 0, "max_delay_ms": 0})
+        current["sent"] += stats["sent"]
+        current["within_slo"] += stats["within_slo"]
+        current["delay_sum_ms"] += stats["delay_sum_ms"]
+        current["max_delay_ms"] = max(current["max_delay_ms"], stats["max_delay_ms"])
+
+
+def tier_report(tier_stats: Dict[str, Dict[str, int]]) -> Dict[str, Dict[str, Any]]:
+    """Доля доставленных в SLO, средняя и максимальная задержка по тарифам"""
+    report = {}
+    for tier, stats in tier_stats.items():
+        sent = stats["sent"]
+        report[tier] = {
+            "sent": sent,
+            "slo_s": settings.FANOUT_TIER_SLO.get(tier),
+            "within_slo": stats["within_slo"],
+            "compliance": round(stats["within_slo"] / sent, 4) if sent else 1.0,
+            "avg_delay_s": round(stats["delay_sum_ms"] / sent / 1000, 1) if sent else 0.0,
+            "max_delay_s": round(stats["max_delay_ms"] / 1000, 1),
+        }
+    return report
+
+
+class FanoutProgress:
+    """
+    Live-счётчики рассылки в Redis (HASH fanout:{id}:progress)
+
+    Шарды увеличивают success/failed после каждого батча,
+    финализатор chord выставляет итоговый статус.
+    Рассылку можно отменить (cancel): идущие шарды замечают это
+    в течение CANCEL_POLL_INTERVAL и прекращают отправку.
+    """
+
+    def __init__(self, fanout_id: str, trace_id: Optional[str] = None):
+        self.fanout_id = fanout_id
+        self.trace_id = trace_id  # событие отключения (services.outage_trace)
+        self.key = f"fanout:{fanout_id}:progress"
+        self.cancelled = False
+
+    async def start(self, queue_id: int, notification_type: str, total: int, shards: int):
+        await self._write({
+            "fanout_id": self.fanout_id,
+            "queue_id": queue_id,
+            "notification_type": notification_type,
+            "total": total,
+            "shards": shards,
+            "shards_done": 0,
+            "success": 0,
+            "failed": 0,
+            "status": "running",
+            "started_at": datetime.utcnow().isoformat(),
+            "trace_id": self.trace_id or "",
+        })
+
+    async def add(self, success: int, failed: int):
+        """Учесть результат очередного батча"""
+        try:
+            redis = await redis_client.get_connection()
+            pipe = redis.pipeline(transaction=False)
+            pipe.hincrby(self.key, "success", success)
+            pipe.hincrby(self.key, "failed", failed)
+            await pipe.execute()
+        except RedisError as e:
+            logger.warning(f"Failed to update fanout {self.fanout_id} progress: {e}")
+
+    async def shard_done(self):
+        try:
+            redis = await redis_client.get_connection()
+            await redis.hincrby(self.key, "shards_done", 1)
+        except RedisError as e:
+            logger.warning(f"Failed to update fanout {self.fanout_id} progress: {e}")
+
+    async def finish(
+            self,
+            status: str = "done",
+            tiers: Optional[Dict[str, Dict[str, Any]]] = None,
+            paid: int = 0
+    ):
+        fields = {
+            "status": status,
+            "finished_at": datetime.utcnow().isoformat(),
+        }
+        if tiers:
+            fields["tiers"] = json.dumps(tiers)
+        if paid:
+            # Платная рассылка: сообщений и стоимость в Telegram Stars
+            fields["paid"] = paid
+            fields["paid_cost_stars"] = round(paid * settings.TELEGRAM_PAID_STARS_PER_MESSAGE, 2)
+        await self._write(fields)
+
+    async def cancel(self):
+        """Отменить рассылку (например, состояние черги уже изменилось обратно)"""
+        self.cancelled = True
+        await self.finish(status="cancelled")
+
+    async def refresh_cancelled(self) -> bool:
+        """Перечитать флаг отмены из Redis"""
+        try:
+            redis = await redis_client.get_connection()
+            self.cancelled = await redis.hget(self.key, "status") == "cancelled"
+        except RedisError as e:
+            logger.warning(f"Failed to read fanout {self.fanout_id} status: {e}")
+        return self.cancelled
+
+    async def watch_cancel(self):
+        """Фоново обновлять self.cancelled, пока рассылка не отменена"""
+        while not await self.refresh_cancelled():
+            await asyncio.sleep(CANCEL_POLL_INTERVAL)
+
+    async def get(self) -> Optional[Dict[str, Any]]:
+        """Текущий прогресс (None - рассылка не найдена или истекла)"""
+        redis = await redis_client.get_connection()
+        data = await redis.hgetall(self.key)
+        if not data:
+            return None
+
+        for field in PROGRESS_INT_FIELDS:
+            if field in data:
+                data[field] = int(data[field])
+        for field in PROGRESS_JSON_FIELDS:
+            if field in data:
+                data[field] = json.loads(data[field])
+
+        processed = data.get("success", 0) + data.get("failed", 0)
+        total = data.get("total", 0)
+        data["processed"] = processed
+        data["percent"] = round(processed / total * 100, 1) if total else 100.0
+        return data
+
+    async def _write(self, fields: Dict[str, Any]):
+        try:
+            redis = await redis_client.get_connection()
+            pipe = redis.pipeline(transaction=False)
+            pipe.hset(self.key, mapping=fields)
+            pipe.expire(self.key, PROGRESS_TTL)
+            await pipe.execute()
+        except RedisError as e:
+            logger.warning(f"Failed to write fanout {self.fanout_id} progress: {e}")
@@ -0,0 +1,417 @@
+"""
+IoT Ingest
+Запись показаний сенсоров в iot_data: только изменения, COPY и write-behind буфер процесса API
+"""
+
+import asyncio
+import json
+import logging
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from redis.exceptions import RedisError
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from redis_client import redis_client
+from database import engine
+from config import settings
+from models.iot_sensor import IoTSensor, IoTData
+from services.iot_registry import iot_registry
+
+logger = logging.getLogger(__name__)
+
+
+TABLE = "iot_data"
+
+STORED_KEY = "iot:stored"  # HASH sensor_id -> JSON последнего записанного показания и времени последнего пинга
+
+
+class Row(NamedTuple):
+    """Строка iot_data (порядок полей - порядок колонок COPY)"""
+    sensor_id: str
+    is_power_on: bool
+    voltage: Optional[Decimal]
+    frequency: Optional[Decimal]
+    measured_at: datetime
+    received_at: datetime
+    prev_seen_at: Optional[datetime] = None
+    replayed: bool = False
+
+
+COLUMNS = list(Row._fields)
+
+
+def reading_row(
+        sensor_id: str,
+        is_power_on: bool,
+        voltage: Optional[float] = None,
+        frequency: Optional[float] = None,
+        measured_at: Optional[datetime] = None,
+        received_at: Optional[datetime] = None
+) -> Row:
+    """Показание -> строка для COPY (Numeric(5, 2) - через Decimal, как при INSERT)"""
+    received_at = received_at or datetime.now(timezone.utc)
+    return Row(
+        sensor_id=sensor_id,
+        is_power_on=is_power_on,
+        voltage=round(Decimal(str(voltage)), 2) if voltage is not None else None,
+        frequency=round(Decimal(str(frequency)), 2) if frequency is not None else None,
+        measured_at=measured_at or received_at,
+        received_at=received_at,
+    )
+
+
+def to_ms(at: datetime) -> int:
+    return int(at.timestamp() * 1000)
+
+
+def beyond_deadband(old: Optional[float], new: Optional[Decimal], deadband: float) -> bool:
+    """Значение вышло за deadband относительно записанного (появилось или пропало - тоже)"""
+    if old is None or new is None:
+        return (old is None) != (new is None)
+    return abs(float(new) - old) > deadband
+
+
+class ChangeFilter:
+    """
+    Запись только изменений (IOT_STORAGE_MODE = "changes")
+
+    ESP32 шлёт одно и то же состояние каждые 10-30 секунд: больше 99%
+    строк iot_data повторяют предыдущую. В iot_data попадают только:
+
+    - смена is_power_on
+    - voltage / frequency, ушедшие от записанного значения дальше
+      IOT_VOLTAGE_DEADBAND / IOT_FREQUENCY_DEADBAND
+    - первое показание после паузы в пингах дольше IOT_HEARTBEAT_GAP
+
+    Остальные показания - heartbeat: они только двигают время последнего
+    пинга (iot_sensors.last_ping_at, services.iot_registry).
+
+    Каждая записанная строка открывает отрезок, в котором сенсор сообщал
+    это же показание (в пределах deadband), и хранит prev_seen_at - время
+    последнего пинга предыдущего отрезка. Поэтому "что сообщал сенсор X
+    в момент T" восстанавливается точно (reading_at): последняя строка
+    с measured_at <= T, если следующая строка не говорит о паузе
+    (prev_seen_at < T) и T не позже последнего пинга.
+
+    Досланные показания старше последнего пинга в отрезки не входят:
+    они пишутся все, с replayed = true, и каждое описывает только себя.
+
+    Последнее записанное показание и время последнего пинга сенсора - в
+    Redis (общие для воркеров API). Redis недоступен - пишется всё.
+    Строки, потерянные буфером записи, отрезок закрывают (invalidate):
+    следующее показание откроет новый, и потерянный промежуток будет
+    паузой, а не продолжением старого показания.
+    """
+
+    async def _load(self, sensor_id: str) -> Optional[Dict[str, Any]]:
+        redis = await redis_client.get_connection()
+        stored = await redis.hget(STORED_KEY, sensor_id)
+        return json.loads(stored) if stored else None
+
+    async def select(self, sensor_id: str, rows: List[Row]) -> List[Row]:
+        """
+        Оставить строки, которые надо записать (rows одного сенсора, по времени)
+
+        Returns:
+            List[Row]: Изменения с заполненным prev_seen_at
+        """
+        if not rows or settings.IOT_STORAGE_MODE != "changes":
+            return rows
+
+        try:
+            last = await self._load(sensor_id)
+        except RedisError as e:
+            logger.warning(f"Failed to read stored reading of sensor {sensor_id}: {e}")
+            return rows
+
+        gap_ms = settings.IOT_HEARTBEAT_GAP * 1000
+        changes: List[Row] = []
+
+        for row in rows:
+            at_ms = to_ms(row.measured_at)
+
+            if last is not None and at_ms <= last["seen"]:
+                # Досланное показание из прошлого: отрезки не трогаем, пишем как есть
+                changes.append(row._replace(replayed=True))
+                continue
+
+            if (
+                last is None
+                or row.is_power_on != last["on"]
+                or beyond_deadband(last["voltage"], row.voltage, settings.IOT_VOLTAGE_DEADBAND)
+                or beyond_deadband(last["frequency"], row.frequency, settings.IOT_FREQUENCY_DEADBAND)
+                or at_ms - last["seen"] > gap_ms
+            ):
+                prev_seen_at = (
+                    datetime.fromtimestamp(last["seen"] / 1000, tz=timezone.utc) if last is not None else None
+                )
+                changes.append(row._replace(prev_seen_at=prev_seen_at))
+                last = {
+                    "on": row.is_power_on,
+                    "voltage": float(row.voltage) if row.voltage is not None else None,
+                    "frequency": float(row.frequency) if row.frequency is not None else None,
+                    "seen": at_ms,
+                }
+            else:
+                # Heartbeat: только время последнего пинга
+                last["seen"] = at_ms
+
+        try:
+            redis = await redis_client.get_connection()
+            await redis.hset(STORED_KEY, sensor_id, json.dumps(last))
+        except RedisError as e:
+            # Следующий пинг сравнится со старым состоянием: лишняя строка, но не потерянная
+            logger.warning(f"Failed to save stored reading of sensor {sensor_id}: {e}")
+
+        return changes
+
+    async def invalidate(self, rows: List[Row]):
+        """
+        Строки не записаны (потеряны буфером): закрыть отрезки их сенсоров
+
+        Следующее показание сенсора станет новой строкой с prev_seen_at =
+        последнему пингу, который точно есть в iot_data (prev_seen_at
+        первой потерянной строки).
+        """
+        seen: Dict[str, int] = {}
+        for row in rows:
+            if row.replayed or row.sensor_id in seen:
+                continue
+            seen[row.sensor_id] = to_ms(row.prev_seen_at or row.measured_at)
+
+        if not seen or settings.IOT_STORAGE_MODE != "changes":
+            return
+
+        try:
+            redis = await redis_client.get_connection()
+            await redis.hset(STORED_KEY, mapping={
+                sensor_id: json.dumps({"on": None, "voltage": None, "frequency": None, "seen": at_ms})
+                for sensor_id, at_ms in seen.items()
+            })
+        except RedisError as e:
+            logger.error(f"Failed to invalidate stored readings of {len(seen)} sensors: {e}")
+
+
+async def copy_readings(rows: List[Row]) -> int:
+    """
+    Записать показания одним COPY
+
+    Returns:
+        int: Сколько строк записано
+    """
+    if not rows:
+        return 0
+
+    async with engine.connect() as conn:
+        raw = await conn.get_raw_connection()
+        await raw.driver_connection.copy_records_to_table(TABLE, records=rows, columns=COLUMNS)
+    return len(rows)
+
+
+async def reading_at(session: AsyncSession, sensor_id: str, at: datetime) -> Optional[Dict[str, Any]]:
+    """
+    Что сообщал сенсор в момент at
+
+    Последняя строка отрезка с measured_at <= at действует, пока сенсор
+    пинговал: до prev_seen_at следующей строки (или до последнего пинга,
+    если строка последняя) плюс IOT_HEARTBEAT_GAP. Досланное показание
+    (replayed) действует IOT_HEARTBEAT_GAP после measured_at и, если оно
+    позже строки отрезка, точнее её.
+
+    Returns:
+        None - данных нет или сенсор в этот момент молчал
+    """
+    gap = timedelta(seconds=settings.IOT_HEARTBEAT_GAP)
+
+    replayed = await session.scalar(
+        select(IoTData)
+        .where(IoTData.sensor_id == sensor_id, IoTData.replayed.is_(True), IoTData.measured_at <= at)
+        .order_by(IoTData.measured_at.desc())
+        .limit(1)
+    )
+    if replayed is not None and at > replayed.measured_at + gap:
+        replayed = None
+
+    row = await session.scalar(
+        select(IoTData)
+        .where(IoTData.sensor_id == sensor_id, IoTData.replayed.is_(False), IoTData.measured_at <= at)
+        .order_by(IoTData.measured_at.desc())
+        .limit(1)
+    )
+    seen_until = None
+
+    if row is not None:
+        following = await session.scalar(
+            select(IoTData)
+            .where(IoTData.sensor_id == sensor_id, IoTData.replayed.is_(False), IoTData.measured_at > at)
+            .order_by(IoTData.measured_at.asc())
+            .limit(1)
+        )
+        if following is not None:
+            seen_until = following.prev_seen_at
+        else:
+            seen_until = await iot_registry.last_ping(sensor_id) or await session.scalar(
+                select(IoTSensor.last_ping_at).where(IoTSensor.sensor_id == sensor_id)
+            )
+
+        if seen_until is not None and at > seen_until + gap:
+            row = None
+
+    if replayed is not None and (row is None or replayed.measured_at > row.measured_at):
+        row, seen_until = replayed, replayed.measured_at
+
+    if row is None:
+        return None
+
+    return {
+        "is_power_on": row.is_power_on,
+        "voltage": row.voltage,
+        "frequency": row.frequency,
+        "since": row.measured_at,
+        "seen_until": seen_until,
+    }
+
+
+class IoTWriteBuffer:
+    """
+    Write-behind буфер iot_data в процессе API
+
+    Пинг не открывает свою транзакцию: строка ложится в буфер, фоновая
+    корутина сбрасывает буфер одним COPY (одна транзакция, один fsync WAL
+    на все строки - group commit), как только набралось
+    IOT_WRITE_FLUSH_ROWS строк или прошло IOT_WRITE_FLUSH_INTERVAL секунд.
+
+    Если Postgres не успевает (COPY падает или буфер растёт быстрее
+    сброса), строки остаются в буфере и сброс повторяется с паузой.
+    Буфер ограничен IOT_WRITE_BUFFER_MAX_ROWS: заполненный буфер -
+    сигнал API отвечать сенсорам 429 с Retry-After (has_room), сенсор
+    копит показания у себя и досылает пакетом. Граница мягкая: запросы,
+    прошедшие проверку одновременно, могут превысить её на свои строки.
+
+    При остановке API (stop) буфер сбрасывается; строки, которые так и не
+    удалось записать, закрывают отрезки ChangeFilter (invalidate).
+    Буфер процесса, упавшего без stop, теряется вместе с процессом.
+    """
+
+    def __init__(self):
+        self._rows: List[Row] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self._failures = 0
+
+        self.written = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.dropped = 0
+
+    @property
+    def pending(self) -> int:
+        return len(self._rows)
+
+    def has_room(self, rows: int = 1) -> bool:
+        """Поместятся ли ещё rows строк (False - ответить сенсору 429)"""
+        return len(self._rows) + rows <= settings.IOT_WRITE_BUFFER_MAX_ROWS
+
+    def submit(self, rows: List[Row]):
+        """Положить строки в буфер (запись - после ответа сенсору)"""
+        self._rows.extend(rows)
+        if self._wakeup is not None and len(self._rows) >= settings.IOT_WRITE_FLUSH_ROWS:
+            self._wakeup.set()
+
+    async def start(self):
+        """Запустить фоновый сброс (lifespan API)"""
+        if self._task is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановить фоновый сброс и записать всё, что осталось в буфере"""
+        if self._task is not None:
+            # Не cancel: wait_for может проглотить отмену, если событие
+            # пришло одновременно, - корутина сама выходит по флагу
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+
+        if self._rows and not await self.flush():
+            rows, self._rows = self._rows, []
+            self.dropped += len(rows)
+            logger.error(f"Dropped {len(rows)} IoT readings on shutdown")
+            await change_filter.invalidate(rows)
+
+    async def _wait(self, timeout: float):
+        """Пауза до timeout или до пробуждения (буфер набрался, остановка)"""
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+    async def _run(self):
+        while not self._stopping:
+            await self._wait(settings.IOT_WRITE_FLUSH_INTERVAL)
+            if self._stopping:
+                break  # последний сброс - в stop
+
+            if not await self.flush():
+                # Postgres отстаёт: не долбить его, буфер тем временем копится
+                # (и при заполнении отсекает сенсоров через has_room)
+                await self._wait(min(
+                    settings.IOT_WRITE_FLUSH_INTERVAL * 2 ** self._failures,
+                    settings.IOT_WRITE_RETRY_AFTER
+                ))
+
+    async def flush(self) -> bool:
+        """
+        Сбросить буфер одним COPY
+
+        Returns:
+            bool: Записано (или нечего писать); False - строки вернулись в буфер
+        """
+        if not self._rows:
+            return True
+
+        rows, self._rows = self._rows, []
+
+        try:
+            await copy_readings(rows)
+        except asyncio.CancelledError:
+            # Отмена посреди COPY: транзакция откатится, строки остаются в буфере
+            self._rows = rows + self._rows
+            raise
+        except Exception as e:
+            # Вернуть строки в начало буфера: порядок показаний сохраняется
+            self._rows = rows + self._rows
+            self._failures += 1
+            self.failed_flushes += 1
+            logger.error(f"Failed to write {len(rows)} IoT readings (attempt {self._failures}): {e}")
+            return False
+
+        self._failures = 0
+        self.flushes += 1
+        self.written += len(rows)
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending": self.pending,
+            "capacity": settings.IOT_WRITE_BUFFER_MAX_ROWS,
+            "written": self.written,
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes,
+            "dropped": self.dropped,
+        }
+
+
+# Глобальный экземпляр фильтра изменений
+change_filter = ChangeFilter()
+
+# Глобальный экземпляр буфера (один на процесс API)
+iot_write_buffer = IoTWriteBuffer()
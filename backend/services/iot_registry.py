@@ -0,0 +1,379 @@
+"""
+IoT Registry
+Реестр сенсоров, состояние черг и последние показания в Redis: пинг ESP32 без запросов к Postgres
+"""
+
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from redis.exceptions import RedisError
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from redis_client import redis_client
+from database import engine
+from config import settings
+from models.iot_sensor import IoTSensor
+from models.queue import Queue
+
+logger = logging.getLogger(__name__)
+
+
+SENSORS_KEY = "iot:sensors"  # HASH sensor_id -> queue_id
+QUEUES_KEY = "iot:queues"  # HASH queue_id -> "1"/"0" (свет есть / нет)
+READINGS_KEY = "iot:readings"  # HASH sensor_id -> "голос|at_ms" последнего показания
+PINGS_KEY = "iot:pings"  # HASH sensor_id -> последний пинг (мс), переносится в iot_sensors.last_ping_at
+CHANGED_KEY = "iot:changed"  # HASH queue_id -> время последнего подтверждённого перехода (мс)
+QUORUM_KEY = "iot:quorum"  # HASH queue_id -> голосов для перехода (IOT_CONSENSUS_QUORUM)
+LOADED_KEY = "iot:loaded"  # реестр загружен из Postgres
+
+
+def queue_sensors_key(queue_id: int) -> str:
+    return f"iot:queue:{queue_id}:sensors"
+
+
+# Пинг сенсора и голосование N из M: одна атомарная операция на пинг
+# KEYS[1] - реестр сенсоров, KEYS[2] - состояния черг, KEYS[3] - голоса сенсоров,
+# KEYS[4] - пинги, KEYS[5] - время последнего перехода черг, KEYS[6] - кворумы черг,
+# KEYS[7] - SET сенсоров черги ARGV[10] (черга сенсора читается до вызова, все ключи - явно)
+# ARGV[1] - sensor_id, ARGV[2] - is_power_on (1/0), ARGV[3] - время показания (мс),
+# ARGV[4] - время пинга (мс; у показаний из буфера сенсора раньше пинга),
+# ARGV[5] - напряжение ('' - нет), ARGV[6] / ARGV[7] - пороги включения / выключения (В),
+# ARGV[8] - окно свежести голоса (мс), ARGV[9] - минимальное время в состоянии (мс),
+# ARGV[10] - черга сенсора, прочитанная до вызова
+# Возвращает {} - сенсор неизвестен, {'moved'} - сенсор перенесён в другую чергу, иначе
+# {queue_id, состояние до пинга ('' - нет в кэше), голос сенсора, 1 - переход подтверждён этим пингом,
+#  голосов за голос сенсора, свежих голосов (M), сенсоров черги, кворум (N)}
+CONSENSUS_SCRIPT = """
+local queue_id = redis.call('HGET', KEYS[1], ARGV[1])
+if not queue_id then
+    return {}
+end
+if queue_id ~= ARGV[10] then
+    return {'moved'}
+end
+local now = tonumber(ARGV[4])
+redis.call('HSET', KEYS[4], ARGV[1], ARGV[4])
+
+-- Голос сенсора: по напряжению с гистерезисом (между порогами - прежний голос), иначе is_power_on
+local vote = ARGV[2]
+local previous = redis.call('HGET', KEYS[3], ARGV[1])
+local previous_vote, previous_at
+if previous then
+    previous_vote, previous_at = string.match(previous, '^(%d)|(%d+)$')
+end
+if previous_at and tonumber(ARGV[3]) < tonumber(previous_at) then
+    -- Досланное показание старше записанного: голос не меняет
+    vote = previous_vote
+else
+    if ARGV[5] ~= '' then
+        local voltage = tonumber(ARGV[5])
+        if voltage >= tonumber(ARGV[6]) then
+            vote = '1'
+        elseif voltage <= tonumber(ARGV[7]) then
+            vote = '0'
+        elseif previous_vote then
+            vote = previous_vote
+        end
+    end
+    redis.call('HSET', KEYS[3], ARGV[1], vote .. '|' .. ARGV[3])
+end
+
+local state = redis.call('HGET', KEYS[2], queue_id)
+if not state then
+    return {queue_id, '', vote, 0, 0, 0, 0, 0}
+end
+if state == vote then
+    return {queue_id, state, vote, 0, 0, 0, 0, 0}
+end
+
+-- M - сенсоры черги, голосуют только свежие (моложе окна) голоса
+local sensors = redis.call('SMEMBERS', KEYS[7])
+local votes, voters = 0, 0
+for _, sensor in ipairs(sensors) do
+    local reading = redis.call('HGET', KEYS[3], sensor)
+    if reading then
+        local sensor_vote, at = string.match(reading, '^(%d)|(%d+)$')
+        if now - tonumber(at) <= tonumber(ARGV[8]) then
+            voters = voters + 1
+            if sensor_vote == vote then
+                votes = votes + 1
+            end
+        end
+    end
+end
+
+-- N - кворум черги или большинство свежих голосов (не меньше одного)
+local quorum = tonumber(redis.call('HGET', KEYS[6], queue_id) or '0')
+if quorum <= 0 then
+    quorum = math.floor(voters / 2) + 1
+end
+
+local changed = 0
+if votes >= quorum then
+    local last_change = tonumber(redis.call('HGET', KEYS[5], queue_id) or '0')
+    if now - last_change >= tonumber(ARGV[9]) then
+        -- Переход подтверждает ровно один пинг: остальные увидят уже новое состояние
+        redis.call('HSET', KEYS[2], queue_id, vote)
+        redis.call('HSET', KEYS[5], queue_id, ARGV[4])
+        changed = 1
+    end
+end
+return {queue_id, state, vote, changed, votes, voters, #sensors, quorum}
+"""
+
+
+class PingResult(NamedTuple):
+    """Результат пинга сенсора (CONSENSUS_SCRIPT)"""
+    queue_id: int
+    state: Optional[bool]  # состояние черги до пинга (None - нет в кэше)
+    vote: bool  # голос сенсора
+    changed: bool  # этот пинг подтвердил переход в vote
+    votes: int  # свежих голосов за vote
+    voters: int  # M - свежих голосов
+    sensors: int  # сенсоров черги
+    quorum: int  # N - голосов для перехода
+
+
+# Один set-based UPDATE на все сенсоры, пинговавшие с прошлой синхронизации
+SYNC_PINGS_SQL = """
+    UPDATE iot_sensors
+    SET last_ping_at = p.pinged_at, is_online = true
+    FROM unnest($1::varchar[], $2::timestamptz[]) AS p(sensor_id, pinged_at)
+    WHERE iot_sensors.sensor_id = p.sensor_id
+        AND (iot_sensors.last_ping_at IS NULL OR iot_sensors.last_ping_at < p.pinged_at)
+"""
+
+
+def now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+class IoTRegistry:
+    """
+    Горячее состояние IoT в Redis (общее для всех воркеров uvicorn)
+
+    - реестр сенсоров (sensor_id -> черга) и сенсоры каждой черги
+    - текущее состояние черг (копия queues.is_power_on)
+    - последний голос каждого сенсора
+    - время последнего пинга (в iot_sensors.last_ping_at переносит sync_pings)
+
+    Загружается из Postgres при старте API (load), дальше поддерживается
+    записями: регистрация сенсора - add_sensor, ручная смена состояния
+    черги - set_queue_state. Пинг - один вызов CONSENSUS_SCRIPT, без
+    чтения и записи строк Postgres в запросе.
+
+    Консенсус (CONSENSUS_SCRIPT) атомарен, гонки двух сенсоров и воркеров
+    uvicorn нет:
+
+    - голос сенсора - is_power_on, а у сенсоров с напряжением - гистерезис
+      IOT_VOLTAGE_ON / IOT_VOLTAGE_OFF (между порогами голос не меняется)
+    - голос старше IOT_STALE_AFTER не учитывается ни за, ни против:
+      молчащий (мёртвый) сенсор не блокирует черги
+    - переход - когда за новое состояние N голосов из M свежих: кворум
+      черги из IOT_CONSENSUS_QUORUM (строгий, считается от всех сенсоров)
+      или большинство свежих (1 из 1, 2 из 2, 2 из 3), не меньше одного
+    - после перехода черга держит состояние не меньше IOT_MIN_DWELL
+    - переход подтверждает ровно один пинг (changed), он же пишет его в Postgres
+    """
+
+    def __init__(self):
+        self._ping_script = None
+
+    async def load(self, session: AsyncSession) -> Dict[str, int]:
+        """Загрузить реестр сенсоров и состояния черг из Postgres"""
+        sensors = (await session.execute(select(IoTSensor.sensor_id, IoTSensor.queue_id))).all()
+        queues = (await session.execute(select(Queue.queue_id, Queue.is_power_on))).all()
+
+        redis = await redis_client.get_connection()
+        old_queues = {int(queue_id) for queue_id in await redis.hvals(SENSORS_KEY)}
+
+        pipe = redis.pipeline(transaction=True)
+        pipe.delete(
+            SENSORS_KEY, QUEUES_KEY, QUORUM_KEY, *(queue_sensors_key(queue_id) for queue_id in old_queues)
+        )
+        for sensor_id, queue_id in sensors:
+            pipe.hset(SENSORS_KEY, sensor_id, queue_id)
+            pipe.sadd(queue_sensors_key(queue_id), sensor_id)
+        if queues:
+            pipe.hset(QUEUES_KEY, mapping={
+                queue_id: "1" if is_power_on else "0" for queue_id, is_power_on in queues
+            })
+        if settings.IOT_CONSENSUS_QUORUM:
+            pipe.hset(QUORUM_KEY, mapping=settings.IOT_CONSENSUS_QUORUM)
+        pipe.set(LOADED_KEY, 1)
+        await pipe.execute()
+
+        logger.info(f"IoT registry loaded: {len(sensors)} sensors, {len(queues)} queues")
+        return {"sensors": len(sensors), "queues": len(queues)}
+
+    async def is_loaded(self) -> bool:
+        redis = await redis_client.get_connection()
+        return bool(await redis.exists(LOADED_KEY))
+
+    async def sensor_queue(self, sensor_id: str) -> Optional[int]:
+        """Черга сенсора (None - сенсор не зарегистрирован)"""
+        redis = await redis_client.get_connection()
+        queue_id = await redis.hget(SENSORS_KEY, sensor_id)
+        return int(queue_id) if queue_id is not None else None
+
+    async def add_sensor(self, sensor_id: str, queue_id: int):
+        """Добавить сенсор в реестр (после регистрации)"""
+        redis = await redis_client.get_connection()
+        old_queue = await redis.hget(SENSORS_KEY, sensor_id)
+
+        pipe = redis.pipeline(transaction=True)
+        if old_queue is not None and int(old_queue) != queue_id:
+            pipe.srem(queue_sensors_key(int(old_queue)), sensor_id)
+        pipe.hset(SENSORS_KEY, sensor_id, queue_id)
+        pipe.sadd(queue_sensors_key(queue_id), sensor_id)
+        await pipe.execute()
+
+    async def set_queue_state(self, queue_id: int, is_power_on: bool):
+        """Обновить состояние черги в кэше (после коммита в queues)"""
+        try:
+            redis = await redis_client.get_connection()
+            await redis.hset(QUEUES_KEY, queue_id, "1" if is_power_on else "0")
+        except RedisError as e:
+            # Переход по устаревшему кэшу отсечёт условный UPDATE queues, кэш поправит следующая загрузка
+            logger.error(f"Failed to update cached state of queue {queue_id}: {e}")
+
+    async def revert_transition(self, queue_id: int, is_power_on: Optional[bool]):
+        """
+        Переход, подтверждённый CONSENSUS_SCRIPT, не записан в Postgres
+
+        Состояние черги в кэше возвращается к Postgres, таймер IOT_MIN_DWELL
+        сбрасывается: следующий пинг голосует заново без задержки.
+
+        Args:
+            is_power_on: Состояние черги в Postgres (None - черги нет, убрать из кэша)
+        """
+        try:
+            redis = await redis_client.get_connection()
+            pipe = redis.pipeline(transaction=True)
+            if is_power_on is None:
+                pipe.hdel(QUEUES_KEY, queue_id)
+            else:
+                pipe.hset(QUEUES_KEY, queue_id, "1" if is_power_on else "0")
+            pipe.hdel(CHANGED_KEY, queue_id)
+            await pipe.execute()
+        except RedisError as e:
+            logger.error(f"Failed to revert cached transition of queue {queue_id}: {e}")
+
+    async def ping(
+            self,
+            sensor_id: str,
+            is_power_on: bool,
+            at_ms: Optional[int] = None,
+            voltage: Optional[float] = None
+    ) -> Optional[PingResult]:
+        """
+        Записать пинг сенсора и проголосовать за состояние черги
+
+        Args:
+            at_ms: Время показания по часам сенсора (None - сейчас)
+            voltage: Напряжение (PRO сенсоры) - голос по порогам с гистерезисом
+
+        Returns:
+            None - сенсор неизвестен
+        """
+        redis = await redis_client.get_connection()
+        if self._ping_script is None:
+            self._ping_script = redis.register_script(CONSENSUS_SCRIPT)
+
+        # Сенсор могут перенести в другую чергу между чтением и скриптом - тогда перечитать
+        for _ in range(3):
+            queue_id = await redis.hget(SENSORS_KEY, sensor_id)
+            if queue_id is None:
+                return None
+
+            pinged_at = now_ms()
+            result = await self._ping_script(
+                keys=[
+                    SENSORS_KEY, QUEUES_KEY, READINGS_KEY, PINGS_KEY, CHANGED_KEY, QUORUM_KEY,
+                    queue_sensors_key(int(queue_id)),
+                ],
+                args=[
+                    sensor_id,
+                    1 if is_power_on else 0,
+                    at_ms or pinged_at,
+                    pinged_at,
+                    voltage if voltage is not None else "",
+                    settings.IOT_VOLTAGE_ON,
+                    settings.IOT_VOLTAGE_OFF,
+                    settings.IOT_STALE_AFTER * 1000,
+                    settings.IOT_MIN_DWELL * 1000,
+                    queue_id,
+                ]
+            )
+            if result != ["moved"]:
+                break
+        else:
+            logger.warning(f"Sensor {sensor_id} keeps moving between queues, ping skipped")
+            return None
+
+        if not result:
+            return None
+
+        queue_id, state, vote, changed, votes, voters, sensors, quorum = result
+        return PingResult(
+            queue_id=int(queue_id),
+            state=(state == "1") if state else None,
+            vote=vote == "1",
+            changed=bool(changed),
+            votes=int(votes),
+            voters=int(voters),
+            sensors=int(sensors),
+            quorum=int(quorum),
+        )
+
+    async def last_ping(self, sensor_id: str) -> Optional[datetime]:
+        """Последний пинг сенсора (свежее iot_sensors.last_ping_at на интервал sync_pings)"""
+        redis = await redis_client.get_connection()
+        pinged_at = await redis.hget(PINGS_KEY, sensor_id)
+        return datetime.fromtimestamp(int(pinged_at) / 1000, tz=timezone.utc) if pinged_at else None
+
+    async def load_queue_state(self, session: AsyncSession, queue_id: int) -> Optional[bool]:
+        """Состояние черги, которой нет в кэше: прочитать из Postgres и закэшировать"""
+        is_power_on = await session.scalar(select(Queue.is_power_on).where(Queue.queue_id == queue_id))
+        if is_power_on is not None:
+            await self.set_queue_state(queue_id, is_power_on)
+        return is_power_on
+
+    async def sync_pings(self) -> int:
+        """
+        Перенести время последних пингов в iot_sensors.last_ping_at
+
+        Один UPDATE на все сенсоры (запускается Celery Beat).
+
+        Returns:
+            int: Сколько сенсоров обновлено
+        """
+        redis = await redis_client.get_connection()
+        pings = await redis.hgetall(PINGS_KEY)
+        if not pings:
+            return 0
+
+        sensor_ids: List[str] = list(pings)
+        pinged_at = [
+            datetime.fromtimestamp(int(pings[sensor_id]) / 1000, tz=timezone.utc) for sensor_id in sensor_ids
+        ]
+
+        async with engine.connect() as conn:
+            raw = await conn.get_raw_connection()
+            status = await raw.driver_connection.execute(SYNC_PINGS_SQL, sensor_ids, pinged_at)
+        return int(status.split()[-1])
+
+    async def stats(self) -> Dict[str, Any]:
+        redis = await redis_client.get_connection()
+        return {
+            "loaded": bool(await redis.exists(LOADED_KEY)),
+            "sensors": await redis.hlen(SENSORS_KEY),
+            "queues": await redis.hlen(QUEUES_KEY),
+        }
+
+
+# Глобальный экземпляр реестра
+iot_registry = IoTRegistry()
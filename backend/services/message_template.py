@@ -0,0 +1,158 @@
+"""
+Message Template
+Шаблон рассылки, скомпилированный один раз на всю рассылку
+"""
+
+import json
+import logging
+from datetime import datetime
+from string import Formatter
+from typing import Dict, List, Optional, Tuple, Union
+
+from services.recipients import Recipient
+
+logger = logging.getLogger(__name__)
+
+
+# Плейсхолдеры, которые зависят от конкретного получателя
+PER_USER_FIELDS = {"first_name", "username", "queue"}
+
+# Сколько разных текстов кэшировать как готовые JSON тела запросов
+BODY_CACHE_SIZE = 4096
+
+_formatter = Formatter()
+
+
+class MessageTemplate:
+    """
+    Шаблон сообщения для массовой рассылки
+
+    При компиляции:
+    - time/date фиксируются на момент запуска рассылки
+    - статические плейсхолдеры подставляются сразу
+    - остаются только сегменты, зависящие от получателя
+
+    Шаблон без персональных полей рендерится ровно один раз,
+    а JSON тело sendMessage (кроме chat_id) сериализуется один раз
+    на каждый уникальный текст.
+    """
+
+    def __init__(
+            self,
+            template: str,
+            queue_id: Optional[int] = None,
+            parse_mode: str = "HTML",
+            disable_notification: bool = False,
+            now: Optional[datetime] = None
+    ):
+        now = now or datetime.now()
+
+        self.template = template
+        self.parse_mode = parse_mode
+        self.disable_notification = disable_notification
+
+        context = {
+            "time": now.strftime("%H:%M"),
+            "date": now.strftime("%d.%m.%Y"),
+        }
+        per_user = set(PER_USER_FIELDS)
+        if queue_id is not None:
+            # Рассылка по одной черге - номер черги общий для всех
+            context["queue"] = queue_id
+            per_user.discard("queue")
+
+        self.segments = self._compile(template, context, per_user)
+        self.is_static = all(isinstance(segment, str) for segment in self.segments)
+        self.static_text = "".join(self.segments) if self.is_static else ""
+
+        self._bodies: Dict[Tuple[str, bool, bool], bytes] = {}
+
+    @staticmethod
+    def _compile(
+            template: str,
+            context: Dict[str, object],
+            per_user: set
+    ) -> List[Union[str, Tuple[str, str, Optional[str]]]]:
+        """Разбить шаблон на статические строки и персональные поля"""
+        segments: List[Union[str, Tuple[str, str, Optional[str]]]] = []
+        buffer = []
+
+        try:
+            for literal, field, spec, conversion in _formatter.parse(template):
+                buffer.append(literal)
+                if field is None:
+                    continue
+
+                if field in per_user:
+                    if buffer:
+                        segments.append("".join(buffer))
+                        buffer = []
+                    segments.append((field, spec or "", conversion))
+                elif field in context:
+                    value = _formatter.convert_field(context[field], conversion)
+                    buffer.append(_formatter.format_field(value, spec or ""))
+                else:
+                    raise KeyError(field)
+        except (KeyError, ValueError, IndexError) as e:
+            logger.warning(f"Missing placeholder {e} in template, using raw template")
+            return [template]
+
+        if buffer:
+            segments.append("".join(buffer))
+
+        return [segment for segment in segments if segment != ""]
+
+    def render(self, recipient: Recipient) -> str:
+        """Текст сообщения для получателя"""
+        if self.is_static:
+            return self.static_text
+
+        values = {
+            "first_name": recipient.first_name or "Користувач",
+            "username": recipient.username or "",
+            "queue": recipient.queue_id or "невідомо",
+        }
+
+        parts = []
+        for segment in self.segments:
+            if isinstance(segment, str):
+                parts.append(segment)
+            else:
+                field, spec, conversion = segment
+                value = _formatter.convert_field(values[field], conversion)
+                parts.append(_formatter.format_field(value, spec))
+        return "".join(parts)
+
+    def body(
+            self,
+            recipient: Recipient,
+            disable_notification: Optional[bool] = None,
+            paid: bool = False
+    ) -> bytes:
+        """
+        Готовое JSON тело запроса sendMessage
+
+        Всё, кроме chat_id, сериализуется один раз на уникальный текст
+        и переиспользуется для всех получателей с таким же текстом.
+        paid - платная рассылка (allow_paid_broadcast).
+        """
+        if disable_notification is None:
+            disable_notification = self.disable_notification
+
+        text = self.render(recipient)
+        cache_key = (text, disable_notification, paid)
+
+        tail = self._bodies.get(cache_key)
+        if tail is None:
+            payload = {
+                "text": text,
+                "parse_mode": self.parse_mode,
+                "disable_notification": disable_notification,
+            }
+            if paid:
+                payload["allow_paid_broadcast"] = True
+            tail = json.dumps(payload, ensure_ascii=False)[1:].encode()
+            if len(self._bodies) < BODY_CACHE_SIZE:
+                self._bodies[cache_key] = tail
+
+        return b'{"chat_id":' + str(recipient.user_id).encode() + b"," + tail
@@ -4,20 +4,370 @@ Notification Service
 """
 
 import asyncio
+import json
 import logging
+import time
 from datetime import datetime
-from typing import List, Dict, Optional, Any
-from sqlalchemy import select, and_, or_
+from typing import (
+    List, Dict, Optional, Any, Awaitable, Callable, Iterable, AsyncIterable, AsyncIterator, Set, Tuple, Union
+)
+from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 import httpx
+from redis.exceptions import RedisError
 
+from celery_app import celery_app
 from models.user import User
-from models.notification import Notification
-from models.queue import Queue
+from services.recipients import Recipient, stream_recipients, FLAG_MULTI_ADDRESS
+from services.recipient_index import recipient_index
+from services.message_template import MessageTemplate
+from services.delivery_journal import DeliveryJournal, DeliveryJournals
+from services.fanout import FanoutProgress, tier_slo_ms
+from services.delivery_checkpoint import DeliveryCheckpoint, dead_letter_queue, is_retryable
+from services.outage_trace import outage_tracer
+from services.quiet_hours import quiet_hours_queue, local_now, in_window, DROPPED_TYPES
+from services.chat_merge import chat_merge_buffer, combine, MERGED_LINES
+from services.rate_limiter import (
+    telegram_rate_limiter, paid_rate_limiter, lane_for, is_paid_broadcast, LANE_BULK, LANE_CRITICAL, LANE_WARNINGS
+)
+from services.telegram_errors import (
+    classify_error, UNREACHABLE_ERRORS, ERROR_RATE_LIMITED, ERROR_CANCELLED, ERROR_OTHER
+)
 from config import settings
 
 logger = logging.getLogger(__name__)
 
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+FLUSH_MERGED_TASK = "tasks.notification_tasks.flush_merged_notifications"
+
+
+class BatchSend:
+    """
+    Одна массовая отправка (NotificationService.send_batch)
+
+    Конвейер: producer читает получателей батчами, отсекает уже обработанных
+    (чекпоинт), откладывает тихий режим и склейку, остальных кладёт
+    в ограниченную очередь; NOTIFICATION_SENDERS корутин sender отправляют
+    из неё, а settle учитывает их результаты порциями по NOTIFICATION_BATCH_SIZE.
+    """
+
+    def __init__(
+            self,
+            service: "NotificationService",
+            message_template: str,
+            notification_type: str,
+            disable_notification: bool = False,
+            queue_id: Optional[int] = None,
+            journal: Optional[DeliveryJournal] = None,
+            progress: Optional[FanoutProgress] = None,
+            dispatched_at: Optional[datetime] = None,
+            checkpoint: Optional[DeliveryCheckpoint] = None
+    ):
+        self.service = service
+        self.notification_type = notification_type
+        self.queue_id = queue_id
+        self.journal = journal
+        self.progress = progress
+        self.checkpoint = checkpoint
+
+        self.lane = lane_for(notification_type)
+        self.version_ms = int((dispatched_at.timestamp() if dispatched_at else time.time()) * 1000)
+        self.mergeable = notification_type in MERGED_LINES
+        self.time_str = (dispatched_at or datetime.now()).strftime("%H:%M")
+        self.template = MessageTemplate(
+            message_template,
+            queue_id=queue_id,
+            disable_notification=disable_notification,
+            now=dispatched_at
+        )
+        if journal and journal.message_text is None:
+            journal.message_text = self.template.static_text or message_template
+
+        self.batch_size = settings.NOTIFICATION_BATCH_SIZE
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=settings.NOTIFICATION_PIPELINE_DEPTH)
+        self.finished: List[Tuple[Recipient, bytes, Dict[str, Any]]] = []
+        self.settle_lock = asyncio.Lock()
+        self.senders: List[asyncio.Task] = []
+
+        self.total = 0
+        self.success = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.deferred = 0
+        self.quiet_skipped = 0
+        self.merged = 0
+        self.skipped = 0
+        self.retrying = 0
+        self.paid_sent = 0
+        self.batch_num = 0
+        self.errors: List[Dict[str, Any]] = []
+        self.error_codes: Dict[str, int] = {}
+        # Задержка доставки по тарифам от запуска рассылки (SLO, см. finalize_fanout)
+        self.tier_stats: Dict[str, Dict[str, int]] = {}
+
+    def is_cancelled(self) -> bool:
+        return bool(self.progress and self.progress.cancelled)
+
+    async def run(self, users: Union[Iterable[Recipient], AsyncIterable[Recipient]]) -> Dict[str, Any]:
+        logger.info(f"Starting batch send, type: {self.notification_type}, lane: {self.lane}")
+
+        # Отмена рассылки (состояние черги изменилось обратно) проверяется фоново
+        watcher = None
+        if self.progress:
+            await self.progress.refresh_cancelled()
+            watcher = asyncio.create_task(self.progress.watch_cancel())
+
+        self.senders = [asyncio.create_task(self.sender()) for _ in range(settings.NOTIFICATION_SENDERS)]
+        workers = [asyncio.create_task(self.producer(users)), *self.senders]
+
+        try:
+            # Ошибка чтения получателей или учёта результатов останавливает весь конвейер
+            await asyncio.gather(*workers)
+            if self.finished:
+                await self.settle(self.finished)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            if watcher:
+                watcher.cancel()
+
+        if self.cancelled or self.is_cancelled():
+            logger.warning(f"Batch send cancelled: {self.cancelled} messages not sent")
+
+        logger.info(
+            f"Batch send completed: {self.total} total, {self.success} success, {self.failed} failed, "
+            f"{self.deferred} deferred, {self.merged} merged, {self.skipped} skipped, "
+            f"{self.retrying} retrying, {self.paid_sent} paid {self.error_codes}"
+        )
+
+        return {
+            "total": self.total,
+            "success": self.success,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+            "deferred": self.deferred,
+            "quiet_skipped": self.quiet_skipped,
+            "merged": self.merged,
+            "skipped": self.skipped,
+            "retrying": self.retrying,
+            "paid": self.paid_sent,
+            "error_codes": self.error_codes,
+            "tier_stats": self.tier_stats,
+            "errors": self.errors
+        }
+
+    async def producer(self, users: Union[Iterable[Recipient], AsyncIterable[Recipient]]):
+        """Читать получателей батчами и ставить в очередь отправки"""
+        async for batch in self.service._iter_batches(users, self.batch_size):
+            if self.is_cancelled():
+                break
+
+            self.batch_num += 1
+            self.total += len(batch)
+
+            logger.info(f"Processing batch {self.batch_num} ({len(batch)} users)")
+
+            # Повтор рассылки: уже обработанные получатели пропускаются
+            if self.checkpoint:
+                done = await self.checkpoint.delivered([user.user_id for user in batch])
+                if done:
+                    self.skipped += len(done)
+                    batch = [user for user in batch if user.user_id not in done]
+
+            # Ограниченная очередь: чтение ждёт, пока отправка не догонит
+            for user in await self.defer(batch):
+                await self.queue.put(user)
+
+        for _ in self.senders:
+            await self.queue.put(None)
+
+    async def defer(self, batch: List[Recipient]) -> List[Recipient]:
+        """
+        Отложить тихий режим (до конца окна получателя) и склейку (services.chat_merge)
+
+        Returns:
+            list: Получатели, которым отправлять сейчас
+        """
+        now = local_now()
+        held = []
+        to_merge = []
+        recipients = []
+        for user in batch:
+            if user.quiet_window and in_window(user.quiet_window, now):
+                if self.notification_type in DROPPED_TYPES:
+                    self.quiet_skipped += 1
+                else:
+                    held.append((user, self.template.body(user)))
+            elif self.mergeable and user.flags & FLAG_MULTI_ADDRESS:
+                to_merge.append(user)
+            else:
+                recipients.append(user)
+
+        settled: List[int] = []
+        if held:
+            try:
+                await quiet_hours_queue.hold_many(
+                    held, self.notification_type, self.queue_id, now, self.version_ms
+                )
+                self.deferred += len(held)
+                settled.extend(user.user_id for user, _ in held)
+            except RedisError as e:
+                # Лучше разбудить, чем не сообщить об отключении
+                logger.error(f"Quiet hours queue unavailable, sending {len(held)} held now: {e}")
+                recipients.extend(user for user, _ in held)
+        if to_merge:
+            try:
+                # Склеивать есть с чем, только если другая черга чата ещё в пути
+                hold = await chat_merge_buffer.select_held([user.user_id for user in to_merge], self.queue_id)
+                recipients.extend(user for user in to_merge if user.user_id not in hold)
+                to_merge = [user for user in to_merge if user.user_id in hold]
+                if to_merge:
+                    release_at = await chat_merge_buffer.hold_many(
+                        [(user, self.template.body(user)) for user in to_merge],
+                        self.notification_type, self.queue_id, self.time_str, self.version_ms
+                    )
+                    celery_app.send_task(FLUSH_MERGED_TASK, countdown=max(0.0, release_at - time.time()))
+                    self.merged += len(to_merge)
+                    settled.extend(user.user_id for user in to_merge)
+            except RedisError as e:
+                logger.error(f"Chat merge buffer unavailable, sending {len(to_merge)} separately: {e}")
+                recipients.extend(to_merge)
+        if self.checkpoint:
+            await self.checkpoint.mark(settled)
+
+        return recipients
+
+    async def sender(self):
+        """Забирать получателей из очереди и отправлять, пока не придёт None"""
+        while True:
+            user = await self.queue.get()
+            if user is None:
+                return
+
+            paid = is_paid_broadcast(self.notification_type, user.tier)
+            body = self.template.body(user, paid=paid)
+            if self.is_cancelled():
+                result = {"success": False, "error": "Fanout cancelled", "error_code": ERROR_CANCELLED}
+            else:
+                try:
+                    result = await self.service._send_body(
+                        user.user_id, body, self.lane,
+                        self.is_cancelled if self.progress else None, paid=paid
+                    )
+                except Exception as e:
+                    result = {"success": False, "error": str(e), "error_code": ERROR_OTHER}
+            if paid:
+                result["paid"] = True
+            self.finished.append((user, body, result))
+
+            # Результаты учитываются порциями по batch_size; остальные
+            # корутины в это время продолжают отправку
+            if len(self.finished) >= self.batch_size:
+                done, self.finished = self.finished, []
+                async with self.settle_lock:
+                    await self.settle(done)
+
+    async def settle(self, done: List[Tuple[Recipient, bytes, Dict[str, Any]]]):
+        """Учесть результаты отправки: dead-letter, журнал, чекпоинт, прогресс"""
+        retry_idx = await self.dead_letter(done)
+
+        # Получатели, которых повтор рассылки уже не должен трогать
+        settled: List[int] = []
+        chunk_success = 0
+        chunk_failed = 0
+        first_sent_ms = None
+        last_sent_ms = None
+        for idx, (user, _, result) in enumerate(done):
+            # Не отправлено из-за отмены - не доставка и не ошибка
+            if result.get("error_code") == ERROR_CANCELLED:
+                self.cancelled += 1
+                continue
+
+            settled.append(user.user_id)
+            if idx in retry_idx:
+                continue
+
+            if self.journal:
+                await self.journal.record(user, result)
+
+            if result.get("success"):
+                chunk_success += 1
+                if result.get("paid"):
+                    self.paid_sent += 1
+                sent_at_ms = result.get("sent_at_ms")
+                if sent_at_ms:
+                    first_sent_ms = min(first_sent_ms or sent_at_ms, sent_at_ms)
+                    last_sent_ms = max(last_sent_ms or sent_at_ms, sent_at_ms)
+                    self.record_delay(user.tier, sent_at_ms)
+                continue
+
+            chunk_failed += 1
+            error_code = result.get("error_code", ERROR_OTHER)
+            self.error_codes[error_code] = self.error_codes.get(error_code, 0) + 1
+
+            # Храним только первые 10 ошибок
+            if len(self.errors) < 10:
+                self.errors.append({
+                    "user_id": user.user_id,
+                    "error": result.get("error", "Unknown error")
+                })
+
+        self.success += chunk_success
+        self.failed += chunk_failed
+        if self.checkpoint:
+            await self.checkpoint.mark(settled)
+        if self.progress:
+            await self.progress.add(chunk_success, chunk_failed)
+            await outage_tracer.record_sends(self.progress.trace_id, first_sent_ms, last_sent_ms)
+
+    async def dead_letter(self, done: List[Tuple[Recipient, bytes, Dict[str, Any]]]) -> Set[int]:
+        """
+        Временные ошибки - в dead-letter, повтор по одному получателю
+
+        Returns:
+            set: Индексы в done, переданные в dead-letter
+        """
+        if not self.checkpoint:
+            return set()
+
+        retry = [idx for idx, (_, _, result) in enumerate(done) if is_retryable(result)]
+        try:
+            await dead_letter_queue.add_many([
+                {
+                    "fanout_id": self.checkpoint.fanout_id,
+                    "user_id": done[idx][0].user_id,
+                    "type": self.notification_type,
+                    "queue_id": done[idx][0].queue_id or self.queue_id,
+                    "lane": self.lane,
+                    "body": done[idx][1].decode(),
+                    "paid": bool(done[idx][2].get("paid")),
+                    "attempt": 1,
+                }
+                for idx in retry
+            ])
+        except RedisError as e:
+            logger.error(f"Dead-letter queue unavailable, {len(retry)} failures are final: {e}")
+            return set()
+
+        self.retrying += len(retry)
+        return set(retry)
+
+    def record_delay(self, tier: str, sent_at_ms: int):
+        """Задержка доставки от запуска рассылки в статистику тарифа"""
+        delay_ms = max(0, sent_at_ms - self.version_ms)
+        stats = self.tier_stats.get(tier)
+        if stats is None:
+            stats = self.tier_stats[tier] = {
+                "sent": 0, "within_slo": 0, "delay_sum_ms": 0, "max_delay_ms": 0
+            }
+        stats["sent"] += 1
+        stats["delay_sum_ms"] += delay_ms
+        stats["max_delay_ms"] = max(stats["max_delay_ms"], delay_ms)
+        slo_ms = tier_slo_ms(tier)
+        if slo_ms is None or delay_ms <= slo_ms:
+            stats["within_slo"] += 1
+
 
 class NotificationService:
     """
@@ -26,8 +376,40 @@ class NotificationService:
 
     def __init__(self):
         self.bot_token = settings.TELEGRAM_BOT_TOKEN
-        self.base_url = f"https://api.telegram.org/bot{self.bot_token}"
-        self.rate_limit = settings.TELEGRAM_RATE_LIMIT  # 30 msg/sec
+        self.base_url = f"{settings.TELEGRAM_API_URL}/bot{self.bot_token}"
+        self.rate_limiter = telegram_rate_limiter  # 30 msg/sec на весь кластер
+        self.paid_rate_limiter = paid_rate_limiter  # allow_paid_broadcast, свой бюджет
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """
+        Долгоживущий HTTP клиент к Bot API (один на процесс воркера)
+
+        Создаётся лениво при первой отправке и переиспользует
+        keep-alive соединения (HTTP/2 мультиплексирование) между сообщениями.
+        """
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                http2=settings.TELEGRAM_HTTP2,
+                limits=httpx.Limits(
+                    max_connections=settings.TELEGRAM_MAX_CONNECTIONS,
+                    max_keepalive_connections=settings.TELEGRAM_MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=settings.TELEGRAM_KEEPALIVE_EXPIRY
+                ),
+                timeout=httpx.Timeout(
+                    settings.TELEGRAM_READ_TIMEOUT,
+                    connect=settings.TELEGRAM_CONNECT_TIMEOUT
+                )
+            )
+        return self._client
+
+    async def close(self):
+        """Закрыть HTTP клиент (при остановке воркера)"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            logger.info("Telegram HTTP client closed")
 
     async def send_message(
             self,
@@ -35,6 +417,7 @@ class NotificationService:
             text: str,
             parse_mode: str = "HTML",
             disable_notification: bool = False,
+            lane: str = LANE_BULK,
             **kwargs
     ) -> Dict[str, Any]:
         """
@@ -45,13 +428,12 @@ class NotificationService:
             text: Текст сообщения
             parse_mode: Режим парсинга (HTML, Markdown)
             disable_notification: Тихое уведомление
+            lane: Полоса приоритета rate limit
             **kwargs: Дополнительные параметры (reply_markup, etc.)
 
         Returns:
             dict: Результат отправки
         """
-        url = f"{self.base_url}/sendMessage"
-
         payload = {
             "chat_id": user_id,
             "text": text,
@@ -60,111 +442,186 @@ class NotificationService:
             **kwargs
         }
 
+        return await self._send_body(user_id, json.dumps(payload, ensure_ascii=False).encode(), lane)
+
+    async def _send_body(
+            self,
+            user_id: int,
+            body: bytes,
+            lane: str = LANE_BULK,
+            is_cancelled: Optional[Callable[[], bool]] = None,
+            paid: bool = False
+    ) -> Dict[str, Any]:
+        """
+        Отправить готовое JSON тело sendMessage (с rate limit и повтором после 429)
+
+        Args:
+            user_id: Telegram ID пользователя (chat_id внутри body)
+            body: Сериализованный JSON запроса
+            lane: Полоса приоритета rate limit
+            is_cancelled: Проверка отмены рассылки (после ожидания rate limit)
+            paid: Платная рассылка (body с allow_paid_broadcast, бюджет paid_rate_limiter)
+
+        Returns:
+            dict: Результат отправки
+        """
+        url = f"{self.base_url}/sendMessage"
+        rate_limiter = self.paid_rate_limiter if paid else self.rate_limiter
+
         try:
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                response = await client.post(url, json=payload)
-                response.raise_for_status()
+            for attempt in range(settings.NOTIFICATION_RETRY_ATTEMPTS):
+                # Глобальный rate limit (общий для всех воркеров) + лимит чата
+                if rate_limiter:
+                    await rate_limiter.acquire(user_id, lane)
+
+                # Пока ждали токен, рассылку могли отменить
+                if is_cancelled and is_cancelled():
+                    return {"success": False, "error": "Fanout cancelled", "error_code": ERROR_CANCELLED}
+
+                started = time.perf_counter()
+                response = await self.client.post(url, content=body, headers=JSON_HEADERS)
+                latency_ms = int((time.perf_counter() - started) * 1000)
+
+                # Flood control: ставим на паузу весь bucket и повторяем
+                if response.status_code == 429:
+                    retry_after = response.json().get("parameters", {}).get("retry_after", 1)
+                    logger.warning(f"429 for {user_id}, retry after {retry_after}s")
+                    if rate_limiter:
+                        await rate_limiter.pause(retry_after)
+                    else:
+                        await asyncio.sleep(retry_after)
+                    continue
+
+                # 4xx приходят с JSON описанием ошибки, 5xx - сбой на стороне Telegram
+                if response.status_code >= 500:
+                    response.raise_for_status()
 
                 result = response.json()
 
                 if result.get("ok"):
                     logger.info(f"Message sent to {user_id}")
-                    return {"success": True, "message_id": result["result"]["message_id"]}
+                    return {
+                        "success": True,
+                        "message_id": result["result"]["message_id"],
+                        "latency_ms": latency_ms,
+                        "sent_at_ms": int(time.time() * 1000)
+                    }
+
+                error_code = classify_error(
+                    result.get("error_code", response.status_code),
+                    result.get("description")
+                )
+                if error_code in UNREACHABLE_ERRORS:
+                    logger.info(f"User {user_id} is unreachable ({error_code})")
                 else:
                     logger.error(f"Failed to send message to {user_id}: {result}")
-                    return {"success": False, "error": result.get("description")}
+
+                return {
+                    "success": False,
+                    "error": result.get("description"),
+                    "error_code": error_code,
+                    "latency_ms": latency_ms
+                }
+
+            return {
+                "success": False,
+                "error": "Too Many Requests: retry attempts exhausted",
+                "error_code": ERROR_RATE_LIMITED
+            }
 
         except httpx.HTTPError as e:
             logger.error(f"HTTP error sending message to {user_id}: {e}")
-            return {"success": False, "error": str(e)}
+            return {"success": False, "error": str(e), "error_code": ERROR_OTHER}
         except Exception as e:
             logger.error(f"Error sending message to {user_id}: {e}")
-            return {"success": False, "error": str(e)}
+            return {"success": False, "error": str(e), "error_code": ERROR_OTHER}
 
     async def send_batch(
             self,
-            users: List[User],
+            users: Union[Iterable[Recipient], AsyncIterable[Recipient]],
             message_template: str,
             notification_type: str,
-            disable_notification: bool = False
+            disable_notification: bool = False,
+            queue_id: Optional[int] = None,
+            journal: Optional[DeliveryJournal] = None,
+            progress: Optional[FanoutProgress] = None,
+            dispatched_at: Optional[datetime] = None,
+            checkpoint: Optional[DeliveryCheckpoint] = None
     ) -> Dict[str, Any]:
         """
         Массовая отправка сообщений батчами с соблюдением rate limit
 
+        Темп задаёт общий token bucket (см. services.rate_limiter):
+        каждое сообщение ждёт свой токен, без всплесков и пауз между батчами.
+        Отправка - конвейер: получатели идут через ограниченную очередь
+        (NOTIFICATION_PIPELINE_DEPTH) к NOTIFICATION_SENDERS корутинам,
+        поэтому число открытых запросов и память постоянны, а медленный
+        ответ задерживает только свою корутину, а не весь батч.
+        Полоса приоритета определяется типом уведомления: power_on/off
+        забирают бюджет у идущих массовых рассылок. Типы и тарифы из
+        TELEGRAM_PAID_BROADCAST_* уходят платной рассылкой со своим бюджетом
+        (до TELEGRAM_PAID_RATE_LIMIT msg/sec), число платных сообщений в paid.
+        Получатели читаются из итератора порциями, весь список в память не грузится.
+        Шаблон компилируется один раз (время фиксируется на момент запуска).
+        Получателям в тихом режиме сообщение не отправляется, а откладывается
+        до конца их окна (services.quiet_hours); предупреждения во время окна пропускаются.
+        power_on/off для пользователей с несколькими адресами, у которых другая
+        черга ещё ждёт debounce или рассылается, ждут окно склейки и склеиваются
+        с её переходом в одно сообщение (services.chat_merge).
+        С чекпоинтом уже обработанные получатели пропускаются (повтор рассылки),
+        а временные ошибки уходят в dead-letter на повтор по одному получателю.
+
         Args:
-            users: Список пользователей
+            users: Получатели (список или async итератор, например stream_recipients)
             message_template: Шаблон сообщения (может содержать {placeholders})
             notification_type: Тип уведомления (power_on, power_off, warning, etc.)
             disable_notification: Тихое уведомление
+            queue_id: Черга рассылки ({queue} общий для всех получателей)
+            journal: Журнал доставки (результат по каждому получателю,
+                недостижимые получатели помечаются в users)
+            progress: Live-прогресс шардированной рассылки (обновляется после каждого батча;
+                при отмене рассылки оставшиеся сообщения не отправляются)
+            dispatched_at: Время запуска рассылки ({time}/{date} одинаковые во всех шардах)
+            checkpoint: Чекпоинт рассылки (services.delivery_checkpoint)
 
         Returns:
             dict: Статистика отправки
         """
-        total = len(users)
-        success = 0
-        failed = 0
-        errors = []
-
-        logger.info(f"Starting batch send to {total} users, type: {notification_type}")
-
-        # Разбиваем на батчи
-        batch_size = settings.NOTIFICATION_BATCH_SIZE
-
-        for i in range(0, total, batch_size):
-            batch = users[i:i + batch_size]
-            batch_num = i // batch_size + 1
-            total_batches = (total + batch_size - 1) // batch_size
-
-            logger.info(f"Processing batch {batch_num}/{total_batches} ({len(batch)} users)")
-
-            # Создаём задачи для параллельной отправки
-            tasks = []
-            for user in batch:
-                # Форматируем сообщение под конкретного пользователя
-                message = self._format_message(message_template, user)
-
-                # Создаём задачу отправки
-                task = self.send_message(
-                    user_id=user.user_id,
-                    text=message,
-                    disable_notification=disable_notification
-                )
-                tasks.append(task)
-
-            # Отправляем батч параллельно
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-
-            # Подсчитываем результаты
-            for idx, result in enumerate(results):
-                if isinstance(result, Exception):
-                    failed += 1
-                    errors.append({
-                        "user_id": batch[idx].user_id,
-                        "error": str(result)
-                    })
-                elif result.get("success"):
-                    success += 1
-                else:
-                    failed += 1
-                    errors.append({
-                        "user_id": batch[idx].user_id,
-                        "error": result.get("error", "Unknown error")
-                    })
-
-            # Rate limiting: 30 msg/sec = задержка между батчами
-            if i + batch_size < total:
-                delay = len(batch) / self.rate_limit
-                logger.info(f"Rate limit delay: {delay:.2f}s")
-                await asyncio.sleep(delay)
-
-        logger.info(f"Batch send completed: {success} success, {failed} failed")
-
-        return {
-            "total": total,
-            "success": success,
-            "failed": failed,
-            "errors": errors[:10]  # Возвращаем только первые 10 ошибок
-        }
+        return await BatchSend(
+            self,
+            message_template,
+            notification_type,
+            disable_notification=disable_notification,
+            queue_id=queue_id,
+            journal=journal,
+            progress=progress,
+            dispatched_at=dispatched_at,
+            checkpoint=checkpoint
+        ).run(users)
+
+    @staticmethod
+    async def _iter_batches(
+            users: Union[Iterable[Recipient], AsyncIterable[Recipient]],
+            batch_size: int
+    ) -> AsyncIterator[List[Recipient]]:
+        """Нарезать синхронный или асинхронный поток получателей на батчи"""
+        batch = []
+
+        if hasattr(users, "__aiter__"):
+            async for user in users:
+                batch.append(user)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+        else:
+            for user in users:
+                batch.append(user)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+
+        if batch:
+            yield batch
 
     async def send_queue_notification(
             self,
@@ -173,10 +630,14 @@ class NotificationService:
             notification_type: str,
             message_template: str,
             disable_notification: bool = False,
-            tier_filter: Optional[List[str]] = None
+            tier_filter: Optional[List[str]] = None,
+            id_range: Optional[Tuple[int, int]] = None,
+            progress: Optional[FanoutProgress] = None,
+            dispatched_at: Optional[datetime] = None,
+            required_flags: int = 0
     ) -> Dict[str, Any]:
         """
-        Отправка уведомления всем пользователям очереди
+        Отправка уведомления всем пользователям очереди (или одному шарду черги)
 
         Args:
             session: Database session
@@ -185,146 +646,300 @@ class NotificationService:
             message_template: Шаблон сообщения
             disable_notification: Тихое уведомление
             tier_filter: Фильтр по тарифам (например, ["STANDARD", "PRO"])
+            id_range: Диапазон chat ID [from, to) шарда (см. services.fanout)
+            progress: Live-прогресс рассылки
+            dispatched_at: Время запуска рассылки
+            required_flags: Флаги, которые должны быть у получателя
+                (например, warning_flag - предупреждение за N минут)
 
         Returns:
             dict: Статистика отправки
         """
         logger.info(f"Sending notification to queue {queue_id}, type: {notification_type}")
 
-        # Получаем пользователей очереди
-        users = await self._get_queue_users(
-            session,
-            queue_id,
-            notification_type,
-            tier_filter
-        )
+        # Получатели читаются потоком прямо в отправку:
+        # из индекса в Redis, если он построен, иначе из Postgres
+        if await recipient_index.is_ready():
+            recipients = recipient_index.iter_recipients(
+                queue_id,
+                notification_type,
+                tier_filter=tier_filter,
+                id_range=id_range,
+                required_flags=required_flags
+            )
+        else:
+            recipients = stream_recipients(
+                session,
+                queue_id=queue_id,
+                notification_type=notification_type,
+                tier_filter=tier_filter,
+                id_range=id_range,
+                required_flags=required_flags
+            )
+
+        # Результат по каждому получателю пишется в notifications (COPY пачками)
+        journal = DeliveryJournal(notification_type, queue_id=queue_id)
 
-        if not users:
+        try:
+            result = await self.send_batch(
+                users=recipients,
+                message_template=message_template,
+                notification_type=notification_type,
+                disable_notification=disable_notification,
+                queue_id=queue_id,
+                journal=journal,
+                progress=progress,
+                dispatched_at=dispatched_at,
+                checkpoint=DeliveryCheckpoint(progress.fanout_id) if progress else None
+            )
+        finally:
+            await journal.close()
+
+        if not result["total"]:
             logger.warning(f"No users found for queue {queue_id}")
-            return {
-                "total": 0,
-                "success": 0,
-                "failed": 0,
-                "errors": []
-            }
-
-        # Сохраняем уведомление в БД
-        notification = Notification(
-            queue_id=queue_id,
-            notification_type=notification_type,
-            message=message_template,
-            sent_at=datetime.utcnow()
-        )
-        session.add(notification)
-        await session.commit()
-
-        # Отправляем батчами
-        result = await self.send_batch(
-            users=users,
-            message_template=message_template,
-            notification_type=notification_type,
-            disable_notification=disable_notification
-        )
-
-        # Обновляем статистику уведомления
-        notification.users_sent = result["success"]
-        notification.users_failed = result["failed"]
-        await session.commit()
 
         return result
 
-    async def _get_queue_users(
-            self,
-            session: AsyncSession,
-            queue_id: int,
-            notification_type: str,
-            tier_filter: Optional[List[str]] = None
-    ) -> List[User]:
+    async def release_deferred(self, limit: Optional[int] = None) -> Dict[str, Any]:
         """
-        Получить список пользователей очереди с фильтрацией
+        Выдать одну волну сообщений, отложенных тихим режимом
+
+        Сообщения уходят со звуком (окно уже закончилось) в полосе bulk:
+        live-рассылки power_on/off их вытесняют.
 
         Args:
-            session: Database session
-            queue_id: ID очереди
-            notification_type: Тип уведомления (для проверки настроек)
-            tier_filter: Фильтр по тарифам
+            limit: Размер волны (по умолчанию QUIET_RELEASE_WAVE_SIZE)
 
         Returns:
-            List[User]: Список пользователей
+            dict: Статистика волны (total = 0 - выдавать нечего)
         """
-        # Базовый запрос
-        query = select(User).where(
-            User.primary_queue_id == queue_id,
-            User.is_active == True,
-            User.is_bot_blocked == False
-        )
+        items = await quiet_hours_queue.lease_due(limit or settings.QUIET_RELEASE_WAVE_SIZE)
+
+        # Исход известен - удалить из очереди; упавшие с исключением остаются
+        # в аренде и выдадутся снова через QUIET_RELEASE_LEASE секунд
+        done: List[Dict[str, Any]] = []
+        retry: List[Dict[str, Any]] = []
+        letters: List[Dict[str, Any]] = []
+
+        async def release(item: Dict[str, Any], journals: DeliveryJournals):
+            payload = json.loads(item["body"])
+            payload["disable_notification"] = False
+            body = json.dumps(payload, ensure_ascii=False)
+            result = await self._send_body(item["user_id"], body.encode(), LANE_BULK)
+
+            # Временная ошибка - в dead-letter, как у рассылки (в журнал - после повторов)
+            if is_retryable(result):
+                retry.append(item)
+                letters.append({
+                    "fanout_id": f"quiet:{item['member']}",
+                    "user_id": item["user_id"],
+                    "type": item["type"],
+                    "queue_id": item["queue_id"],
+                    "lane": LANE_BULK,
+                    "body": body,
+                    "attempt": 1,
+                })
+                return result
+
+            done.append(item)
+            await journals.record(item["user_id"], item["type"], item["queue_id"], payload.get("text"), result)
+            return result
+
+        results = await self._resend(items, release)
+
+        if await self._dead_letter(letters):
+            done.extend(retry)
+        try:
+            await quiet_hours_queue.ack(done)
+        except RedisError as e:
+            logger.warning(f"Failed to ack {len(done)} released quiet hours messages: {e}")
 
-        # Фильтр по тарифам
-        if tier_filter:
-            query = query.where(User.subscription_tier.in_(tier_filter))
+        success = sum(1 for result in results if not isinstance(result, BaseException) and result.get("success"))
+        failed = len(results) - success
 
-        result = await session.execute(query)
-        users = result.scalars().all()
+        if items:
+            logger.info(
+                f"Quiet hours wave released: {len(items)} total, {success} sent, "
+                f"{failed} failed, {len(retry)} retrying"
+            )
 
-        # Дополнительная фильтрация по настройкам уведомлений
-        filtered_users = []
-        for user in users:
-            if self._can_receive_notification(user, notification_type):
-                filtered_users.append(user)
+        return {"total": len(items), "success": success, "failed": failed, "retrying": len(retry)}
 
-        return filtered_users
+    async def flush_merged(self, limit: int = 1000) -> Dict[str, Any]:
+        """
+        Отправить склеенные сообщения чатов, окно склейки которых закончилось
+
+        Returns:
+            dict: Статистика (chats - сообщений, entries - исходных уведомлений в них)
+        """
+        chats = await chat_merge_buffer.lease_due(limit)
+
+        # Исход известен - удалить из буфера; упавшие с исключением остаются
+        # в аренде и отправятся снова через CHAT_MERGE_LEASE секунд
+        done: List[Tuple[int, List[Dict[str, Any]]]] = []
+        retry: List[Tuple[int, List[Dict[str, Any]]]] = []
+        letters: List[Dict[str, Any]] = []
+        fanout_id = f"merge:{int(time.time() * 1000)}"
+
+        async def flush(chat: Tuple[int, List[Dict[str, Any]]], journals: DeliveryJournals):
+            user_id, entries = chat
+            body = combine(entries)
+            result = await self._send_body(user_id, body, LANE_CRITICAL)
+
+            # В журнал - строка на каждую чергу, как при отдельных сообщениях
+            journal = [[entry["type"], entry["queue_id"], json.loads(entry["body"]).get("text")] for entry in entries]
+
+            # Временная ошибка - склеенное сообщение в dead-letter (в журнал - после повторов)
+            if is_retryable(result):
+                retry.append(chat)
+                letters.append({
+                    "fanout_id": fanout_id,
+                    "user_id": user_id,
+                    "type": entries[0]["type"],
+                    "queue_id": entries[0]["queue_id"],
+                    "lane": LANE_CRITICAL,
+                    "body": body.decode(),
+                    "attempt": 1,
+                    "journal": journal,
+                })
+                return result
+
+            done.append(chat)
+            for notification_type, queue_id, text in journal:
+                await journals.record(user_id, notification_type, queue_id, text, result)
+            return result
+
+        results = await self._resend(chats, flush)
+
+        if await self._dead_letter(letters):
+            done.extend(retry)
+        try:
+            await chat_merge_buffer.ack(done)
+        except RedisError as e:
+            logger.warning(f"Failed to ack {len(done)} merged chats: {e}")
+
+        success = sum(1 for result in results if not isinstance(result, BaseException) and result.get("success"))
+        entries_total = sum(len(entries) for _, entries in chats)
+
+        if chats:
+            logger.info(
+                f"Merged notifications flushed: {entries_total} notifications "
+                f"in {len(chats)} messages, {success} sent, {len(retry)} retrying"
+            )
+
+        return {
+            "chats": len(chats),
+            "entries": entries_total,
+            "success": success,
+            "failed": len(chats) - success,
+            "retrying": len(retry)
+        }
 
-    def _can_receive_notification(self, user: User, notification_type: str) -> bool:
+    async def retry_dead_letters(self, limit: Optional[int] = None) -> Dict[str, Any]:
         """
-        Проверить, может ли пользователь получить уведомление данного типа
+        Повторить отправку получателям из dead-letter, время попытки которых наступило
+
+        Сообщения отменённой рассылки (состояние черги уже изменилось обратно)
+        не отправляются. Временная ошибка - следующая попытка с удвоенной паузой,
+        после DEAD_LETTER_MAX_ATTEMPTS попыток ошибка окончательная.
 
         Args:
-            user: Пользователь
-            notification_type: Тип уведомления
+            limit: Сообщений за вызов (по умолчанию DEAD_LETTER_BATCH_SIZE)
 
         Returns:
-            bool: Может ли получить уведомление
+            dict: Статистика (total = 0 - повторять нечего)
         """
-        settings = user.notification_settings or {}
-
-        # Проверяем настройки для конкретного типа
-        if notification_type == "power_off":
-            return settings.get("power_off_enabled", True)
-        elif notification_type == "power_on":
-            return settings.get("power_on_enabled", True)
-        elif notification_type == "warning":
-            return settings.get("warnings_enabled", False) and user.subscription_tier in ["STANDARD", "PRO"]
-        elif notification_type == "schedule":
-            return settings.get("schedule_enabled", False) and user.subscription_tier == "PRO"
-
-        # По умолчанию разрешаем
-        return True
+        items = await dead_letter_queue.lease_due(limit or settings.DEAD_LETTER_BATCH_SIZE)
+
+        cancelled_fanouts = set()
+        for fanout_id in {item["fanout_id"] for item in items}:
+            if await FanoutProgress(fanout_id).refresh_cancelled():
+                cancelled_fanouts.add(fanout_id)
+
+        again: List[Dict[str, Any]] = []
+        # Исход известен - удалить из очереди; упавшие с исключением остаются
+        # в аренде и вернутся через DEAD_LETTER_LEASE секунд
+        done: List[Dict[str, Any]] = [item for item in items if item["fanout_id"] in cancelled_fanouts]
+
+        async def retry(item: Dict[str, Any], journals: DeliveryJournals):
+            result = await self._send_body(
+                item["user_id"], item["body"].encode(), item["lane"], paid=item.get("paid", False)
+            )
+
+            if is_retryable(result) and item["attempt"] < settings.DEAD_LETTER_MAX_ATTEMPTS:
+                again.append({**item, "attempt": item["attempt"] + 1})
+                return result
+
+            done.append(item)
+            # Склеенное сообщение (services.chat_merge) - строка журнала на каждую чергу
+            journal = item.get("journal") or [[item["type"], item["queue_id"], json.loads(item["body"]).get("text")]]
+            for notification_type, queue_id, text in journal:
+                await journals.record(item["user_id"], notification_type, queue_id, text, result)
+            return result
+
+        results = await self._resend(
+            [item for item in items if item["fanout_id"] not in cancelled_fanouts], retry
+        )
 
-    def _format_message(self, template: str, user: User) -> str:
-        """
-        Форматировать сообщение под конкретного пользователя
+        # add_many перезаписывает арендованные сообщения новым временем попытки;
+        # при сбое Redis они повторятся после аренды с прежним номером попытки
+        try:
+            await dead_letter_queue.add_many(again)
+        except RedisError as e:
+            logger.warning(f"Failed to reschedule {len(again)} dead letters: {e}")
+        try:
+            await dead_letter_queue.ack(done)
+        except RedisError as e:
+            logger.warning(f"Failed to ack {len(done)} dead letters: {e}")
 
-        Args:
-            template: Шаблон сообщения
-            user: Пользователь
+        success = sum(1 for result in results if not isinstance(result, BaseException) and result.get("success"))
+        dropped = len(items) - len(results)
+
+        if items:
+            logger.info(
+                f"Dead letters retried: {len(results)} sent, {success} delivered, "
+                f"{len(again)} rescheduled, {dropped} dropped (fanout cancelled)"
+            )
+
+        return {
+            "total": len(items),
+            "success": success,
+            "failed": len(results) - success - len(again),
+            "rescheduled": len(again),
+            "dropped": dropped
+        }
+
+    @staticmethod
+    async def _dead_letter(letters: List[Dict[str, Any]]) -> bool:
+        """
+        Передать временные ошибки повторной отправки в dead-letter
 
         Returns:
-            str: Отформатированное сообщение
+            bool: Переданы (False - Redis недоступен, сообщения остаются в аренде источника)
         """
         try:
-            # Доступные плейсхолдеры
-            placeholders = {
-                "first_name": user.first_name or "Користувач",
-                "username": user.username or "",
-                "queue": user.primary_queue_id or "невідомо",
-                "time": datetime.now().strftime("%H:%M"),
-                "date": datetime.now().strftime("%d.%m.%Y"),
-            }
+            await dead_letter_queue.add_many(letters)
+        except RedisError as e:
+            logger.error(f"Dead-letter queue unavailable, {len(letters)} failures stay leased: {e}")
+            return False
+        return True
 
-            return template.format(**placeholders)
-        except KeyError as e:
-            logger.warning(f"Missing placeholder {e} in template, using raw template")
-            return template
+    @staticmethod
+    async def _resend(
+            items: List[Any],
+            send: Callable[[Any, DeliveryJournals], Awaitable[Dict[str, Any]]]
+    ) -> List[Union[Dict[str, Any], BaseException]]:
+        """
+        Повторная отправка вне рассылки: все сообщения параллельно, темп задаёт rate limiter
+
+        send отправляет одно сообщение и пишет результат в общие журналы;
+        исключение одного сообщения не прерывает остальные.
+        """
+        journals = DeliveryJournals()
+        try:
+            return await asyncio.gather(*(send(item, journals) for item in items), return_exceptions=True)
+        finally:
+            await journals.close()
 
     async def send_warning_notification(
             self,
@@ -366,7 +981,7 @@ class NotificationService:
         )
 
         # Отправляем
-        return await self.send_message(user_id, message)
+        return await self.send_message(user_id, message, lane=LANE_WARNINGS)
 
 
 # Глобальный экземпляр сервиса
@@ -0,0 +1,305 @@
+"""
+Outage Trace
+Сквозная трассировка события отключения: от первого сигнала сенсора до последней отправки
+"""
+
+import logging
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+from redis.exceptions import RedisError
+
+from redis_client import redis_client
+
+logger = logging.getLogger(__name__)
+
+
+# Этапы в порядке прохождения события
+STAGE_SENSOR_FLIP = "sensor_flip"  # первый сенсор сообщил новое состояние
+STAGE_CONSENSUS = "consensus"  # изменение подтверждено
+STAGE_STATUS_COMMIT = "status_commit"  # статус черги записан в БД
+STAGE_TASK_ENQUEUE = "task_enqueue"  # задача рассылки поставлена в очередь
+STAGE_TASK_START = "task_start"  # задача начала выполнение (после debounce)
+STAGE_RECIPIENTS_RESOLVED = "recipients_resolved"  # получатели посчитаны, шарды запущены
+STAGE_FIRST_SEND = "first_send"  # первое доставленное сообщение
+STAGE_LAST_SEND = "last_send"  # последнее доставленное сообщение
+
+STAGES = (
+    STAGE_SENSOR_FLIP,
+    STAGE_CONSENSUS,
+    STAGE_STATUS_COMMIT,
+    STAGE_TASK_ENQUEUE,
+    STAGE_TASK_START,
+    STAGE_RECIPIENTS_RESOLVED,
+    STAGE_FIRST_SEND,
+    STAGE_LAST_SEND,
+)
+
+# Итоговые метрики (кроме интервалов между соседними этапами)
+METRIC_DETECT_TO_FIRST_SEND = "detect_to_first_send"
+METRIC_DETECT_TO_DELIVER = "detect_to_deliver"
+TOTAL_METRICS = (METRIC_DETECT_TO_FIRST_SEND, METRIC_DETECT_TO_DELIVER)
+
+TRACE_TTL = 7 * 24 * 3600  # трасса хранится неделю
+OPEN_EVENT_TTL = 15 * 60  # неподтверждённый сигнал сенсора "забывается" через 15 минут
+SAMPLES_PER_METRIC = 1000  # последних замеров на метрику черги
+PERCENTILES = (50, 95, 99)
+
+# KEYS[1] - HASH трассы, ARGV[1] - этап, ARGV[2] - время (мс), ARGV[3] - режим, ARGV[4] - TTL
+# Режимы: first - только первое значение, min / max - для отправок из параллельных шардов
+MARK_SCRIPT = """
+local current = tonumber(redis.call('HGET', KEYS[1], ARGV[1]))
+local value = tonumber(ARGV[2])
+if current == nil
+        or (ARGV[3] == 'min' and value < current)
+        or (ARGV[3] == 'max' and value > current) then
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return 1
+"""
+
+
+def now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+def trace_key(event_id: str) -> str:
+    return f"trace:outage:{event_id}"
+
+
+def open_event_key(queue_id: int, is_power_on: bool) -> str:
+    return f"trace:queue:{queue_id}:open:{'on' if is_power_on else 'off'}"
+
+
+def samples_key(queue_id: int, metric: str) -> str:
+    return f"metrics:latency:{queue_id}:{metric}"
+
+
+def metric_names_key(queue_id: int) -> str:
+    """SET метрик, в которые писались замеры черги (включая интервалы через пропущенные этапы)"""
+    return f"metrics:latency:{queue_id}:names"
+
+
+def metric_order(metric: str) -> tuple:
+    """Интервалы по порядку этапов, итоговые метрики - в конце"""
+    previous, _, stage = metric.partition("->")
+    if previous in STAGES and stage in STAGES:
+        return 0, STAGES.index(previous), STAGES.index(stage)
+    if metric in TOTAL_METRICS:
+        return 1, TOTAL_METRICS.index(metric), 0
+    return 2, 0, 0
+
+
+def percentile(sorted_values: List[int], p: int) -> int:
+    """Перцентиль по методу nearest-rank"""
+    index = max(0, -(-p * len(sorted_values) // 100) - 1)
+    return sorted_values[index]
+
+
+class OutageTracer:
+    """
+    Трассы событий отключения/включения в Redis
+
+    - trace:outage:{event_id} - HASH этап -> время (мс), плюс queue_id и state
+    - trace:queue:{queue}:{state} - открытое событие черги (ещё не разослано)
+    - metrics:latency:{queue}:{metric} - LIST последних замеров (мс)
+
+    Трассировка не должна мешать рассылке: ошибки Redis только логируются.
+    """
+
+    def __init__(self):
+        self._mark_script = None
+
+    async def begin(self, queue_id: int, is_power_on: bool) -> Optional[str]:
+        """
+        Первый сигнал о новом состоянии черги
+
+        Повторные сигналы (второй сенсор, следующие пинги) возвращают
+        то же событие, время первого сигнала не меняется.
+
+        Returns:
+            str: ID события (None - Redis недоступен)
+        """
+        try:
+            redis = await redis_client.get_connection()
+            key = open_event_key(queue_id, is_power_on)
+            event_id = uuid.uuid4().hex
+
+            if await redis.set(key, event_id, nx=True, ex=OPEN_EVENT_TTL):
+                await redis.hset(trace_key(event_id), mapping={
+                    "queue_id": queue_id,
+                    "state": "on" if is_power_on else "off",
+                    STAGE_SENSOR_FLIP: now_ms(),
+                })
+                await redis.expire(trace_key(event_id), TRACE_TTL)
+                return event_id
+
+            return await redis.get(key)
+        except RedisError as e:
+            logger.warning(f"Outage trace unavailable: {e}")
+            return None
+
+    async def confirm(self, event_id: Optional[str], queue_id: int, is_power_on: bool):
+        """
+        Событие подтверждено: новое состояние черги стало текущим
+
+        Открытое событие противоположного состояния (флап, не дошедший
+        до рассылки) закрывается, чтобы следующий флип начал новую трассу.
+        """
+        if not event_id:
+            return
+        try:
+            redis = await redis_client.get_connection()
+            await redis.delete(open_event_key(queue_id, not is_power_on))
+        except RedisError as e:
+            logger.warning(f"Outage trace unavailable: {e}")
+
+    async def abandon(self, queue_id: int, is_power_on: bool):
+        """Событие не будет разослано (состояние вернулось к уже разосланному)"""
+        try:
+            redis = await redis_client.get_connection()
+            await redis.delete(open_event_key(queue_id, is_power_on))
+        except RedisError as e:
+            logger.warning(f"Outage trace unavailable: {e}")
+
+    async def mark(self, event_id: Optional[str], stage: str, at_ms: Optional[int] = None, mode: str = "first"):
+        """
+        Отметить этап события
+
+        Args:
+            event_id: ID события (None - трассировки нет, ничего не делаем)
+            stage: Один из STAGE_*
+            at_ms: Время этапа (мс, по умолчанию - сейчас)
+            mode: first / min / max
+        """
+        if not event_id:
+            return
+        try:
+            redis = await redis_client.get_connection()
+            if self._mark_script is None:
+                self._mark_script = redis.register_script(MARK_SCRIPT)
+            await self._mark_script(
+                keys=[trace_key(event_id)],
+                args=[stage, at_ms or now_ms(), mode, TRACE_TTL]
+            )
+        except RedisError as e:
+            logger.warning(f"Failed to mark {stage} for outage {event_id}: {e}")
+
+    async def record_sends(self, event_id: Optional[str], first_ms: Optional[int], last_ms: Optional[int]):
+        """Учесть время отправок батча (шарды идут параллельно: min / max)"""
+        if first_ms:
+            await self.mark(event_id, STAGE_FIRST_SEND, first_ms, mode="min")
+        if last_ms:
+            await self.mark(event_id, STAGE_LAST_SEND, last_ms, mode="max")
+
+    async def complete(self, event_id: Optional[str]):
+        """
+        Событие разослано: записать замеры в метрики черги
+
+        Пишутся интервалы между соседними пройденными этапами
+        и итоговые detect_to_first_send / detect_to_deliver; имена метрик
+        копятся в SET черги, чтобы latency_metrics показал и интервалы через пропуски.
+        """
+        trace = await self.get(event_id) if event_id else None
+        if not trace or STAGE_SENSOR_FLIP not in trace:
+            return
+
+        queue_id = trace["queue_id"]
+        samples: Dict[str, int] = {}
+
+        previous = None
+        for stage in STAGES:
+            if stage not in trace:
+                continue
+            if previous:
+                samples[f"{previous}->{stage}"] = trace[stage] - trace[previous]
+            previous = stage
+
+        if STAGE_FIRST_SEND in trace:
+            samples[METRIC_DETECT_TO_FIRST_SEND] = trace[STAGE_FIRST_SEND] - trace[STAGE_SENSOR_FLIP]
+        if STAGE_LAST_SEND in trace:
+            samples[METRIC_DETECT_TO_DELIVER] = trace[STAGE_LAST_SEND] - trace[STAGE_SENSOR_FLIP]
+
+        try:
+            redis = await redis_client.get_connection()
+            pipe = redis.pipeline(transaction=False)
+            for metric, value in samples.items():
+                key = samples_key(queue_id, metric)
+                pipe.lpush(key, max(0, value))
+                pipe.ltrim(key, 0, SAMPLES_PER_METRIC - 1)
+            if samples:
+                pipe.sadd(metric_names_key(queue_id), *samples)
+            pipe.sadd("metrics:latency:queues", queue_id)
+            pipe.delete(open_event_key(queue_id, trace["state"] == "on"))
+            await pipe.execute()
+        except RedisError as e:
+            logger.warning(f"Failed to record latency for outage {event_id}: {e}")
+            return
+
+        logger.info(
+            f"Outage {event_id} (queue {queue_id}): detect-to-deliver "
+            f"{samples.get(METRIC_DETECT_TO_DELIVER, 'n/a')} ms"
+        )
+
+    async def get(self, event_id: str) -> Optional[Dict[str, Any]]:
+        """Трасса события (этапы в мс от эпохи)"""
+        redis = await redis_client.get_connection()
+        data = await redis.hgetall(trace_key(event_id))
+        if not data:
+            return None
+
+        trace: Dict[str, Any] = {"event_id": event_id, "state": data.get("state")}
+        trace["queue_id"] = int(data["queue_id"])
+        for stage in STAGES:
+            if stage in data:
+                trace[stage] = int(data[stage])
+        return trace
+
+    async def latency_metrics(self, queue_id: Optional[int] = None) -> Dict[int, Dict[str, Dict[str, int]]]:
+        """
+        Перцентили p50/p95/p99 по последним SAMPLES_PER_METRIC событиям
+
+        Returns:
+            dict: queue_id -> метрика -> {count, p50, p95, p99}
+        """
+        redis = await redis_client.get_connection()
+
+        if queue_id is not None:
+            queue_ids = [queue_id]
+        else:
+            queue_ids = sorted(int(q) for q in await redis.smembers("metrics:latency:queues"))
+
+        # Соседние этапы и итоговые - всегда; интервалы через пропущенные этапы
+        # (событие прошло не все STAGES) - из SET метрик черги
+        default_metrics = [
+            f"{previous}->{stage}" for previous, stage in zip(STAGES, STAGES[1:])
+        ] + list(TOTAL_METRICS)
+
+        result: Dict[int, Dict[str, Dict[str, int]]] = {}
+        for queue in queue_ids:
+            names = await redis.smembers(metric_names_key(queue))
+            metrics = sorted(set(default_metrics) | set(names), key=metric_order)
+
+            pipe = redis.pipeline(transaction=False)
+            for metric in metrics:
+                pipe.lrange(samples_key(queue, metric), 0, -1)
+            values = await pipe.execute()
+
+            queue_metrics = {}
+            for metric, raw in zip(metrics, values):
+                if not raw:
+                    continue
+                sorted_values = sorted(int(v) for v in raw)
+                queue_metrics[metric] = {
+                    "count": len(sorted_values),
+                    **{f"p{p}": percentile(sorted_values, p) for p in PERCENTILES},
+                }
+            result[queue] = queue_metrics
+
+        return result
+
+
+# Глобальный экземпляр трассировщика
+outage_tracer = OutageTracer()
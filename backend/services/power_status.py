@@ -0,0 +1,239 @@
+"""
+Power Status Coalescer
+Debounce переходов ON/OFF черги перед рассылкой power_on / power_off
+"""
+
+import asyncio
+import logging
+from datetime import datetime
+from typing import Any, Dict, Iterable, Optional, Set
+
+from redis.exceptions import RedisError
+
+from celery_app import celery_app
+from redis_client import redis_client
+from config import settings
+from services.fanout import FanoutProgress
+from services.outage_trace import outage_tracer, STAGE_TASK_ENQUEUE
+
+logger = logging.getLogger(__name__)
+
+
+NOTIFY_TASK = "tasks.notification_tasks.notify_queue_status"
+
+# Новое состояние черги: поколение +1, отмена идущей рассылки противоположного состояния
+# KEYS[1] - HASH состояния черги, ARGV[1] - состояние ('1' ON / '0' OFF), ARGV[2] - время
+# Возвращает {поколение, последнее разосланное состояние, отменённая рассылка, отложенная задача}
+SUBMIT_SCRIPT = """
+local gen = redis.call('HINCRBY', KEYS[1], 'gen', 1)
+local f = redis.call('HMGET', KEYS[1], 'notified', 'fanout', 'fanout_state', 'pending')
+local notified = f[1] or ''
+local fanout = f[2] or ''
+local cancelled = ''
+if fanout ~= '' and f[3] ~= ARGV[1] then
+    cancelled = fanout
+    notified = ''
+    redis.call('HSET', KEYS[1], 'fanout', '', 'fanout_state', '', 'notified', '')
+end
+redis.call('HSET', KEYS[1], 'state', ARGV[1], 'changed_at', ARGV[2], 'pending', '')
+return {gen, notified, cancelled, f[4] or ''}
+"""
+
+# Отложенная задача запомнена, только если за это время не пришёл новый переход
+# KEYS[1] - HASH состояния черги, ARGV[1] - поколение, ARGV[2] - ID задачи
+SET_PENDING_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'gen') == ARGV[1] then
+    redis.call('HSET', KEYS[1], 'pending', ARGV[2])
+end
+return 1
+"""
+
+# Захват перехода задачей после debounce
+# KEYS[1] - HASH состояния черги, ARGV[1] - поколение задачи, ARGV[2] - ID рассылки
+# Повторный захват той же рассылкой (retry задачи после сбоя отправки) разрешён
+# Возвращает состояние для рассылки или '' (переход устарел / уже разослан)
+CLAIM_SCRIPT = """
+local f = redis.call('HMGET', KEYS[1], 'gen', 'state', 'notified', 'fanout')
+if f[1] ~= ARGV[1] or not f[2] then
+    return ''
+end
+if f[3] == f[2] then
+    if f[4] == ARGV[2] then
+        return f[2]
+    end
+    return ''
+end
+redis.call('HSET', KEYS[1], 'notified', f[2], 'fanout', ARGV[2], 'fanout_state', f[2], 'pending', '')
+return f[2]
+"""
+
+# KEYS[1] - HASH состояния черги, ARGV[1] - ID завершившейся рассылки
+FINISH_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'fanout') == ARGV[1] then
+    redis.call('HSET', KEYS[1], 'fanout', '', 'fanout_state', '')
+end
+return 1
+"""
+
+
+# Снятие захвата рассылкой, которая так и не ушла (повторы исчерпаны)
+# KEYS[1] - HASH состояния черги, ARGV[1] - ID рассылки
+RELEASE_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'fanout') == ARGV[1] then
+    redis.call('HSET', KEYS[1], 'fanout', '', 'fanout_state', '', 'notified', '')
+end
+return 1
+"""
+
+
+def state_key(queue_id: int) -> str:
+    return f"queue:{queue_id}:power"
+
+
+class PowerStatusCoalescer:
+    """
+    Коалесцер переходов ON/OFF черги
+
+    Переход не рассылается сразу, а ждёт POWER_STATUS_DEBOUNCE секунд:
+    - каждый новый переход увеличивает поколение, и отложенная задача
+      предыдущего поколения становится no-op (и отзывается из очереди)
+    - если состояние вернулось к уже разосланному - рассылки нет вовсе
+    - идущая рассылка противоположного состояния отменяется
+      (её шарды прекращают отправку, см. FanoutProgress.cancel)
+
+    В итоге OFF->ON->OFF за минуту даёт одну рассылку с последним состоянием.
+    """
+
+    def __init__(self, debounce: Optional[int] = None):
+        self.debounce = debounce if debounce is not None else settings.POWER_STATUS_DEBOUNCE
+        self._scripts: Dict[str, Any] = {}
+
+    async def _script(self, name: str, source: str):
+        redis = await redis_client.get_connection()
+        if name not in self._scripts:
+            self._scripts[name] = redis.register_script(source)
+        return self._scripts[name]
+
+    async def submit(self, queue_id: int, is_power_on: bool, event_id: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Новый подтверждённый статус черги (после commit в queues)
+
+        Args:
+            queue_id: ID черги
+            is_power_on: Новое состояние
+            event_id: ID события для сквозной трассировки (services.outage_trace)
+
+        Returns:
+            dict: Поколение перехода и запланирована ли рассылка
+        """
+        state = "1" if is_power_on else "0"
+
+        try:
+            submit = await self._script("submit", SUBMIT_SCRIPT)
+            generation, notified, cancelled, pending = await submit(
+                keys=[state_key(queue_id)],
+                args=[state, datetime.utcnow().isoformat()]
+            )
+        except RedisError as e:
+            # Без коалесцера рассылаем сразу: лучше дубль, чем пропущенное отключение
+            logger.error(f"Power status coalescer unavailable, sending immediately: {e}")
+            # Вызовы брокера синхронные: в потоке, чтобы медленный брокер
+            # не останавливал event loop обработчиков IoT и очередей
+            await asyncio.to_thread(
+                celery_app.send_task,
+                NOTIFY_TASK,
+                args=[queue_id, None, is_power_on],
+                kwargs={"event_id": event_id}
+            )
+            await outage_tracer.mark(event_id, STAGE_TASK_ENQUEUE)
+            return {"queue_id": queue_id, "scheduled": True, "debounce": 0}
+
+        if cancelled:
+            logger.info(f"Queue {queue_id} reverted, cancelling in-flight fanout {cancelled}")
+            await FanoutProgress(cancelled).cancel()
+
+        if pending:
+            # Переход, ещё не дождавшийся debounce, больше не актуален
+            await asyncio.to_thread(celery_app.control.revoke, pending)
+
+        if notified == state:
+            logger.info(f"Queue {queue_id} back to already notified state, nothing to send")
+            await outage_tracer.abandon(queue_id, is_power_on)
+            return {"queue_id": queue_id, "generation": generation, "scheduled": False}
+
+        result = await asyncio.to_thread(
+            celery_app.send_task,
+            NOTIFY_TASK,
+            args=[queue_id, generation],
+            kwargs={"event_id": event_id},
+            countdown=self.debounce
+        )
+        await outage_tracer.mark(event_id, STAGE_TASK_ENQUEUE)
+
+        set_pending = await self._script("set_pending", SET_PENDING_SCRIPT)
+        await set_pending(keys=[state_key(queue_id)], args=[generation, result.id])
+
+        return {
+            "queue_id": queue_id,
+            "generation": generation,
+            "scheduled": True,
+            "debounce": self.debounce
+        }
+
+    async def claim(self, queue_id: int, generation: int, fanout_id: str) -> Optional[bool]:
+        """
+        Захватить переход для рассылки (вызывается задачей после debounce)
+
+        Returns:
+            bool: Состояние для рассылки; None - переход устарел или уже разослан
+
+        Повторный вызов с тем же fanout_id (retry задачи) снова вернёт состояние,
+        пока переход не устарел - иначе сбой отправки терял бы оповещение.
+        """
+        claim = await self._script("claim", CLAIM_SCRIPT)
+        state = await claim(keys=[state_key(queue_id)], args=[generation, fanout_id])
+        if not state:
+            return None
+        return state == "1"
+
+    async def release(self, queue_id: int, fanout_id: str):
+        """Рассылка не состоялась - следующий переход в то же состояние разошлётся"""
+        try:
+            release = await self._script("release", RELEASE_SCRIPT)
+            await release(keys=[state_key(queue_id)], args=[fanout_id])
+        except RedisError as e:
+            logger.warning(f"Failed to release fanout {fanout_id} for queue {queue_id}: {e}")
+
+    async def active_queues(self, queue_ids: Iterable[int]) -> Set[int]:
+        """
+        Черги из queue_ids с переходом, который ждёт debounce или рассылается
+
+        Ждёт - состояние ещё не разослано (state != notified), рассылается - задан fanout.
+        """
+        queue_ids = list(queue_ids)
+        if not queue_ids:
+            return set()
+
+        redis = await redis_client.get_connection()
+        pipe = redis.pipeline(transaction=False)
+        for queue_id in queue_ids:
+            pipe.hmget(state_key(queue_id), "state", "notified", "fanout")
+        states = await pipe.execute()
+
+        return {
+            queue_id
+            for queue_id, (state, notified, fanout) in zip(queue_ids, states)
+            if (state and state != (notified or "")) or fanout
+        }
+
+    async def fanout_finished(self, queue_id: int, fanout_id: str):
+        """Рассылка завершена - отменять больше нечего"""
+        try:
+            finish = await self._script("finish", FINISH_SCRIPT)
+            await finish(keys=[state_key(queue_id)], args=[fanout_id])
+        except RedisError as e:
+            logger.warning(f"Failed to clear fanout {fanout_id} for queue {queue_id}: {e}")
+
+
+# Глобальный экземпляр коалесцера
+power_status_coalescer = PowerStatusCoalescer()
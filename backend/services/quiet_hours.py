@@ -0,0 +1,249 @@
+"""
+Quiet Hours
+Отложенная доставка для пользователей в тихом режиме: ZSET по времени выдачи в Redis
+"""
+
+import json
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+from zoneinfo import ZoneInfo
+
+from redis_client import redis_client
+from config import settings
+from services.recipients import QuietWindow, Recipient, parse_clock
+
+logger = logging.getLogger(__name__)
+
+
+TIMEZONE = ZoneInfo(settings.QUIET_HOURS_TIMEZONE)
+
+DUE_KEY = "quiet:due"  # ZSET "{user}:{queue}:{kind}" -> время выдачи (unix)
+PAYLOAD_KEY = "quiet:payload"  # HASH член -> JSON отложенного сообщения
+VERSION_KEY = "quiet:version"  # HASH член -> время события (мс), последнее побеждает
+
+# Типы, которые за время окна схлопываются в одно сообщение на пользователя и чергу
+STATE_TYPES = {"power_on": "power", "power_off": "power"}
+
+# Устаревают к концу окна - во время окна не отправляются вовсе
+DROPPED_TYPES = frozenset({"warning"})
+
+# Отложить сообщения (последнее состояние побеждает)
+# KEYS[1] - ZSET выдачи, KEYS[2] - HASH сообщений, KEYS[3] - HASH версий
+# ARGV - четвёрки: член, время выдачи, версия (мс), JSON сообщения
+HOLD_SCRIPT = """
+local held = 0
+for i = 1, #ARGV, 4 do
+    local current = tonumber(redis.call('HGET', KEYS[3], ARGV[i]))
+    if current == nil or tonumber(ARGV[i + 2]) >= current then
+        redis.call('ZADD', KEYS[1], ARGV[i + 1], ARGV[i])
+        redis.call('HSET', KEYS[2], ARGV[i], ARGV[i + 3])
+        redis.call('HSET', KEYS[3], ARGV[i], ARGV[i + 2])
+        held = held + 1
+    end
+end
+return held
+"""
+
+# Взять в аренду волну сообщений, время выдачи которых наступило: время выдачи
+# сдвигается на срок аренды, удаляются они только после известного исхода (ACK_SCRIPT)
+# KEYS - как в HOLD_SCRIPT, ARGV[1] - текущее время (unix), ARGV[2] - размер волны,
+# ARGV[3] - конец аренды (unix)
+# Возвращает {член, JSON сообщения, версия, ...}
+LEASE_SCRIPT = """
+local members = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+local leased = {}
+for _, member in ipairs(members) do
+    local payload = redis.call('HGET', KEYS[2], member)
+    if payload then
+        redis.call('ZADD', KEYS[1], 'XX', ARGV[3], member)
+        table.insert(leased, member)
+        table.insert(leased, payload)
+        table.insert(leased, redis.call('HGET', KEYS[3], member) or '')
+    else
+        redis.call('ZREM', KEYS[1], member)
+        redis.call('HDEL', KEYS[3], member)
+    end
+end
+return leased
+"""
+
+# Удалить выданные сообщения, если за время аренды их не заменило более новое
+# KEYS - как в HOLD_SCRIPT, ARGV - пары: член, версия из аренды
+ACK_SCRIPT = """
+local acked = 0
+for i = 1, #ARGV, 2 do
+    if (redis.call('HGET', KEYS[3], ARGV[i]) or '') == ARGV[i + 1] then
+        redis.call('ZREM', KEYS[1], ARGV[i])
+        redis.call('HDEL', KEYS[2], ARGV[i])
+        redis.call('HDEL', KEYS[3], ARGV[i])
+        acked = acked + 1
+    end
+end
+return acked
+"""
+
+
+def local_now(now: Optional[datetime] = None) -> datetime:
+    """Текущее время в часовом поясе тихого режима"""
+    if now is None:
+        return datetime.now(TIMEZONE)
+    if now.tzinfo is None:
+        return now.replace(tzinfo=TIMEZONE)
+    return now.astimezone(TIMEZONE)
+
+
+def default_window() -> QuietWindow:
+    """Окно тихого режима по умолчанию (QUIET_HOURS_START - QUIET_HOURS_END)"""
+    return (
+        parse_clock(settings.QUIET_HOURS_START, "23:00"),
+        parse_clock(settings.QUIET_HOURS_END, "07:00"),
+    )
+
+
+def in_window(window: QuietWindow, now: datetime) -> bool:
+    """Попадает ли локальное время в окно (окно может переходить через полночь)"""
+    start, end = window
+    minute = now.hour * 60 + now.minute
+    if start < end:
+        return start <= minute < end
+    return minute >= start or minute < end
+
+
+def window_end(window: QuietWindow, now: datetime) -> datetime:
+    """Ближайший конец окна после now (локальное время)"""
+    end = now.replace(hour=window[1] // 60, minute=window[1] % 60, second=0, microsecond=0)
+    if end <= now:
+        end += timedelta(days=1)
+    return end
+
+
+def is_night(now: Optional[datetime] = None) -> bool:
+    """Ночные часы по умолчанию: всем остальным power_on/off приходят без звука"""
+    return in_window(default_window(), local_now(now))
+
+
+def release_at(recipient: Recipient, now: datetime) -> int:
+    """
+    Время выдачи отложенного сообщения (unix)
+
+    Конец окна пользователя плюс сдвиг 0..QUIET_RELEASE_SPREAD по chat ID:
+    окна у большинства совпадают, и без сдвига все отложенные
+    сообщения стали бы в очередь на rate limit в одну секунду.
+    """
+    spread = settings.QUIET_RELEASE_SPREAD
+    offset = recipient.user_id % spread if spread > 0 else 0
+    return int(window_end(recipient.quiet_window, now).timestamp()) + offset
+
+
+class QuietHoursQueue:
+    """
+    Очередь отложенной доставки тихого режима
+
+    - quiet:due - ZSET член -> время выдачи; член "{user}:{queue}:{kind}",
+      для power_on/power_off kind общий ("power"): за ночь остаётся только
+      последнее состояние черги
+    - quiet:payload / quiet:version - само сообщение и время события,
+      более раннее событие не перезаписывает более позднее
+
+    Выдаёт волнами по QUIET_RELEASE_WAVE_SIZE (см. release_quiet_notifications),
+    темп отправки держит общий rate limiter. Волна берётся в аренду (lease_due)
+    и удаляется после отправки (ack).
+    """
+
+    def __init__(self):
+        self._scripts: Dict[str, Any] = {}
+
+    async def _script(self, name: str, source: str):
+        redis = await redis_client.get_connection()
+        if name not in self._scripts:
+            self._scripts[name] = redis.register_script(source)
+        return self._scripts[name]
+
+    async def hold_many(
+            self,
+            items: List[Tuple[Recipient, bytes]],
+            notification_type: str,
+            queue_id: Optional[int],
+            now: datetime,
+            version_ms: int
+    ) -> int:
+        """
+        Отложить сообщения батча до конца окна каждого получателя
+
+        Args:
+            items: Получатели и готовые JSON тела sendMessage
+            notification_type: Тип уведомления
+            queue_id: Черга рассылки
+            now: Локальное время (см. local_now)
+            version_ms: Время события (мс) для выбора последнего состояния
+
+        Returns:
+            int: Сколько сообщений записано (устаревшие не перезаписывают новые)
+        """
+        if not items:
+            return 0
+
+        kind = STATE_TYPES.get(notification_type, notification_type)
+
+        args: List[Any] = []
+        for recipient, body in items:
+            item_queue = recipient.queue_id or queue_id or 0
+            args.extend([
+                f"{recipient.user_id}:{item_queue}:{kind}",
+                release_at(recipient, now),
+                version_ms,
+                json.dumps({
+                    "user_id": recipient.user_id,
+                    "queue_id": item_queue,
+                    "type": notification_type,
+                    "body": body.decode(),
+                }, ensure_ascii=False),
+            ])
+
+        hold = await self._script("hold", HOLD_SCRIPT)
+        return await hold(keys=[DUE_KEY, PAYLOAD_KEY, VERSION_KEY], args=args)
+
+    async def lease_due(self, limit: int, now: Optional[datetime] = None) -> List[Dict[str, Any]]:
+        """
+        Взять в аренду волну сообщений, время выдачи которых наступило
+
+        До ack сообщения остаются в очереди со временем выдачи через
+        QUIET_RELEASE_LEASE секунд: упавший посреди волны воркер их не теряет.
+
+        Returns:
+            list: user_id, queue_id, type, body, member и version (для ack)
+        """
+        timestamp = int(local_now(now).timestamp())
+        lease = await self._script("lease", LEASE_SCRIPT)
+        flat = await lease(
+            keys=[DUE_KEY, PAYLOAD_KEY, VERSION_KEY],
+            args=[timestamp, limit, timestamp + settings.QUIET_RELEASE_LEASE]
+        )
+        return [
+            {**json.loads(flat[i + 1]), "member": flat[i], "version": flat[i + 2]}
+            for i in range(0, len(flat), 3)
+        ]
+
+    async def ack(self, items: List[Dict[str, Any]]) -> int:
+        """Удалить сообщения, исход которых известен (выдано или передано в dead-letter)"""
+        if not items:
+            return 0
+        args: List[Any] = []
+        for item in items:
+            args.extend([item["member"], item["version"]])
+        ack = await self._script("ack", ACK_SCRIPT)
+        return await ack(keys=[DUE_KEY, PAYLOAD_KEY, VERSION_KEY], args=args)
+
+    async def stats(self, now: Optional[datetime] = None) -> Dict[str, int]:
+        """Сколько сообщений отложено и сколько уже пора выдать"""
+        redis = await redis_client.get_connection()
+        timestamp = int(local_now(now).timestamp())
+        return {
+            "pending": await redis.zcard(DUE_KEY),
+            "due": await redis.zcount(DUE_KEY, "-inf", timestamp),
+        }
+
+
+# Глобальный экземпляр очереди тихого режима
+quiet_hours_queue = QuietHoursQueue()
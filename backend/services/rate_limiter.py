@@ -0,0 +1,273 @@
+"""
+Telegram Rate Limiter
+Общий для всех воркеров token bucket в Redis (атомарный Lua скрипт)
+"""
+
+import asyncio
+import logging
+from typing import Dict, Optional
+
+from redis.exceptions import RedisError
+
+from redis_client import redis_client
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+
+# Полосы приоритета (от высшего к низшему) - они же очереди Celery
+LANE_CRITICAL = "critical"  # power_on / power_off
+LANE_WARNINGS = "warnings"  # предупреждения о графике
+LANE_BULK = "bulk"  # кастомные и массовые рассылки
+LANE_MAINTENANCE = "maintenance"  # очистка, сверка индекса
+LANES = (LANE_CRITICAL, LANE_WARNINGS, LANE_BULK, LANE_MAINTENANCE)
+
+NOTIFICATION_LANES = {
+    "power_off": LANE_CRITICAL,
+    "power_on": LANE_CRITICAL,
+    "warning": LANE_WARNINGS,
+}
+
+
+# Режимы отправки: у каждого свой бюджет (token bucket) в Redis
+MODE_FREE = "free"  # обычный лимит Bot API (~30 msg/sec)
+MODE_PAID = "paid"  # allow_paid_broadcast (до 1000 msg/sec за Telegram Stars)
+
+
+def lane_for(notification_type: str) -> str:
+    """Полоса приоритета для типа уведомления (по умолчанию - bulk)"""
+    return NOTIFICATION_LANES.get(notification_type, LANE_BULK)
+
+
+def is_paid_broadcast(notification_type: str, tier: Optional[str] = None) -> bool:
+    """Отправлять ли сообщение в платном режиме (TELEGRAM_PAID_BROADCAST_*)"""
+    if not settings.TELEGRAM_PAID_BROADCAST:
+        return False
+    if notification_type not in settings.TELEGRAM_PAID_BROADCAST_TYPES:
+        return False
+    tiers = settings.TELEGRAM_PAID_BROADCAST_TIERS
+    return not tiers or tier in tiers
+
+
+# KEYS[1] - глобальный bucket, KEYS[2] - лимит чата, KEYS[3] - пауза после 429,
+# KEYS[4] - bucket полосы, KEYS[5] - маркер активности полосы, KEYS[6..] - маркеры старших полос
+# ARGV[1] - скорость (токенов/сек), ARGV[2] - ёмкость bucket, ARGV[3] - интервал чата (мс),
+# ARGV[4] - скорость полосы при конкуренции со старшими, ARGV[5] - TTL маркера активности (мс)
+# Возвращает {wait_ms, scope}: wait_ms = 0 - токен получен, scope = 1 - ждём конкретный чат
+ACQUIRE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local active_ttl = tonumber(ARGV[5])
+
+-- Полоса заявляет о себе ещё до получения токена: младшие уступают сразу
+redis.call('SET', KEYS[5], 1, 'PX', active_ttl)
+
+local paused = redis.call('PTTL', KEYS[3])
+if paused > 0 then
+    return {paused, 0}
+end
+
+local chat_wait = redis.call('PTTL', KEYS[2])
+if chat_wait > 0 then
+    return {chat_wait, 1}
+end
+
+local function refill(key, rate, burst)
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or burst
+    local ts = tonumber(state[2]) or now
+    return math.min(burst, tokens + math.max(0, now - ts) * rate / 1000)
+end
+
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local tokens = refill(KEYS[1], rate, burst)
+
+if tokens < 1 then
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+    return {math.ceil((1 - tokens) * 1000 / rate), 0}
+end
+
+-- Старшая полоса активна - младшей остаётся только её доля бюджета
+local contended = false
+for i = 6, #KEYS do
+    if redis.call('EXISTS', KEYS[i]) == 1 then
+        contended = true
+        break
+    end
+end
+
+if contended then
+    local lane_rate = tonumber(ARGV[4])
+    if lane_rate <= 0 then
+        return {active_ttl, 0}
+    end
+    local lane_tokens = refill(KEYS[4], lane_rate, math.max(1, burst * lane_rate / rate))
+    if lane_tokens < 1 then
+        redis.call('HSET', KEYS[4], 'tokens', tostring(lane_tokens), 'ts', now)
+        return {math.ceil((1 - lane_tokens) * 1000 / lane_rate), 0}
+    end
+    redis.call('HSET', KEYS[4], 'tokens', tostring(lane_tokens - 1), 'ts', now)
+    redis.call('PEXPIRE', KEYS[4], 60000)
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens - 1), 'ts', now)
+redis.call('PEXPIRE', KEYS[1], 60000)
+if tonumber(ARGV[3]) > 0 then
+    redis.call('SET', KEYS[2], 1, 'PX', ARGV[3])
+end
+return {0, 0}
+"""
+
+# KEYS[1] - ключ паузы, ARGV[1] - длительность паузы (мс); паузу можно только продлить
+PAUSE_SCRIPT = """
+if redis.call('PTTL', KEYS[1]) < tonumber(ARGV[1]) then
+    redis.call('SET', KEYS[1], 1, 'PX', ARGV[1])
+end
+return 1
+"""
+
+
+class TelegramRateLimiter:
+    """
+    Глобальный rate limiter отправок в Telegram
+
+    - Один bucket на весь кластер: N воркеров вместе не превышают rate
+    - Лимит ~1 msg/sec на конкретный чат
+    - Пауза всего bucket при ответе 429 (retry_after)
+    - Полосы приоритета: пока шлёт старшая полоса, младшая ограничена
+      своей долей (TELEGRAM_LANE_SHARES) и продолжает на полной скорости,
+      как только старшая затихнет
+    - Режим (MODE_FREE / MODE_PAID): свой bucket, пауза и полосы на режим,
+      лимит чата общий - Telegram считает его независимо от режима
+    """
+
+    KEY_PREFIX = "telegram:{ratelimit}"
+
+    def __init__(
+            self,
+            rate: Optional[float] = None,
+            burst: Optional[int] = None,
+            chat_interval: Optional[float] = None,
+            mode: str = MODE_FREE
+    ):
+        self.mode = mode
+        self.rate = rate or settings.TELEGRAM_RATE_LIMIT
+        self.burst = burst or settings.TELEGRAM_RATE_BURST
+        self.chat_interval_ms = int(
+            (chat_interval if chat_interval is not None else settings.TELEGRAM_PER_CHAT_INTERVAL) * 1000
+        )
+        self.lane_shares = settings.TELEGRAM_LANE_SHARES
+        self.active_ttl_ms = int(settings.TELEGRAM_LANE_ACTIVE_TTL * 1000)
+        self._acquire_script = None
+        self._pause_script = None
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    @property
+    def mode_prefix(self) -> str:
+        # Ключи обычного режима без суффикса - как до появления платного
+        return self.KEY_PREFIX if self.mode == MODE_FREE else f"{self.KEY_PREFIX}:{self.mode}"
+
+    @property
+    def bucket_key(self) -> str:
+        return f"{self.mode_prefix}:global"
+
+    @property
+    def pause_key(self) -> str:
+        return f"{self.mode_prefix}:pause"
+
+    def chat_key(self, chat_id: int) -> str:
+        return f"{self.KEY_PREFIX}:chat:{chat_id}"
+
+    def lane_key(self, lane: str) -> str:
+        return f"{self.mode_prefix}:lane:{lane}"
+
+    def active_key(self, lane: str) -> str:
+        return f"{self.mode_prefix}:active:{lane}"
+
+    async def _take(self, chat_id: int, lane: str):
+        """Одна попытка взять токен: (wait_ms, scope)"""
+        redis = await redis_client.get_connection()
+        if self._acquire_script is None:
+            self._acquire_script = redis.register_script(ACQUIRE_SCRIPT)
+
+        higher = LANES[:LANES.index(lane)]
+        wait_ms, scope = await self._acquire_script(
+            keys=[
+                self.bucket_key,
+                self.chat_key(chat_id),
+                self.pause_key,
+                self.lane_key(lane),
+                self.active_key(lane),
+                *(self.active_key(other) for other in higher)
+            ],
+            args=[
+                self.rate,
+                self.burst,
+                self.chat_interval_ms,
+                self.rate * self.lane_shares.get(lane, 1.0),
+                self.active_ttl_ms
+            ]
+        )
+        return int(wait_ms), int(scope)
+
+    async def acquire(self, chat_id: int, lane: str = LANE_BULK):
+        """
+        Дождаться разрешения на отправку сообщения в чат
+
+        Внутри процесса запросы к Redis сериализуются через lock (свой
+        на каждую полосу), поэтому тысячи ожидающих корутин не опрашивают
+        Redis одновременно, а critical не стоит за bulk в том же процессе.
+        Ожидание лимита конкретного чата происходит вне lock.
+
+        Args:
+            chat_id: Telegram ID чата
+            lane: Полоса приоритета (см. lane_for)
+        """
+        lock = self._locks.get(lane)
+        if lock is None:
+            lock = self._locks[lane] = asyncio.Lock()
+
+        while True:
+            async with lock:
+                try:
+                    wait_ms, scope = await self._take(chat_id, lane)
+                    while wait_ms > 0 and scope == 0:
+                        await asyncio.sleep(wait_ms / 1000)
+                        wait_ms, scope = await self._take(chat_id, lane)
+                except RedisError as e:
+                    # Redis недоступен - локальный pacing, чтобы не остановить рассылку
+                    logger.warning(f"Rate limiter unavailable, falling back to local pacing: {e}")
+                    await asyncio.sleep(1 / self.rate)
+                    return
+
+                if wait_ms <= 0:
+                    return
+
+            # Лимит конкретного чата - ждём, не блокируя остальных
+            await asyncio.sleep(wait_ms / 1000)
+
+    async def pause(self, retry_after: float):
+        """
+        Приостановить весь bucket после 429 от Telegram
+
+        Args:
+            retry_after: Значение parameters.retry_after из ответа (секунд)
+        """
+        logger.warning(f"Telegram flood control: pausing all {self.mode} sends for {retry_after}s")
+        try:
+            redis = await redis_client.get_connection()
+            if self._pause_script is None:
+                self._pause_script = redis.register_script(PAUSE_SCRIPT)
+            await self._pause_script(keys=[self.pause_key], args=[int(retry_after * 1000)])
+        except RedisError as e:
+            logger.error(f"Failed to set rate limiter pause: {e}")
+
+
+# Глобальные экземпляры rate limiter (обычный и платный режим)
+telegram_rate_limiter = TelegramRateLimiter()
+paid_rate_limiter = TelegramRateLimiter(
+    rate=settings.TELEGRAM_PAID_RATE_LIMIT,
+    burst=settings.TELEGRAM_PAID_RATE_BURST,
+    mode=MODE_PAID
+)
@@ -0,0 +1,428 @@
+"""
+Recipient Index
+Предвычисленный индекс получателей в Redis: черга + тариф + тип уведомления -> ZSET chat ID
+"""
+
+import heapq
+import logging
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Set, Tuple
+
+from redis.exceptions import RedisError
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models.address import Address, UserAddress
+from redis_client import redis_client
+from services.recipients import QuietWindow, Recipient, can_receive_notification, stream_recipients
+
+logger = logging.getLogger(__name__)
+
+
+TIERS = ["PRO", "STANDARD", "TRIAL", "FREE", "NOFREE"]
+INDEXED_TYPES = ["power_off", "power_on", "warning", "schedule", "custom"]
+
+KEY_PREFIX = "recipients"
+PROFILE_KEY = f"{KEY_PREFIX}:profile"  # HASH user_id -> "flags[;start-end]|username|first_name"
+BUILT_KEY = f"{KEY_PREFIX}:built"  # индекс полностью построен
+VERSION_KEY = f"{KEY_PREFIX}:version"  # формат профилей, с которым построен индекс
+
+# Увеличивается при изменении формата профиля или флагов:
+# индекс старого формата не используется до перестройки (check_recipient_index)
+PROFILE_VERSION = "3"
+
+# Атомарная замена членства пользователя в индексе
+# KEYS[1] - SET ключей, в которых состоит пользователь, KEYS[2] - HASH профилей
+# ARGV[1] - user_id, ARGV[2] - профиль ('' - удалить), ARGV[3..] - новые ключи индекса
+REPLACE_SCRIPT = """
+local old = redis.call('SMEMBERS', KEYS[1])
+for _, key in ipairs(old) do
+    redis.call('ZREM', key, ARGV[1])
+end
+redis.call('DEL', KEYS[1])
+for i = 3, #ARGV do
+    redis.call('ZADD', ARGV[i], ARGV[1], ARGV[1])
+    redis.call('SADD', KEYS[1], ARGV[i])
+end
+if ARGV[2] == '' then
+    redis.call('HDEL', KEYS[2], ARGV[1])
+else
+    redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+end
+return #old
+"""
+
+
+def queue_key(queue_id: int, tier: str, notification_type: str) -> str:
+    return f"{KEY_PREFIX}:q:{queue_id}:{tier}:{notification_type}"
+
+
+def member_key(user_id: int) -> str:
+    return f"{KEY_PREFIX}:member:{user_id}"
+
+
+def key_queue(key: str) -> int:
+    """Черга ключа индекса recipients:q:{queue}:{tier}:{type}"""
+    return int(key.split(":")[2])
+
+
+def pack_profile(recipient: Recipient) -> str:
+    flags = str(recipient.flags)
+    if recipient.quiet_window:
+        flags += ";{}-{}".format(*recipient.quiet_window)
+    return f"{flags}|{recipient.username or ''}|{recipient.first_name or ''}"
+
+
+def unpack_flags(packed: str) -> Tuple[int, Optional[QuietWindow]]:
+    """Флаги и окно тихого режима из первого поля профиля"""
+    flags, _, window = packed.partition(";")
+    if not window:
+        return int(flags), None
+    start, end = window.split("-")
+    return int(flags), (int(start), int(end))
+
+
+def index_keys(recipient: Recipient, queue_ids: Set[int]) -> List[str]:
+    """Все ключи индекса, в которых должен состоять получатель"""
+    keys = []
+    for queue_id in sorted(queue_ids):
+        for notification_type in INDEXED_TYPES:
+            if can_receive_notification(recipient, notification_type):
+                keys.append(queue_key(queue_id, recipient.tier, notification_type))
+    return keys
+
+
+async def load_extra_queues(
+        session: AsyncSession,
+        user_ids: Optional[List[int]] = None
+) -> Dict[int, Set[int]]:
+    """
+    Дополнительные черги пользователей (адреса PRO из user_addresses)
+
+    Returns:
+        dict: user_id -> множество queue_id
+    """
+    query = select(UserAddress.user_id, Address.queue_id).join(
+        Address, Address.id == UserAddress.address_id
+    )
+    if user_ids:
+        query = query.where(UserAddress.user_id.in_(user_ids))
+
+    result = await session.execute(query)
+
+    queues: Dict[int, Set[int]] = {}
+    for user_id, queue_id in result.all():
+        queues.setdefault(user_id, set()).add(queue_id)
+    return queues
+
+
+class RecipientIndex:
+    """
+    Индекс получателей рассылок в Redis
+
+    - recipients:q:{queue}:{tier}:{type} - ZSET chat ID (score = chat ID,
+      чтобы рассылку можно было резать на шарды по диапазонам ID)
+    - recipients:member:{user_id} - SET ключей, в которых состоит пользователь
+    - recipients:profile - HASH с данными для персонализации
+
+    Обновляется точечно (refresh_user) при изменении пользователя
+    или его адресов; полная перестройка и сверка с Postgres - rebuild/check.
+    """
+
+    def __init__(self):
+        self._replace_script = None
+
+    async def is_ready(self) -> bool:
+        """Построен ли индекс (иначе рассылка читает получателей из Postgres)"""
+        try:
+            redis = await redis_client.get_connection()
+            built, version = await redis.mget(BUILT_KEY, VERSION_KEY)
+            return built is not None and version == PROFILE_VERSION
+        except RedisError as e:
+            logger.warning(f"Recipient index unavailable: {e}")
+            return False
+
+    async def refresh_user(self, session: AsyncSession, user_id: int):
+        """
+        Пересчитать членство пользователя в индексе
+
+        Вызывать после изменения primary_address_id, тарифа, настроек
+        пользователя или его строк user_addresses.
+        """
+        try:
+            found = [r async for r in stream_recipients(session, user_ids=[user_id])]
+
+            keys = []
+            profile = ""
+            if found:
+                recipient = found[0]
+                queue_ids = (await load_extra_queues(session, [user_id])).get(user_id, set())
+                if recipient.queue_id is not None:
+                    queue_ids.add(recipient.queue_id)
+                keys = index_keys(recipient, queue_ids)
+                profile = pack_profile(recipient)
+
+            redis = await redis_client.get_connection()
+            if self._replace_script is None:
+                self._replace_script = redis.register_script(REPLACE_SCRIPT)
+
+            await self._replace_script(
+                keys=[member_key(user_id), PROFILE_KEY],
+                args=[user_id, profile, *keys]
+            )
+        except RedisError as e:
+            # Индекс догонит периодическая сверка (check)
+            logger.error(f"Failed to refresh recipient index for {user_id}: {e}")
+
+    async def remove_users(self, user_ids: List[int]):
+        """
+        Убрать пользователей из индекса (например, заблокировавших бота)
+
+        Одна пачка Lua вызовов через pipeline, без обращения к Postgres.
+        """
+        try:
+            redis = await redis_client.get_connection()
+            if self._replace_script is None:
+                self._replace_script = redis.register_script(REPLACE_SCRIPT)
+
+            pipe = redis.pipeline(transaction=False)
+            for user_id in user_ids:
+                await self._replace_script(
+                    keys=[member_key(user_id), PROFILE_KEY],
+                    args=[user_id, ""],
+                    client=pipe
+                )
+            await pipe.execute()
+        except RedisError as e:
+            logger.error(f"Failed to remove {len(user_ids)} users from recipient index: {e}")
+
+    async def iter_recipients(
+            self,
+            queue_id: int,
+            notification_type: str,
+            tier_filter: Optional[List[str]] = None,
+            id_range: Optional[Tuple[int, int]] = None,
+            chunk_size: int = 1000,
+            required_flags: int = 0
+    ) -> AsyncIterator[Recipient]:
+        """
+        Получатели черги из индекса: одно чтение ZSET на каждый тариф
+
+        Args:
+            queue_id: ID черги
+            notification_type: Тип уведомления
+            tier_filter: Фильтр по тарифам
+            id_range: Диапазон chat ID [from, to) для шарда рассылки
+            chunk_size: Сколько профилей читать за один HMGET
+            required_flags: Флаги, которые должны быть у получателя (например, warning_flag)
+
+        Yields:
+            Recipient: Получатель
+        """
+        redis = await redis_client.get_connection()
+
+        for tier in tier_filter or TIERS:
+            key = queue_key(queue_id, tier, notification_type)
+            if id_range:
+                user_ids = await redis.zrangebyscore(key, id_range[0], f"({id_range[1]}")
+            else:
+                user_ids = await redis.zrange(key, 0, -1)
+
+            for i in range(0, len(user_ids), chunk_size):
+                chunk = user_ids[i:i + chunk_size]
+                profiles = await redis.hmget(PROFILE_KEY, chunk)
+
+                for user_id, profile in zip(chunk, profiles):
+                    packed_flags, username, first_name = (profile or "0||").split("|", 2)
+                    flags, quiet_window = unpack_flags(packed_flags)
+                    if flags & required_flags != required_flags:
+                        continue
+                    yield Recipient(
+                        user_id=int(user_id),
+                        first_name=first_name or None,
+                        username=username or None,
+                        tier=tier,
+                        queue_id=queue_id,
+                        flags=flags,
+                        quiet_window=quiet_window
+                    )
+
+    async def watched_queues(self, user_ids: List[int]) -> Dict[int, Set[int]]:
+        """
+        Черги, за которыми следят пользователи (основной и дополнительные адреса)
+
+        Returns:
+            dict: user_id -> множество queue_id (пусто - пользователя нет в индексе)
+        """
+        if not user_ids:
+            return {}
+
+        redis = await redis_client.get_connection()
+        pipe = redis.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.smembers(member_key(user_id))
+        members = await pipe.execute()
+
+        return {
+            user_id: {key_queue(key) for key in keys}
+            for user_id, keys in zip(user_ids, members)
+        }
+
+    async def get_recipient_ids(
+            self,
+            queue_id: int,
+            notification_type: str,
+            tier_filter: Optional[List[str]] = None
+    ) -> Iterator[int]:
+        """
+        chat ID получателей черги по возрастанию (для нарезки на шарды)
+
+        ZSET каждого тарифа уже упорядочен по chat ID (score = chat ID):
+        потоки тарифов сливаются heapq.merge без общей сортировки.
+        """
+        redis = await redis_client.get_connection()
+
+        streams = []
+        for tier in tier_filter or TIERS:
+            user_ids = await redis.zrange(queue_key(queue_id, tier, notification_type), 0, -1)
+            streams.append(map(int, user_ids))
+        return heapq.merge(*streams)
+
+    async def _build_expected(self, session: AsyncSession):
+        """Ожидаемое состояние индекса по данным Postgres"""
+        extra_queues = await load_extra_queues(session)
+
+        async for recipient in stream_recipients(session):
+            queue_ids = extra_queues.get(recipient.user_id, set())
+            if recipient.queue_id is not None:
+                queue_ids.add(recipient.queue_id)
+            yield recipient, index_keys(recipient, queue_ids)
+
+    async def _delete_all(self, redis):
+        batch = []
+        async for key in redis.scan_iter(match=f"{KEY_PREFIX}:*", count=1000):
+            batch.append(key)
+            if len(batch) >= 1000:
+                await redis.unlink(*batch)
+                batch = []
+        if batch:
+            await redis.unlink(*batch)
+
+    async def rebuild(self, session: AsyncSession, chunk_size: int = 1000) -> Dict[str, int]:
+        """
+        Полная перестройка индекса из Postgres
+
+        На время перестройки индекс помечен как неготовый,
+        и рассылки читают получателей напрямую из Postgres.
+
+        Returns:
+            dict: Количество проиндексированных пользователей и ключей
+        """
+        redis = await redis_client.get_connection()
+        await redis.delete(BUILT_KEY)
+        await self._delete_all(redis)
+
+        users = 0
+        keys_total = set()
+        pipe = redis.pipeline(transaction=False)
+
+        async for recipient, keys in self._build_expected(session):
+            users += 1
+            keys_total.update(keys)
+
+            for key in keys:
+                pipe.zadd(key, {recipient.user_id: recipient.user_id})
+            if keys:
+                pipe.sadd(member_key(recipient.user_id), *keys)
+            pipe.hset(PROFILE_KEY, recipient.user_id, pack_profile(recipient))
+
+            if users % chunk_size == 0:
+                await pipe.execute()
+
+        await pipe.execute()
+        await redis.set(VERSION_KEY, PROFILE_VERSION)
+        await redis.set(BUILT_KEY, users)
+
+        logger.info(f"Recipient index rebuilt: {users} users, {len(keys_total)} keys")
+        return {"users": users, "keys": len(keys_total)}
+
+    async def check(self, session: AsyncSession, repair: bool = False) -> Dict[str, Any]:
+        """
+        Сверить индекс с Postgres: членство в ZSET и упакованные профили
+
+        Args:
+            session: Database session
+            repair: Исправить расхождения (refresh_user для затронутых)
+                и пометить индекс построенным в текущем формате профилей
+
+        Returns:
+            dict: Статистика расхождений
+        """
+        redis = await redis_client.get_connection()
+
+        expected: Dict[str, Set[str]] = {}
+        expected_profiles: Dict[str, str] = {}
+        async for recipient, keys in self._build_expected(session):
+            expected_profiles[str(recipient.user_id)] = pack_profile(recipient)
+            for key in keys:
+                expected.setdefault(key, set()).add(str(recipient.user_id))
+
+        actual_keys = set()
+        async for key in redis.scan_iter(match=f"{KEY_PREFIX}:q:*", count=1000):
+            actual_keys.add(key)
+
+        missing = 0
+        extra = 0
+        affected_users: Set[int] = set()
+        mismatched_keys = []
+
+        for key in actual_keys | set(expected):
+            actual = set(await redis.zrange(key, 0, -1)) if key in actual_keys else set()
+            wanted = expected.get(key, set())
+
+            key_missing = wanted - actual
+            key_extra = actual - wanted
+            if key_missing or key_extra:
+                mismatched_keys.append(key)
+                missing += len(key_missing)
+                extra += len(key_extra)
+                affected_users.update(int(user_id) for user_id in key_missing | key_extra)
+
+        # Профиль мог устареть при верном членстве (имя, окно тихого режима, формат)
+        stale_profiles = 0
+        actual_profiles = set()
+        async for user_id, profile in redis.hscan_iter(PROFILE_KEY, count=1000):
+            actual_profiles.add(user_id)
+            if expected_profiles.get(user_id) != profile:
+                stale_profiles += 1
+                affected_users.add(int(user_id))
+        missing_profiles = set(expected_profiles) - actual_profiles
+        affected_users.update(int(user_id) for user_id in missing_profiles)
+
+        if repair:
+            for user_id in affected_users:
+                await self.refresh_user(session, user_id)
+            # Как после rebuild: все профили теперь в формате PROFILE_VERSION
+            await redis.set(VERSION_KEY, PROFILE_VERSION)
+            await redis.set(BUILT_KEY, len(expected_profiles), nx=True)
+
+        report = {
+            "keys_checked": len(actual_keys | set(expected)),
+            "missing": missing,
+            "extra": extra,
+            "stale_profiles": stale_profiles,
+            "missing_profiles": len(missing_profiles),
+            "affected_users": len(affected_users),
+            "mismatched_keys": sorted(mismatched_keys)[:10],
+            "repaired": repair,
+        }
+
+        if affected_users:
+            logger.warning(f"Recipient index drift: {report}")
+        else:
+            logger.info("Recipient index is consistent with Postgres")
+
+        return report
+
+
+# Глобальный экземпляр индекса
+recipient_index = RecipientIndex()
@@ -0,0 +1,307 @@
+"""
+Recipients
+Потоковое получение получателей рассылки компактными записями (без ORM объектов)
+"""
+
+import logging
+from typing import AsyncIterator, List, Optional, Tuple
+
+from sqlalchemy import select, or_, false
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+from models.user import User
+from models.address import Address, UserAddress
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+
+# Битовые флаги настроек уведомлений
+FLAG_POWER_OFF = 1 << 0
+FLAG_POWER_ON = 1 << 1
+FLAG_WARNINGS = 1 << 2
+FLAG_SCHEDULE = 1 << 3
+FLAG_QUIET_MODE = 1 << 4
+FLAG_MULTI_ADDRESS = 1 << 5  # есть дополнительные адреса (user_addresses) - может следить за несколькими чергами
+
+# За сколько минут до отключения можно получать предупреждения (settings.warning_times);
+# каждому значению соответствует свой флаг, начиная с бита WARNING_FLAGS_SHIFT
+WARNING_LEAD_TIMES = (5, 10, 15, 30, 60, 120)
+WARNING_FLAGS_SHIFT = 8
+
+# Окно тихого режима - минуты от полуночи (start, end), end < start - через полночь
+QuietWindow = Tuple[int, int]
+
+
+class Recipient:
+    """
+    Получатель рассылки: только то, что нужно для отправки
+
+    ~100 байт на запись вместо полного ORM объекта User с identity map.
+    """
+
+    __slots__ = ("user_id", "first_name", "username", "tier", "queue_id", "flags", "quiet_window")
+
+    def __init__(
+            self,
+            user_id: int,
+            first_name: Optional[str],
+            username: Optional[str],
+            tier: str,
+            queue_id: Optional[int],
+            flags: int,
+            quiet_window: Optional[QuietWindow] = None
+    ):
+        self.user_id = user_id
+        self.first_name = first_name
+        self.username = username
+        self.tier = tier
+        self.queue_id = queue_id
+        self.flags = flags
+        self.quiet_window = quiet_window
+
+    def __repr__(self):
+        return f"<Recipient {self.user_id} ({self.tier})>"
+
+
+def warning_flag(minutes_before: int) -> int:
+    """Флаг предупреждения за minutes_before минут (0 - такое время не поддерживается)"""
+    if minutes_before not in WARNING_LEAD_TIMES:
+        return 0
+    return 1 << (WARNING_FLAGS_SHIFT + WARNING_LEAD_TIMES.index(minutes_before))
+
+
+def settings_to_flags(user_settings: Optional[dict]) -> int:
+    """
+    Упаковать JSON настройки пользователя в битовые флаги
+
+    Args:
+        user_settings: Значение колонки users.settings
+
+    Returns:
+        int: Битовая маска FLAG_*
+    """
+    user_settings = user_settings or {}
+
+    if not user_settings.get("notifications_enabled", True):
+        return 0
+
+    flags = 0
+    if user_settings.get("power_off_enabled", True):
+        flags |= FLAG_POWER_OFF
+    if user_settings.get("power_on_enabled", True):
+        flags |= FLAG_POWER_ON
+    if user_settings.get("warnings_enabled", False):
+        flags |= FLAG_WARNINGS
+    if user_settings.get("schedule_enabled", False):
+        flags |= FLAG_SCHEDULE
+    if user_settings.get("quiet_mode_enabled", False) or user_settings.get("night_mode", False):
+        flags |= FLAG_QUIET_MODE
+    for minutes_before in user_settings.get("warning_times") or settings.WARNING_DEFAULT_TIMES:
+        flags |= warning_flag(minutes_before)
+    return flags
+
+
+def parse_clock(value: Optional[str], default: str) -> int:
+    """Время "HH:MM" в минуты от полуночи (некорректное значение - default)"""
+    for candidate in (value, default):
+        try:
+            hours, minutes = str(candidate).split(":")
+            hours, minutes = int(hours), int(minutes)
+        except (TypeError, ValueError):
+            continue
+        if 0 <= hours < 24 and 0 <= minutes < 60:
+            return hours * 60 + minutes
+    return 0
+
+
+def settings_to_quiet_window(user_settings: Optional[dict]) -> Optional[QuietWindow]:
+    """
+    Окно тихого режима пользователя
+
+    Args:
+        user_settings: Значение колонки users.settings
+
+    Returns:
+        tuple: (start, end) в минутах от полуночи; None - тихий режим выключен
+    """
+    user_settings = user_settings or {}
+
+    if not settings_to_flags(user_settings) & FLAG_QUIET_MODE:
+        return None
+
+    start = parse_clock(user_settings.get("quiet_hours_start"), settings.QUIET_HOURS_START)
+    end = parse_clock(user_settings.get("quiet_hours_end"), settings.QUIET_HOURS_END)
+    if start == end:
+        return None
+    return start, end
+
+
+def can_receive_notification(recipient: Recipient, notification_type: str) -> bool:
+    """
+    Проверить, может ли получатель получить уведомление данного типа
+
+    Args:
+        recipient: Получатель
+        notification_type: Тип уведомления
+
+    Returns:
+        bool: Может ли получить уведомление
+    """
+    return can_receive(recipient.flags, recipient.tier, notification_type)
+
+
+def can_receive(flags: int, tier: str, notification_type: str) -> bool:
+    """can_receive_notification по флагам и тарифу, без записи получателя"""
+    if notification_type == "power_off":
+        return bool(flags & FLAG_POWER_OFF)
+    elif notification_type == "power_on":
+        return bool(flags & FLAG_POWER_ON)
+    elif notification_type == "warning":
+        return bool(flags & FLAG_WARNINGS) and tier in ["STANDARD", "PRO"]
+    elif notification_type == "schedule":
+        return bool(flags & FLAG_SCHEDULE) and tier == "PRO"
+
+    # По умолчанию разрешаем
+    return True
+
+
+def filter_recipients(
+        query,
+        queue_id: Optional[int] = None,
+        tier_filter: Optional[List[str]] = None,
+        user_ids: Optional[List[int]] = None,
+        id_range: Optional[Tuple[int, int]] = None
+):
+    """Условия выборки получателей: достижимые, черга (основной или доп. адрес), тариф, ID"""
+    query = query.where(
+        # Совпадает с условием частичного индекса ix_users_reachable
+        User.is_bot_blocked == false(),
+        User.is_blocked.isnot(True)
+    )
+
+    query = query.outerjoin(Address, Address.id == User.primary_address_id)
+
+    if queue_id is not None:
+        # Основной адрес в черге или дополнительный адрес PRO (user_addresses)
+        watched_address = aliased(Address)
+        watchers = select(UserAddress.user_id).join(
+            watched_address, watched_address.id == UserAddress.address_id
+        ).where(watched_address.queue_id == queue_id)
+
+        query = query.where(or_(
+            Address.queue_id == queue_id,
+            User.user_id.in_(watchers)
+        ))
+
+    if tier_filter:
+        query = query.where(User.subscription_tier.in_(tier_filter))
+
+    if user_ids:
+        query = query.where(User.user_id.in_(user_ids))
+
+    if id_range:
+        query = query.where(User.user_id >= id_range[0], User.user_id < id_range[1])
+
+    return query
+
+
+async def stream_recipients(
+        session: AsyncSession,
+        queue_id: Optional[int] = None,
+        notification_type: Optional[str] = None,
+        tier_filter: Optional[List[str]] = None,
+        user_ids: Optional[List[int]] = None,
+        id_range: Optional[Tuple[int, int]] = None,
+        required_flags: int = 0
+) -> AsyncIterator[Recipient]:
+    """
+    Потоково отдать получателей через server-side cursor
+
+    Строки читаются порциями по NOTIFICATION_STREAM_CHUNK, поэтому память
+    не зависит от размера черги.
+
+    Args:
+        session: Database session
+        queue_id: ID черги (None - все пользователи)
+        notification_type: Тип уведомления (для проверки настроек)
+        tier_filter: Фильтр по тарифам
+        user_ids: Конкретные пользователи
+        id_range: Диапазон chat ID [from, to) для шарда рассылки
+        required_flags: Флаги, которые должны быть у получателя (например, warning_flag)
+
+    Yields:
+        Recipient: Компактная запись получателя
+    """
+    has_extra_addresses = select(UserAddress.user_id).where(
+        UserAddress.user_id == User.user_id
+    ).exists()
+
+    query = filter_recipients(
+        select(
+            User.user_id,
+            User.first_name,
+            User.username,
+            User.subscription_tier,
+            User.settings,
+            Address.queue_id,
+            has_extra_addresses
+        ),
+        queue_id=queue_id,
+        tier_filter=tier_filter,
+        user_ids=user_ids,
+        id_range=id_range
+    )
+
+    query = query.execution_options(yield_per=settings.NOTIFICATION_STREAM_CHUNK)
+
+    result = await session.stream(query)
+
+    async for user_id, first_name, username, tier, user_settings, user_queue_id, multi_address in result:
+        flags = settings_to_flags(user_settings)
+        if multi_address:
+            flags |= FLAG_MULTI_ADDRESS
+
+        recipient = Recipient(
+            user_id=user_id,
+            first_name=first_name,
+            username=username,
+            tier=tier,
+            queue_id=queue_id if queue_id is not None else user_queue_id,
+            flags=flags,
+            quiet_window=settings_to_quiet_window(user_settings)
+        )
+
+        if notification_type and not can_receive_notification(recipient, notification_type):
+            continue
+
+        if recipient.flags & required_flags != required_flags:
+            continue
+
+        yield recipient
+
+
+async def stream_recipient_ids(
+        session: AsyncSession,
+        queue_id: int,
+        notification_type: str,
+        tier_filter: Optional[List[str]] = None
+) -> AsyncIterator[int]:
+    """
+    Потоково отдать chat ID получателей черги по возрастанию (нарезка рассылки на шарды)
+
+    Читаются только ID, тариф и настройки; порядок задаёт ORDER BY по первичному
+    ключу, поэтому сортировать список в памяти не нужно.
+    """
+    query = filter_recipients(
+        select(User.user_id, User.subscription_tier, User.settings),
+        queue_id=queue_id,
+        tier_filter=tier_filter
+    ).order_by(User.user_id).execution_options(yield_per=settings.NOTIFICATION_STREAM_CHUNK)
+
+    result = await session.stream(query)
+
+    async for user_id, tier, user_settings in result:
+        if can_receive(settings_to_flags(user_settings), tier, notification_type):
+            yield user_id
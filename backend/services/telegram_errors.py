@@ -0,0 +1,55 @@
+"""
+Telegram Errors
+Классификация ошибок Bot API по ответу sendMessage
+"""
+
+from typing import Optional
+
+
+ERROR_BLOCKED = "blocked"  # 403: bot was blocked by the user
+ERROR_DEACTIVATED = "deactivated"  # 403: user is deactivated
+ERROR_FORBIDDEN = "forbidden"  # 403: прочие (kicked, can't initiate conversation)
+ERROR_CHAT_NOT_FOUND = "chat_not_found"  # 400: chat not found
+ERROR_BAD_REQUEST = "bad_request"  # 400: ошибка в самом запросе (разметка, длина)
+ERROR_RATE_LIMITED = "rate_limited"  # 429: повторы исчерпаны
+ERROR_OTHER = "other"  # 5xx, сеть, таймауты
+ERROR_CANCELLED = "cancelled"  # не отправлено: рассылку отменили
+
+# Получатель недостижим - повторять отправку бессмысленно
+UNREACHABLE_ERRORS = frozenset({
+    ERROR_BLOCKED,
+    ERROR_DEACTIVATED,
+    ERROR_FORBIDDEN,
+    ERROR_CHAT_NOT_FOUND,
+})
+
+
+def classify_error(status_code: Optional[int], description: Optional[str]) -> str:
+    """
+    Определить класс ошибки Telegram
+
+    Args:
+        status_code: HTTP код (error_code из ответа Bot API)
+        description: Поле description из ответа
+
+    Returns:
+        str: Один из ERROR_*
+    """
+    description = (description or "").lower()
+
+    if status_code == 403:
+        if "blocked" in description:
+            return ERROR_BLOCKED
+        if "deactivated" in description:
+            return ERROR_DEACTIVATED
+        return ERROR_FORBIDDEN
+
+    if status_code == 400:
+        if "chat not found" in description or "peer_id_invalid" in description:
+            return ERROR_CHAT_NOT_FOUND
+        return ERROR_BAD_REQUEST
+
+    if status_code == 429:
+        return ERROR_RATE_LIMITED
+
+    return ERROR_OTHER
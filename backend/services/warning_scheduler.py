@@ -0,0 +1,223 @@
+"""
+Warning Scheduler
+Планировщик предупреждений о плановых отключениях: графики -> ZSET моментов отправки в Redis
+"""
+
+import json
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from redis_client import redis_client
+from config import settings
+from models.notification import Schedule
+from services.recipients import WARNING_LEAD_TIMES
+
+logger = logging.getLogger(__name__)
+
+
+DUE_KEY = "warnings:due"  # ZSET "{schedule}:{minutes}" -> момент отправки (unix)
+FIRE_KEY = "warnings:fire"  # HASH член -> JSON предупреждения
+WATERMARK_KEY = "warnings:watermark"  # max(updated_at) уже синхронизированных графиков
+
+# Транзакция, закоммиченная чуть позже соседней, может иметь меньший updated_at:
+# окно перекрытия перечитывает такие строки (повторная синхронизация идемпотентна)
+WATERMARK_OVERLAP = timedelta(seconds=10)
+
+SENT_TTL = 2 * 86400  # секунд храним уже отданные в Celery предупреждения графика
+
+# Заменить моменты отправки одного графика
+# KEYS[1] - ZSET моментов, KEYS[2] - HASH предупреждений, KEYS[3] - SET членов графика,
+# KEYS[4] - HASH уже отданных в Celery (член -> JSON)
+# ARGV[1] - TTL SET (сек), ARGV[2..] - тройки: член, момент отправки, JSON
+# Уже отданное предупреждение с тем же JSON повторно не планируется
+REPLACE_SCRIPT = """
+for _, member in ipairs(redis.call('SMEMBERS', KEYS[3])) do
+    redis.call('ZREM', KEYS[1], member)
+    redis.call('HDEL', KEYS[2], member)
+end
+redis.call('DEL', KEYS[3])
+local planned = 0
+for i = 2, #ARGV, 3 do
+    if redis.call('HGET', KEYS[4], ARGV[i]) ~= ARGV[i + 2] then
+        redis.call('ZADD', KEYS[1], ARGV[i + 1], ARGV[i])
+        redis.call('HSET', KEYS[2], ARGV[i], ARGV[i + 2])
+        redis.call('SADD', KEYS[3], ARGV[i])
+        planned = planned + 1
+    end
+end
+if planned > 0 then
+    redis.call('EXPIRE', KEYS[3], ARGV[1])
+end
+return planned
+"""
+
+# Забрать выбранные предупреждения, момент отправки которых не позже ARGV[1]
+# KEYS[1] - ZSET моментов, KEYS[2] - HASH предупреждений,
+# KEYS[2 + i] - HASH отданных графика члена ARGV[2 + i] (все ключи передаются явно)
+# ARGV[2] - TTL отданных, ARGV[3..] - члены из ZRANGEBYSCORE
+POP_SCRIPT = """
+local fires = {}
+for i = 3, #ARGV do
+    local member = ARGV[i]
+    local score = redis.call('ZSCORE', KEYS[1], member)
+    if score and tonumber(score) <= tonumber(ARGV[1]) then
+        local fire = redis.call('HGET', KEYS[2], member)
+        if fire then
+            table.insert(fires, fire)
+            redis.call('HSET', KEYS[i], member, fire)
+            redis.call('EXPIRE', KEYS[i], ARGV[2])
+        end
+        redis.call('ZREM', KEYS[1], member)
+        redis.call('HDEL', KEYS[2], member)
+    end
+end
+return fires
+"""
+
+
+def schedule_key(schedule_id: int) -> str:
+    return f"warnings:schedule:{schedule_id}"
+
+
+def sent_key(schedule_id: int) -> str:
+    return f"warnings:sent:{schedule_id}"
+
+
+def lead_times() -> List[int]:
+    """За сколько минут предупреждать: значения по умолчанию + все, что можно выбрать в warning_times"""
+    return sorted(set(settings.WARNING_DEFAULT_TIMES) | set(WARNING_LEAD_TIMES), reverse=True)
+
+
+class WarningScheduler:
+    """
+    Двухуровневое колесо таймеров для предупреждений
+
+    - грубый уровень: ZSET warnings:due в Redis со всеми будущими моментами
+      отправки (графики x lead_times); меняется только при изменении графика
+    - точный уровень: раз в WARNING_SCHEDULER_INTERVAL моменты ближайших
+      WARNING_SCHEDULER_LOOKAHEAD секунд забираются из ZSET и ставятся
+      в Celery с eta - воркер сам отправляет задачу в нужную долю секунды
+
+    Изменения графиков читаются инкрементально по schedules.updated_at
+    (watermark в Redis), без полного пересмотра таблицы. Удалённые
+    и перенесённые графики отсекаются проверкой при отправке (is_current).
+    """
+
+    def __init__(self):
+        self._scripts: Dict[str, Any] = {}
+
+    async def _script(self, name: str, source: str):
+        redis = await redis_client.get_connection()
+        if name not in self._scripts:
+            self._scripts[name] = redis.register_script(source)
+        return self._scripts[name]
+
+    async def sync(self, session: AsyncSession, now: Optional[datetime] = None) -> Dict[str, int]:
+        """
+        Подхватить новые и изменённые графики
+
+        Первый запуск (нет watermark) загружает все будущие графики,
+        дальше - только строки с updated_at новее watermark.
+
+        Returns:
+            dict: Сколько графиков прочитано и моментов отправки запланировано
+        """
+        now = now or datetime.now(timezone.utc)
+        redis = await redis_client.get_connection()
+
+        query = select(Schedule.id, Schedule.queue_id, Schedule.start_time, Schedule.updated_at)
+
+        watermark = await redis.get(WATERMARK_KEY)
+        if watermark:
+            query = query.where(Schedule.updated_at > datetime.fromisoformat(watermark) - WATERMARK_OVERLAP)
+        else:
+            query = query.where(Schedule.start_time > now)
+
+        rows = (await session.execute(query.order_by(Schedule.updated_at))).all()
+        if not rows:
+            return {"schedules": 0, "fires": 0}
+
+        replace = await self._script("replace", REPLACE_SCRIPT)
+        not_before = now - timedelta(seconds=settings.WARNING_MAX_LATENESS)
+
+        fires = 0
+        for schedule_id, queue_id, start_time, _ in rows:
+            args: List[Any] = [max(1, int((start_time - now).total_seconds()) + 86400)]
+
+            for minutes_before in lead_times():
+                fire_at = start_time - timedelta(minutes=minutes_before)
+                if fire_at < not_before:
+                    continue
+                args.extend([
+                    f"{schedule_id}:{minutes_before}",
+                    fire_at.timestamp(),
+                    json.dumps({
+                        "schedule_id": schedule_id,
+                        "queue_id": queue_id,
+                        "minutes_before": minutes_before,
+                        "start_time": start_time.isoformat(),
+                        "fire_at": fire_at.timestamp(),
+                    }),
+                ])
+
+            fires += await replace(
+                keys=[DUE_KEY, FIRE_KEY, schedule_key(schedule_id), sent_key(schedule_id)],
+                args=args
+            )
+
+        await redis.set(WATERMARK_KEY, rows[-1][3].isoformat())
+
+        logger.info(f"Warning scheduler synced {len(rows)} schedules, {fires} warnings planned")
+        return {"schedules": len(rows), "fires": fires}
+
+    async def pop_due(self, lookahead: Optional[int] = None, now: Optional[datetime] = None) -> List[Dict[str, Any]]:
+        """
+        Забрать предупреждения на ближайшие lookahead секунд
+
+        Returns:
+            list: schedule_id, queue_id, minutes_before, start_time, fire_at (unix)
+        """
+        now = now or datetime.now(timezone.utc)
+        horizon = now.timestamp() + (lookahead if lookahead is not None else settings.WARNING_SCHEDULER_LOOKAHEAD)
+
+        # Ключи отданных зависят от графика члена - выбираем члены заранее,
+        # скрипт перепроверяет момент отправки (член могли перепланировать)
+        redis = await redis_client.get_connection()
+        members = await redis.zrangebyscore(DUE_KEY, "-inf", horizon)
+        if not members:
+            return []
+
+        pop = await self._script("pop", POP_SCRIPT)
+        fires = await pop(
+            keys=[DUE_KEY, FIRE_KEY, *(sent_key(int(member.split(":")[0])) for member in members)],
+            args=[horizon, SENT_TTL, *members]
+        )
+        fires = [json.loads(fire) for fire in fires]
+        return sorted(fires, key=lambda fire: fire["fire_at"])
+
+    async def is_current(self, session: AsyncSession, schedule_id: int, start_time: datetime) -> bool:
+        """Актуален ли график на момент отправки (не удалён и не перенесён)"""
+        actual = await session.scalar(
+            select(Schedule.start_time).where(Schedule.id == schedule_id)
+        )
+        return actual is not None and actual == start_time
+
+    async def stats(self) -> Dict[str, Any]:
+        """Сколько предупреждений запланировано и ближайшее из них"""
+        redis = await redis_client.get_connection()
+        upcoming = await redis.zrange(DUE_KEY, 0, 0, withscores=True)
+        return {
+            "planned": await redis.zcard(DUE_KEY),
+            "next_fire_at": (
+                datetime.fromtimestamp(upcoming[0][1], tz=timezone.utc).isoformat() if upcoming else None
+            ),
+            "watermark": await redis.get(WATERMARK_KEY),
+        }
+
+
+# Глобальный экземпляр планировщика
+warning_scheduler = WarningScheduler()
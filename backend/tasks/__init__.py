@@ -2,24 +2,43 @@
 Tasks package for Celery background jobs
 """
 
-# Импортируем только задачи уведомлений (остальные задачи будут добавлены позже)
+# Задачи уведомлений и IoT
 from .notification_tasks import (
     send_queue_notification,
+    send_fanout_shard,
+    finalize_fanout,
+    notify_queue_status,
     send_power_off_notification,
     send_power_on_notification,
+    flush_merged_notifications,
+    retry_dead_letters,
     send_warning_notifications,
+    schedule_warnings,
     send_custom_notification,
+    release_quiet_notifications,
     cleanup_old_notifications,
+    check_recipient_index,
     test_notification,
 )
+from .iot_tasks import sync_iot_pings
 
 __all__ = [
     # Notification tasks
     "send_queue_notification",
+    "send_fanout_shard",
+    "finalize_fanout",
+    "notify_queue_status",
     "send_power_off_notification",
     "send_power_on_notification",
+    "flush_merged_notifications",
+    "retry_dead_letters",
     "send_warning_notifications",
+    "schedule_warnings",
     "send_custom_notification",
+    "release_quiet_notifications",
     "cleanup_old_notifications",
+    "check_recipient_index",
     "test_notification",
+    # IoT tasks
+    "sync_iot_pings",
 ]
\ No newline at end of file
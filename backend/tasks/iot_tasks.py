@@ -0,0 +1,30 @@
+"""
+IoT Tasks
+Celery задачи для IoT сенсоров
+"""
+
+import logging
+
+from celery_app import celery_app
+from tasks.runtime import AsyncTask
+from services.iot_registry import iot_registry
+
+logger = logging.getLogger(__name__)
+
+
+@celery_app.task(
+    bind=True,
+    base=AsyncTask,
+    name="tasks.iot_tasks.sync_iot_pings",
+)
+async def sync_iot_pings(self):
+    """
+    Перенос времени последних пингов сенсоров в iot_sensors.last_ping_at
+    Запускается раз в IOT_PING_SYNC_INTERVAL секунд через Celery Beat
+
+    Пинги пишутся только в Redis (services.iot_registry), здесь они
+    уходят в Postgres одним UPDATE на все сенсоры.
+    """
+    updated = await iot_registry.sync_pings()
+    logger.info(f"Synced pings of {updated} IoT sensors")
+    return {"updated": updated}
@@ -3,35 +3,113 @@ Notification Tasks
 Celery задачи для отправки уведомлений
 """
 
-import asyncio
 import logging
-from datetime import datetime, timedelta
-from typing import List, Optional
-from sqlalchemy import select, delete
-from celery import Task
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+from uuid import uuid4
+from sqlalchemy import delete
+from celery import chord
 
 from celery_app import celery_app
+from tasks.runtime import AsyncTask
 from database import get_session
-from models.user import User
+from config import settings
 from models.notification import Notification
-from models.queue import Queue
 from services.notification_service import notification_service
+from services.recipients import stream_recipients
+from services.recipient_index import recipient_index
+from services.delivery_journal import DeliveryJournal
+from services.fanout import FanoutProgress, plan_shards, merge_tier_stats, tier_report
+from services.rate_limiter import lane_for
+from services.power_status import power_status_coalescer
+from services.quiet_hours import is_night, local_now
+from services.recipients import warning_flag
+from services.warning_scheduler import warning_scheduler
+from services.outage_trace import outage_tracer, STAGE_TASK_START, STAGE_RECIPIENTS_RESOLVED
 
 logger = logging.getLogger(__name__)
 
 
-class AsyncTask(Task):
+async def dispatch_fanout(
+        fanout_id: str,
+        queue_id: int,
+        notification_type: str,
+        message_template: str,
+        disable_notification: bool = False,
+        tier_filter: Optional[List[str]] = None,
+        trace_id: Optional[str] = None,
+        required_flags: int = 0
+) -> Dict[str, Any]:
     """
-    Базовый класс для асинхронных Celery задач
+    Разбить рассылку черги на шарды и запустить их параллельно (chord)
+
+    Шарды - диапазоны chat ID по FANOUT_SHARD_SIZE получателей одной группы
+    тарифов, каждый обрабатывается отдельной задачей send_fanout_shard
+    на любом воркере. Шарды ставятся в очередь в порядке FANOUT_TIER_ORDER:
+    PRO получают сообщение первыми.
+    Общий темп держит token bucket в Redis, поэтому шарды не превышают
+    лимит Bot API, а каждая задача укладывается в task_time_limit.
+    Итог собирает finalize_fanout, live-прогресс - FanoutProgress.
+
+    Args:
+        fanout_id: ID рассылки (ключ прогресса)
+        queue_id: ID очереди
+        notification_type: Тип уведомления
+        message_template: Шаблон сообщения
+        disable_notification: Тихое уведомление
+        tier_filter: Фильтр по тарифам
+        trace_id: ID события отключения (services.outage_trace)
+        required_flags: Флаги, которые должны быть у получателя (проверяются шардами)
+
+    Returns:
+        dict: ID рассылки, число получателей и шардов
     """
+    # Время фиксируется один раз: {time}/{date} одинаковые во всех шардах
+    dispatched_at = datetime.now()
 
-    def __call__(self, *args, **kwargs):
-        return asyncio.get_event_loop().run_until_complete(
-            self.run_async(*args, **kwargs)
-        )
+    async with get_session() as session:
+        total, shards = await plan_shards(session, queue_id, notification_type, tier_filter)
+    await outage_tracer.mark(trace_id, STAGE_RECIPIENTS_RESOLVED)
 
-    async def run_async(self, *args, **kwargs):
-        raise NotImplementedError()
+    progress = FanoutProgress(fanout_id, trace_id)
+    await progress.start(
+        queue_id=queue_id,
+        notification_type=notification_type,
+        total=total,
+        shards=len(shards)
+    )
+
+    if not shards:
+        logger.warning(f"No users found for queue {queue_id}")
+        await progress.finish()
+        await outage_tracer.complete(trace_id)
+        return {"fanout_id": fanout_id, "total": 0, "shards": 0}
+
+    # Шарды и финализатор идут в полосу приоритета своего типа уведомления
+    lane = lane_for(notification_type)
+
+    chord(
+        send_fanout_shard.s(
+            fanout_id,
+            queue_id,
+            notification_type,
+            message_template,
+            disable_notification,
+            tiers,
+            list(id_range),
+            dispatched_at.isoformat(),
+            trace_id,
+            required_flags
+        ).set(queue=lane)
+        for tiers, id_range in shards
+    )(finalize_fanout.s(fanout_id, queue_id, trace_id).set(queue=lane))
+
+    logger.info(
+        f"Fanout {fanout_id}: queue {queue_id}, {total} recipients in {len(shards)} shards"
+    )
+
+    return {"fanout_id": fanout_id, "total": total, "shards": len(shards)}
 
 
 @celery_app.task(
@@ -52,6 +130,11 @@ async def send_queue_notification(
     """
     Отправка уведомления всем пользователям очереди
 
+    Сама задача только планирует шарды (см. dispatch_fanout),
+    fanout_id совпадает с ID этой задачи. ID не меняется при self.retry,
+    поэтому повтор не шлёт сообщение тем, кто уже отмечен в чекпоинте
+    рассылки (services.delivery_checkpoint).
+
     Args:
         queue_id: ID очереди
         notification_type: Тип уведомления (power_on, power_off, warning, etc.)
@@ -61,6 +144,58 @@ async def send_queue_notification(
     """
     logger.info(f"Task started: send_queue_notification for queue {queue_id}")
 
+    try:
+        return await dispatch_fanout(
+            fanout_id=self.request.id or uuid4().hex,
+            queue_id=queue_id,
+            notification_type=notification_type,
+            message_template=message_template,
+            disable_notification=disable_notification,
+            tier_filter=tier_filter
+        )
+
+    except Exception as exc:
+        logger.error(f"Task failed: {exc}")
+        raise self.retry(exc=exc)
+
+
+@celery_app.task(
+    bind=True,
+    base=AsyncTask,
+    name="tasks.notification_tasks.send_fanout_shard",
+    max_retries=3,
+    default_retry_delay=60
+)
+async def send_fanout_shard(
+        self,
+        fanout_id: str,
+        queue_id: int,
+        notification_type: str,
+        message_template: str,
+        disable_notification: bool,
+        tier_filter: Optional[List[str]],
+        id_range: List[int],
+        dispatched_at: str,  # ISO format datetime string
+        trace_id: Optional[str] = None,
+        required_flags: int = 0
+):
+    """
+    Отправка одного шарда рассылки (получатели с chat ID в [from, to))
+
+    Args:
+        fanout_id: ID рассылки
+        queue_id: ID очереди
+        notification_type: Тип уведомления
+        message_template: Шаблон сообщения
+        disable_notification: Тихое уведомление
+        tier_filter: Тарифы шарда (группа FANOUT_TIER_ORDER)
+        id_range: Диапазон chat ID [from, to)
+        dispatched_at: Время запуска рассылки (ISO format)
+        trace_id: ID события отключения (services.outage_trace)
+        required_flags: Флаги, которые должны быть у получателя
+    """
+    progress = FanoutProgress(fanout_id, trace_id)
+
     try:
         async with get_session() as session:
             result = await notification_service.send_queue_notification(
@@ -69,20 +204,258 @@ async def send_queue_notification(
                 notification_type=notification_type,
                 message_template=message_template,
                 disable_notification=disable_notification,
-                tier_filter=tier_filter
+                tier_filter=tier_filter,
+                id_range=(id_range[0], id_range[1]),
+                progress=progress,
+                dispatched_at=datetime.fromisoformat(dispatched_at),
+                required_flags=required_flags
             )
 
-            logger.info(
-                f"Task completed: {result['success']} sent, {result['failed']} failed"
+        await progress.shard_done()
+
+        logger.info(
+            f"Fanout {fanout_id} shard {id_range}: "
+            f"{result['success']} sent, {result['failed']} failed"
+        )
+
+        return result
+
+    except Exception as exc:
+        logger.error(f"Fanout {fanout_id} shard {id_range} failed: {exc}")
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=exc)
+
+        # Повторы исчерпаны: не ронять chord, иначе finalize_fanout не запустится,
+        # рассылка останется "running" и заблокирует power_status_coalescer
+        return {
+            "total": 0,
+            "success": 0,
+            "failed": 0,
+            "shard_failed": True,
+            "errors": [{"id_range": id_range, "error": str(exc)}],
+        }
+
+
+@celery_app.task(
+    bind=True,
+    base=AsyncTask,
+    name="tasks.notification_tasks.finalize_fanout",
+)
+async def finalize_fanout(
+        self,
+        shard_results: List[Dict[str, Any]],
+        fanout_id: str,
+        queue_id: int,
+        trace_id: Optional[str] = None
+):
+    """
+    Финализатор chord: сводная статистика по всем шардам рассылки
+
+    Запускается и при упавших шардах: после всех повторов шард возвращает
+    результат с shard_failed, рассылка завершается со статусом "failed".
+
+    Args:
+        shard_results: Результаты send_fanout_shard
+        fanout_id: ID рассылки
+        queue_id: ID очереди
+        trace_id: ID события отключения (services.outage_trace)
+    """
+    errors = []
+    error_codes: Dict[str, int] = {}
+    tier_stats: Dict[str, Dict[str, int]] = {}
+    for shard in shard_results:
+        errors.extend(shard.get("errors", []))
+        for error_code, count in shard.get("error_codes", {}).items():
+            error_codes[error_code] = error_codes.get(error_code, 0) + count
+        merge_tier_stats(tier_stats, shard.get("tier_stats", {}))
+    tiers = tier_report(tier_stats)
+    paid = sum(shard.get("paid", 0) for shard in shard_results)
+
+    result = {
+        "fanout_id": fanout_id,
+        "shards": len(shard_results),
+        # Шарды, не отправленные после всех повторов
+        "failed_shards": sum(1 for shard in shard_results if shard.get("shard_failed")),
+        "total": sum(shard["total"] for shard in shard_results),
+        "success": sum(shard["success"] for shard in shard_results),
+        "failed": sum(shard["failed"] for shard in shard_results),
+        "cancelled": sum(shard.get("cancelled", 0) for shard in shard_results),
+        "deferred": sum(shard.get("deferred", 0) for shard in shard_results),
+        "merged": sum(shard.get("merged", 0) for shard in shard_results),
+        "skipped": sum(shard.get("skipped", 0) for shard in shard_results),
+        "retrying": sum(shard.get("retrying", 0) for shard in shard_results),
+        "paid": paid,
+        # Платная рассылка: стоимость в Telegram Stars
+        "paid_cost_stars": round(paid * settings.TELEGRAM_PAID_STARS_PER_MESSAGE, 2),
+        "error_codes": error_codes,
+        "tiers": tiers,
+        "errors": errors[:10]
+    }
+
+    for tier, report in tiers.items():
+        if report["within_slo"] < report["sent"]:
+            logger.warning(
+                f"Fanout {fanout_id} {tier} SLO missed: {report['sent'] - report['within_slo']} "
+                f"of {report['sent']} later than {report['slo_s']}s (max {report['max_delay_s']}s)"
             )
 
-            return result
+    progress = FanoutProgress(fanout_id)
+    if not await progress.refresh_cancelled():
+        await progress.finish(status="failed" if result["failed_shards"] else "done", tiers=tiers, paid=paid)
+    await power_status_coalescer.fanout_finished(queue_id, fanout_id)
+    await outage_tracer.complete(trace_id)
+
+    logger.info(
+        f"Fanout {fanout_id} completed: {result['total']} total, "
+        f"{result['success']} sent, {result['failed']} failed, "
+        f"{result['failed_shards']} shards failed, {result['paid']} paid ({result['paid_cost_stars']} Stars)"
+    )
+
+    return result
+
+
+# Шаблоны уведомлений о статусе черги
+POWER_OFF_MESSAGE = (
+    "⚡️ <b>Відключення світла</b>\n\n"
+    "🔴 Світло відключено\n"
+    "🔌 Черга: {queue}\n"
+    "⏰ Час: {time}\n\n"
+    "Ми повідомимо вас, коли світло з'явиться."
+)
+
+POWER_ON_MESSAGE = (
+    "⚡️ <b>Включення світла</b>\n\n"
+    "🟢 Світло з'явилось!\n"
+    "🔌 Черга: {queue}\n"
+    "⏰ Час: {time}"
+)
+
+
+async def dispatch_power_fanout(
+        fanout_id: str,
+        queue_id: int,
+        is_power_on: bool,
+        trace_id: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Рассылка power_on / power_off всей черге
+
+    Args:
+        fanout_id: ID рассылки
+        queue_id: ID очереди
+        is_power_on: Новое состояние черги
+        trace_id: ID события отключения (services.outage_trace)
+    """
+    # Ночью без звука (QUIET_HOURS_START - QUIET_HOURS_END по Киеву);
+    # пользователям в тихом режиме сообщение отложится до конца их окна
+    disable_notification = is_night()
+
+    return await dispatch_fanout(
+        fanout_id=fanout_id,
+        queue_id=queue_id,
+        notification_type="power_on" if is_power_on else "power_off",
+        message_template=POWER_ON_MESSAGE if is_power_on else POWER_OFF_MESSAGE,
+        disable_notification=disable_notification,
+        trace_id=trace_id
+    )
+
+
+@celery_app.task(
+    bind=True,
+    base=AsyncTask,
+    name="tasks.notification_tasks.notify_queue_status",
+    max_retries=3,
+    default_retry_delay=10
+)
+async def notify_queue_status(
+        self,
+        queue_id: int,
+        generation: Optional[int],
+        is_power_on: Optional[bool] = None,
+        event_id: Optional[str] = None
+):
+    """
+    Рассылка статуса черги после debounce (см. services.power_status)
+
+    Если за время ожидания пришёл новый переход, задача ничего не делает:
+    рассылку выполнит задача последнего поколения.
+
+    Args:
+        queue_id: ID очереди
+        generation: Поколение перехода (None - коалесцер недоступен, слать is_power_on)
+        is_power_on: Состояние для рассылки без коалесцера
+        event_id: ID события отключения (services.outage_trace)
+    """
+    fanout_id = self.request.id or uuid4().hex
+    await outage_tracer.mark(event_id, STAGE_TASK_START)
+
+    try:
+        if generation is not None:
+            is_power_on = await power_status_coalescer.claim(queue_id, generation, fanout_id)
+            if is_power_on is None:
+                logger.info(f"Queue {queue_id} transition {generation} superseded, skipping")
+                return {"queue_id": queue_id, "generation": generation, "skipped": True}
+
+        logger.info(f"Sending power {'ON' if is_power_on else 'OFF'} notification to queue {queue_id}")
+
+        return await dispatch_power_fanout(fanout_id, queue_id, is_power_on, trace_id=event_id)
 
     except Exception as exc:
-        logger.error(f"Task failed: {exc}")
+        logger.error(f"Queue status notification failed: {exc}")
+        # Retry идёт с тем же request.id и снова захватит переход (см. claim);
+        # после последней попытки захват снимается, чтобы не глушить следующий переход
+        if generation is not None and self.request.retries >= self.max_retries:
+            await power_status_coalescer.release(queue_id, fanout_id)
         raise self.retry(exc=exc)
 
 
+@celery_app.task(
+    bind=True,
+    base=AsyncTask,
+    name="tasks.notification_tasks.flush_merged_notifications",
+)
+async def flush_merged_notifications(self):
+    """
+    Отправка склеенных power_on/off пользователям с несколькими адресами
+
+    Ставится шардами рассылки с countdown до конца окна склейки;
+    раз в минуту запускается ещё и через Celery Beat (страховка).
+    """
+    return await notification_service.flush_merged()
+
+
+@celery_app.task(
+    bind=True,
+    base=AsyncTask,
+    name="tasks.notification_tasks.retry_dead_letters",
+)
+async def retry_dead_letters(self):
+    """
+    Повтор отправки получателям с временными ошибками (dead-letter)
+    Запускается раз в 30 секунд через Celery Beat
+
+    Выборки по DEAD_LETTER_BATCH_SIZE, пока есть наступившие повторы
+    и не исчерпан DEAD_LETTER_TIME_BUDGET. Каждое сообщение уходит
+    в полосе своей рассылки.
+    """
+    deadline = time.monotonic() + settings.DEAD_LETTER_TIME_BUDGET
+
+    totals = {"total": 0, "success": 0, "failed": 0, "rescheduled": 0, "dropped": 0}
+
+    while time.monotonic() < deadline:
+        batch = await notification_service.retry_dead_letters()
+        if not batch["total"]:
+            break
+
+        for key in totals:
+            totals[key] += batch[key]
+
+    if totals["total"]:
+        logger.info(f"Dead letters: {totals}")
+
+    return totals
+
+
 @celery_app.task(
     bind=True,
     base=AsyncTask,
@@ -92,32 +465,14 @@ async def send_queue_notification(
 )
 async def send_power_off_notification(self, queue_id: int):
     """
-    Отправка уведомления об отключении света
+    Отправка уведомления об отключении света (сразу, без debounce)
 
     Args:
         queue_id: ID очереди
     """
     logger.info(f"Sending power OFF notification to queue {queue_id}")
 
-    # Шаблон сообщения
-    message = (
-        "⚡️ <b>Відключення світла</b>\n\n"
-        "🔴 Світло відключено\n"
-        "🔌 Черга: {queue}\n"
-        "⏰ Час: {time}\n\n"
-        "Ми повідомимо вас, коли світло з'явиться."
-    )
-
-    # Определяем тихое уведомление (с 23:00 до 07:00)
-    current_hour = datetime.now().hour
-    disable_notification = 23 <= current_hour or current_hour < 7
-
-    return await send_queue_notification(
-        queue_id=queue_id,
-        notification_type="power_off",
-        message_template=message,
-        disable_notification=disable_notification
-    )
+    return await dispatch_power_fanout(self.request.id or uuid4().hex, queue_id, is_power_on=False)
 
 
 @celery_app.task(
@@ -129,31 +484,14 @@ async def send_power_off_notification(self, queue_id: int):
 )
 async def send_power_on_notification(self, queue_id: int):
     """
-    Отправка уведомления о включении света
+    Отправка уведомления о включении света (сразу, без debounce)
 
     Args:
         queue_id: ID очереди
     """
     logger.info(f"Sending power ON notification to queue {queue_id}")
 
-    # Шаблон сообщения
-    message = (
-        "⚡️ <b>Включення світла</b>\n\n"
-        "🟢 Світло з'явилось!\n"
-        "🔌 Черга: {queue}\n"
-        "⏰ Час: {time}"
-    )
-
-    # Определяем тихое уведомление (с 23:00 до 07:00)
-    current_hour = datetime.now().hour
-    disable_notification = 23 <= current_hour or current_hour < 7
-
-    return await send_queue_notification(
-        queue_id=queue_id,
-        notification_type="power_on",
-        message_template=message,
-        disable_notification=disable_notification
-    )
+    return await dispatch_power_fanout(self.request.id or uuid4().hex, queue_id, is_power_on=True)
 
 
 @celery_app.task(
@@ -167,16 +505,20 @@ async def send_warning_notifications(
         self,
         queue_id: int,
         minutes_before: int,
-        scheduled_time: str  # ISO format datetime string
+        scheduled_time: str,  # ISO format datetime string
+        schedule_id: Optional[int] = None
 ):
     """
     Отправка предупреждений о предстоящем отключении
-    Только для пользователей с тарифами STANDARD и PRO
+    Только для пользователей с тарифами STANDARD и PRO, у которых
+    minutes_before есть в warning_times
 
     Args:
         queue_id: ID очереди
         minutes_before: За сколько минут до отключения
         scheduled_time: Время отключения (ISO format)
+        schedule_id: График, по которому запланировано предупреждение
+            (services.warning_scheduler) - удалённый или перенесённый пропускается
     """
     logger.info(
         f"Sending warning notifications to queue {queue_id}, "
@@ -185,7 +527,14 @@ async def send_warning_notifications(
 
     try:
         scheduled_dt = datetime.fromisoformat(scheduled_time)
-        time_str = scheduled_dt.strftime("%H:%M")
+
+        if schedule_id is not None:
+            async with get_session() as session:
+                if not await warning_scheduler.is_current(session, schedule_id, scheduled_dt):
+                    logger.info(f"Schedule {schedule_id} changed or removed, warning skipped")
+                    return {"schedule_id": schedule_id, "skipped": True}
+
+        time_str = local_now(scheduled_dt).strftime("%H:%M")
 
         message = (
             f"⚠️ <b>Попередження</b>\n\n"
@@ -196,12 +545,14 @@ async def send_warning_notifications(
         )
 
         # Отправляем только пользователям с STANDARD и PRO
-        return await send_queue_notification(
+        return await dispatch_fanout(
+            fanout_id=self.request.id or uuid4().hex,
             queue_id=queue_id,
             notification_type="warning",
             message_template=message,
             disable_notification=False,
-            tier_filter=["STANDARD", "PRO"]
+            tier_filter=["STANDARD", "PRO"],
+            required_flags=warning_flag(minutes_before)
         )
 
     except Exception as exc:
@@ -209,6 +560,46 @@ async def send_warning_notifications(
         raise self.retry(exc=exc)
 
 
+@celery_app.task(
+    bind=True,
+    base=AsyncTask,
+    name="tasks.notification_tasks.schedule_warnings",
+)
+async def schedule_warnings(self):
+    """
+    Планирование предупреждений по графикам отключений
+    Запускается раз в WARNING_SCHEDULER_INTERVAL секунд через Celery Beat
+
+    Подхватывает изменённые графики и ставит предупреждения ближайших
+    WARNING_SCHEDULER_LOOKAHEAD секунд в Celery с точным eta.
+    """
+    async with get_session() as session:
+        synced = await warning_scheduler.sync(session)
+
+    now = datetime.now(timezone.utc)
+    max_lateness = timedelta(seconds=settings.WARNING_MAX_LATENESS)
+
+    queued = 0
+    for fire in await warning_scheduler.pop_due():
+        fire_at = datetime.fromtimestamp(fire["fire_at"], tz=timezone.utc)
+        if fire_at < now - max_lateness:
+            logger.warning(f"Warning {fire} is too late, skipped")
+            continue
+
+        send_warning_notifications.apply_async(
+            args=[fire["queue_id"], fire["minutes_before"], fire["start_time"]],
+            kwargs={"schedule_id": fire["schedule_id"]},
+            eta=fire_at,
+            expires=fire_at + max_lateness
+        )
+        queued += 1
+
+    if queued:
+        logger.info(f"Queued {queued} warnings for the next {settings.WARNING_SCHEDULER_LOOKAHEAD}s")
+
+    return {**synced, "queued": queued}
+
+
 @celery_app.task(
     bind=True,
     base=AsyncTask,
@@ -235,55 +626,36 @@ async def send_custom_notification(
     logger.info(f"Sending custom notification to queue {queue_id or 'ALL'}")
 
     try:
+        # Если queue_id указан (и нет конкретных пользователей) - шардированная рассылка
+        if queue_id and not user_ids:
+            return await dispatch_fanout(
+                fanout_id=self.request.id or uuid4().hex,
+                queue_id=queue_id,
+                notification_type="custom",
+                message_template=message,
+                disable_notification=False,
+                tier_filter=tier_filter
+            )
+
         async with get_session() as session:
-            # Если указаны конкретные пользователи
-            if user_ids:
-                result = await session.execute(
-                    select(User).where(
-                        User.user_id.in_(user_ids),
-                        User.is_active == True,
-                        User.is_bot_blocked == False
-                    )
-                )
-                users = result.scalars().all()
+            # Конкретные пользователи или все пользователи - потоком
+            recipients = stream_recipients(
+                session,
+                tier_filter=tier_filter,
+                user_ids=user_ids
+            )
 
+            journal = DeliveryJournal("custom")
+            try:
                 return await notification_service.send_batch(
-                    users=users,
+                    users=recipients,
                     message_template=message,
                     notification_type="custom",
-                    disable_notification=False
-                )
-
-            # Если queue_id указан
-            elif queue_id:
-                return await notification_service.send_queue_notification(
-                    session=session,
-                    queue_id=queue_id,
-                    notification_type="custom",
-                    message_template=message,
                     disable_notification=False,
-                    tier_filter=tier_filter
-                )
-
-            # Отправка всем пользователям
-            else:
-                query = select(User).where(
-                    User.is_active == True,
-                    User.is_bot_blocked == False
-                )
-
-                if tier_filter:
-                    query = query.where(User.subscription_tier.in_(tier_filter))
-
-                result = await session.execute(query)
-                users = result.scalars().all()
-
-                return await notification_service.send_batch(
-                    users=users,
-                    message_template=message,
-                    notification_type="custom",
-                    disable_notification=False
+                    journal=journal
                 )
+            finally:
+                await journal.close()
 
     except Exception as exc:
         logger.error(f"Custom notification failed: {exc}")
@@ -323,6 +695,60 @@ async def cleanup_old_notifications(self):
         raise
 
 
+@celery_app.task(
+    bind=True,
+    base=AsyncTask,
+    name="tasks.notification_tasks.release_quiet_notifications",
+)
+async def release_quiet_notifications(self):
+    """
+    Выдача сообщений, отложенных тихим режимом
+    Запускается раз в минуту через Celery Beat
+
+    Волны по QUIET_RELEASE_WAVE_SIZE, пока есть наступившие сообщения
+    и не исчерпан QUIET_RELEASE_TIME_BUDGET (следующий запуск продолжит).
+    """
+    deadline = time.monotonic() + settings.QUIET_RELEASE_TIME_BUDGET
+
+    totals = {"waves": 0, "total": 0, "success": 0, "failed": 0}
+
+    while time.monotonic() < deadline:
+        wave = await notification_service.release_deferred()
+        if not wave["total"]:
+            break
+
+        totals["waves"] += 1
+        for key in ("total", "success", "failed"):
+            totals[key] += wave[key]
+
+    if totals["total"]:
+        logger.info(f"Quiet hours release: {totals}")
+
+    return totals
+
+
+@celery_app.task(
+    bind=True,
+    base=AsyncTask,
+    name="tasks.notification_tasks.check_recipient_index",
+)
+async def check_recipient_index(self, repair: bool = True):
+    """
+    Сверка индекса получателей в Redis с Postgres
+    Запускается раз в день через Celery Beat
+
+    Args:
+        repair: Исправить найденные расхождения
+    """
+    logger.info("Checking recipient index consistency")
+
+    async with get_session() as session:
+        if not await recipient_index.is_ready():
+            return await recipient_index.rebuild(session)
+
+        return await recipient_index.check(session, repair=repair)
+
+
 @celery_app.task(
     bind=True,
     base=AsyncTask,
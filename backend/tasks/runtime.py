@@ -0,0 +1,99 @@
+"""
+Worker Runtime
+Один event loop на процесс воркера Celery и общие для всех задач ресурсы
+"""
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Optional
+
+from celery import Task
+from celery.signals import worker_process_init, worker_process_shutdown, worker_shutdown
+
+from database import engine
+from redis_client import redis_client
+from services.notification_service import notification_service
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerRuntime:
+    """
+    Event loop процесса воркера
+
+    Loop создаётся один раз и живёт до остановки процесса, поэтому
+    пул asyncpg, подключение к Redis, HTTP клиент Telegram и asyncio.Lock
+    rate limiter создаются при первой задаче и переиспользуются всеми
+    следующими, а не пересоздаются на каждый вызов.
+    """
+
+    def __init__(self):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        if self._loop is None or self._loop.is_closed():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+        return self._loop
+
+    def start(self):
+        """Подготовить процесс воркера (после fork)"""
+        # Соединения, унаследованные от родительского процесса, не используем
+        engine.sync_engine.dispose(close=False)
+        self.loop
+        logger.info("Worker runtime started")
+
+    def run(self, coro: Awaitable[Any]) -> Any:
+        """Выполнить корутину задачи в loop процесса"""
+        return self.loop.run_until_complete(coro)
+
+    def stop(self):
+        """Закрыть ресурсы и loop (при остановке процесса)"""
+        if self._loop is None or self._loop.is_closed():
+            return
+
+        try:
+            self._loop.run_until_complete(self._close_resources())
+            self._loop.run_until_complete(self._loop.shutdown_asyncgens())
+        finally:
+            self._loop.close()
+            self._loop = None
+            logger.info("Worker runtime stopped")
+
+    @staticmethod
+    async def _close_resources():
+        await notification_service.close()
+        await redis_client.close()
+        await engine.dispose()
+
+
+# Глобальный экземпляр runtime (один на процесс)
+runtime = WorkerRuntime()
+
+
+class AsyncTask(Task):
+    """
+    Базовый класс для асинхронных Celery задач
+
+    Задача объявляется как async def и выполняется в общем loop процесса.
+    Request (self.request) кладёт в стек трейсер Celery до вызова __call__.
+    """
+
+    def __call__(self, *args, **kwargs):
+        return runtime.run(self.run(*args, **kwargs))
+
+
+@worker_process_init.connect
+def start_worker_runtime(**kwargs):
+    runtime.start()
+
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def stop_worker_runtime(**kwargs):
+    """
+    Закрыть HTTP клиент Telegram, Redis и пул БД при остановке воркера
+    (worker_shutdown - для пулов solo/threads без дочерних процессов)
+    """
+    runtime.stop()